@@ -10,6 +10,9 @@ import logging.handlers
 import traceback
 import datetime
 import subprocess
+import time
+import json
+import queue
 
 # Python and Discord PY check Routine
 try:
@@ -32,7 +35,12 @@ except AssertionError:
 from cogs.utils.settings import Settings
 from cogs.utils.dataIO import dataIO
 from cogs.utils.chat_formatting import inline
-from collections import Counter
+from cogs.utils.dispatch import Dispatcher
+from cogs.utils.metrics import Metrics
+from cogs.utils.permissions import PermissionResolver
+from cogs.utils.outbound import OutboundQueue
+from cogs.utils.config import Config
+from discord.ext.commands.view import StringView
 from io import TextIOWrapper
 
 #
@@ -45,6 +53,11 @@ from io import TextIOWrapper
 
 description = "Chronoxia - A Multifunctional Discord Bot by Wolfstorm"
 
+METRICS_FILE = "data/chronoxia/metrics.prom"
+METRICS_INTERVAL = 60
+HELP_CACHE_SIZE = 2048
+LOG_QUEUE_SIZE = 10000
+
 
 # Bot Class
 class Bot(commands.Bot):
@@ -58,10 +71,15 @@ class Bot(commands.Bot):
             """
             return bot.settings.get_prefixes(message.server)
 
-        self.counter = Counter()
+        self.metrics = Metrics()
+        self.counter = self.metrics.counters
         self.uptime = datetime.datetime.utcnow()  # Refreshed before bot Logins
         self._message_modifiers = []
         self.settings = Settings()
+        self.config = Config()
+        self.permissions = PermissionResolver(self.settings)
+        self.dispatcher = Dispatcher(self)
+        self.outbound = OutboundQueue(self)
         self._intro_displayed = False
         self._shutdown_mode = None
         self.logger = set_logger(self)
@@ -72,27 +90,120 @@ class Bot(commands.Bot):
             kwargs['self_bot'] = self.settings.self_bot
             if self.settings.self_bot:
                 kwargs['pm_help'] = False
+        if self.settings.shard_count > 1:
+            kwargs.setdefault('shard_id', self.settings.shard_id)
+            kwargs.setdefault('shard_count', self.settings.shard_count)
         super().__init__(*args, command_prefix=prefix_manager, **kwargs)
 
-    async def send_message(self, *args, **kwargs):
+        for event in ("on_member_update", "on_member_remove",
+                      "on_server_role_update", "on_server_role_delete",
+                      "on_server_remove"):
+            self.add_listener(getattr(self.permissions, event), event)
+
+    async def send_message(self, *args, coalesce=False, **kwargs):
+        """
+        With coalesce=True a plain-text message goes through the channel's
+        outbound queue and may be merged with others queued behind the
+        rate limit. The returned Message can then hold more than content.
+        """
+        if coalesce:
+            if len(args) == 2 and not kwargs:
+                return await self.outbound.send(*args)
+            if len(args) == 1 and list(kwargs) == ["content"]:
+                return await self.outbound.send(args[0], kwargs["content"])
+
         if self._message_modifiers:
             if "content" in kwargs:
                 pass
             elif len(args) == 2:
                 args = list(args)
                 kwargs["content"] = args.pop()
-            else:
-                return await super().send_message(*args, **kwargs)
 
-            content = kwargs['content']
-            for m in self._message_modifiers:
-                try:
-                    content = str(m(content))
-                except:  # Faulty modifiers should not
-                    pass  # break send_message
-            kwargs['content'] = content
+            if "content" in kwargs:
+                content = kwargs['content']
+                for m in self._message_modifiers:
+                    try:
+                        content = str(m(content))
+                    except:  # Faulty modifiers should not
+                        pass  # break send_message
+                kwargs['content'] = content
+
+        with self.metrics.time("send_message_seconds"):
+            return await super().send_message(*args, **kwargs)
+
+    async def _run_extra(self, coro, event_name, *args, **kwargs):
+        if event_name != "message":
+            return await super()._run_extra(coro, event_name, *args, **kwargs)
+        name = getattr(coro, "__qualname__", None) or repr(coro)
+        with self.metrics.time("listener_seconds", ("listener", name)):
+            await super()._run_extra(coro, event_name, *args, **kwargs)
+
+    def add_cog(self, cog):
+        super().add_cog(cog)
+        if not dataIO.lazy:
+            dataIO.preload(cog)
+
+    # Keeps the dispatcher's name tables and help pages in step with
+    # loaded commands
+    def add_command(self, command):
+        super().add_command(command)
+        self.dispatcher.invalidate()
+        self.invalidate_help()
+
+    def remove_command(self, name):
+        command = super().remove_command(name)
+        self.dispatcher.invalidate()
+        self.invalidate_help()
+        return command
+
+    def invalidate_help(self):
+        formatter = getattr(self, "formatter", None)  # unset during __init__
+        invalidate = getattr(formatter, "invalidate", None)
+        if invalidate is not None:
+            invalidate()
+
+    async def process_commands(self, message, route=None):
+        """
+        Same as discord.py's process_commands, but takes the Route the
+        dispatcher already parsed instead of matching prefixes again
+        """
+        _internal_channel = message.channel
+        _internal_author = message.author
 
-        return await super().send_message(*args, **kwargs)
+        if self._skip_check(message.author, self.user):
+            return
+
+        if route is None:
+            route = self.dispatcher.parse(message)
+            if route is None:
+                return
+
+        view = StringView(route.content)
+        view.skip_string(route.prefix)
+        invoker = view.get_word()
+        ctx = commands.Context(bot=self, invoked_with=invoker,
+                               message=message, view=view,
+                               prefix=route.prefix)
+
+        command = route.command
+        if command is not None:
+            self.dispatch('command', command, ctx)
+            start = time.perf_counter()
+            try:
+                await command.invoke(ctx)
+            except commands.CommandError as e:
+                ctx.command.dispatch_error(e, ctx)
+            else:
+                self.dispatch('command_completion', command, ctx)
+            finally:
+                name = (ctx.command or command).qualified_name
+                self.metrics.observe("command_seconds",
+                                     time.perf_counter() - start,
+                                     ("command", name))
+        elif invoker:
+            exc = commands.CommandNotFound(
+                'Command "{}" is not found'.format(invoker))
+            self.dispatch('command_error', exc, ctx)
 
     # Graceful Quiting with Exit Code 0
     async def shutdown(self, *, restart=False):
@@ -101,6 +212,7 @@ class Bot(commands.Bot):
         Launcher auto restarts when exit code is 26
         """
         self._shutdown_mode = not restart
+        dataIO.flush()
         await self.logout()
 
     # Adds a Message Modifier to the bot
@@ -120,119 +232,118 @@ class Bot(commands.Bot):
             raise TypeError("The message modifier function "
                             "must be a callable.")
 
-            self._message_modifiers.append(func)
-
-        # Remove Message Modifier from the bot
+        self._message_modifiers.append(func)
 
+    # Remove Message Modifier from the bot
+    def remove_message_modifier(self, func):
+        if func not in self._message_modifiers:
+            raise RuntimeError("Function not present in the message "
+                               "modifiers.")
 
-def remove_message_modifier(self, func):
-    if func not in self._message_modifiers:
-        raise RuntimeError("Function not present in the message "
-                           "modifiers.")
+        self._message_modifiers.remove(func)
 
-    self._message_modifiers.remove(func)
+    # Remove all Message Modifiers from the bot
+    def clear_message_modifiers(self):
+        self._message_modifiers.clear()
 
+    async def send_cmd_help(self, ctx):
+        if ctx.invoked_subcommand:
+            pages = self.formatter.format_help_for(ctx, ctx.invoked_subcommand)
+        else:
+            pages = self.formatter.format_help_for(ctx, ctx.command)
+        await asyncio.gather(*[self.send_message(ctx.message.channel, page,
+                                                 coalesce=True)
+                               for page in pages])
 
-# Remove all Message Modifiers from the bot
-def clear_message_modifiers(self):
-    self._message_modifiers.clear()
-
-
-async def send_cmd_help(self, ctx):
-    if ctx.invoked_subcommand:
-        pages = self.formatter.format_help_for(ctx, ctx.invoked_subcommand)
-        for page in pages:
-            await self.send_message(ctx.message.channel, page)
-    else:
-        pages = self.formatter.format_help_for(ctx, ctx.command)
-        for page in pages:
-            await self.send_message(ctx.message.channel, page)
-
-
-def user_allowed(self, message):
-    author = message.author
-
-    if author.bot:
-        return False
+    def user_allowed(self, message):
+        author = message.author
 
-    if author == self.user:
-        return self.settings.self_bot
-
-    mod = self.get_cog('Mod')
-
-    if mod is not None:
-        if self.settings.owner == author.id:
-            return True
-        if not message.channel.is_private:
-            server = message.server
-            names = (self.settings.get_server_admin(
-                server), self.settings.get_server_mod(server))
-            results = map(
-                lambda name: discord.utils.get(author.roles, name=name),
-                names)
-            for r in results:
-                if r is not None:
-                    return True
-
-        if author.id in mod.blacklist_list:
+        if author.bot:
             return False
 
-        if mod.whitelist_list:
-            if author.id not in mod.whitelist_list:
-                return False
+        if author == self.user:
+            return self.settings.self_bot
 
-        if not message.channel.is_private:
-            if message.server.id in mod.ignore_list["SERVERS"]:
-                return False
-
-            if message.channel.id in mod.ignore_list["CHANNELS"]:
-                return False
-        return True
-    else:
-        return True
+        return self.permissions.user_allowed(message)
 
     # Pip Install - OSX
+    async def pip_install(self, name, *, timeout=None):
+        """
+        Installs a pip package in the local 'lib' folder in a thread safe
+        way. On Mac systems the 'lib' folder is not used.
+        Can specify the max seconds to wait for the task to complete
 
+        Returns a bool indicating if the installation was successful
+        """
 
-async def pip_install(self, name, *, timeout=None):
-    """
-       Installs a pip package in the local 'lib' folder in a thread safe
-       way. On Mac systems the 'lib' folder is not used.
-       Can specify the max seconds to wait for the task to complete
-
-       Returns a bool indicating if the installation was successful
-       """
+        IS_MAC = sys.platform == "darwin"
+        interpreter = sys.executable
 
-    IS_MAC = sys.platform == "darwin"
-    interpreter = sys.executable
+        if interpreter is None:
+            raise RuntimeError("Couldn't find Python's interpreter")
 
-    if interpreter is None:
-        raise RuntimeError("Couldn't find Python's interpreter")
+        args = [
+            interpreter, "-m",
+            "pip", "install",
+            "--upgrade",
+            "--target", "lib",
+            name
+        ]
 
-    args = [
-        interpreter, "-m",
-        "pip", "install",
-        "--upgrade",
-        "--target", "lib",
-        name
-    ]
+        if IS_MAC:  # --target is a problem on Homebrew.
+            args.remove("--target")
+            args.remove("lib")
 
-    if IS_MAC:  # --target is a problem on Homebrew.
-        args.remove("--target")
-        args.remove("lib")
+        def install():
+            code = subprocess.call(args)
+            sys.path_importer_cache = {}
+            return not bool(code)
 
-    def install():
-        code = subprocess.call(args)
-        sys.path_importer_cache = {}
-        return not bool(code)
+        response = self.loop.run_in_executor(None, install)
+        return await asyncio.wait_for(response, timeout=timeout)
 
-    response = self.loop.run_in_executor(None, install)
-    return await asyncio.wait_for(response, timeout=timeout)  
 
-    # Format Class
+# Format Class
 class Formatter(commands.HelpFormatter):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._pages = {}
+
+    def invalidate(self):
+        self._pages.clear()
+
+    def format_help_for(self, context, command_or_bot):
+        """
+        Rendered pages are cached by command, prefix and what the author
+        can see: their tier, channel permissions and whether it's a DM.
+        The cache is dropped whenever commands are added, removed,
+        enabled or disabled.
+        """
+        bot = context.bot
+        message = context.message
+        if isinstance(command_or_bot, commands.Command):
+            name = command_or_bot.qualified_name
+        elif command_or_bot is bot:
+            name = None
+        else:  # Cog
+            name = "cog:" + type(command_or_bot).__name__
+        channel = message.channel
+        # Same tier lookup as the checks that decide what's listed
+        key = (name, context.prefix,
+               bot.permissions.tier(message.author, message.server,
+                                    ignore_case=True),
+               channel.is_private,
+               channel.permissions_for(message.author).value)
+        pages = self._pages.get(key)
+        if pages is None:
+            bot.counter["help_cache_misses"] += 1
+            pages = super().format_help_for(context, command_or_bot)
+            if len(self._pages) >= HELP_CACHE_SIZE:
+                self._pages.clear()
+            self._pages[key] = pages
+        else:
+            bot.counter["help_cache_hits"] += 1
+        return list(pages)
 
     def _add_subcommands_to_page(self, max_width, commands):
         for name, command in sorted(commands, key=lambda t: t[0]):
@@ -256,6 +367,13 @@ def initialize(bot_class=Bot, formatter_class=Formatter):
     __main__.send_cmd_help = bot.send_cmd_help
     __main__.user_allowed = bot.user_allowed
     __main__.settings = bot.settings
+    __main__.permissions = bot.permissions
+
+    bot.metrics.add_gauge("servers", lambda: len(bot.servers))
+    bot.metrics.add_gauge("voice_clients", lambda: len(bot.voice_clients))
+    bot.metrics.add_gauge("config_guilds_loaded", bot.config.loaded_guilds)
+    bot.metrics.add_gauge("uptime_seconds", lambda: (
+        datetime.datetime.utcnow() - bot.uptime).total_seconds())
 
     # Def - get_oauth_url
     async def get_oauth_url():
@@ -359,8 +477,14 @@ def initialize(bot_class=Bot, formatter_class=Formatter):
     @bot.event
     async def on_message(message):
         bot.counter["messages_read"] += 1
-        if bot.user_allowed(message):
-            await bot.process_commands(message)
+        with bot.metrics.time("listener_seconds", ("listener", "core.parse")):
+            route = bot.dispatcher.parse(message)
+        if route is None:
+            return
+        with bot.metrics.time("user_allowed_seconds"):
+            allowed = bot.user_allowed(message)
+        if allowed:
+            await bot.dispatcher.dispatch(message, route)
 
     # Bot Event Def - on_command_error
     @bot.event
@@ -471,7 +595,45 @@ def interactive_setup(settings):
 
 
 # Logger Set
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the caller: records are dropped once the queue is full"""
+
+    def __init__(self, queue, counter):
+        super().__init__(queue)
+        self.counter = counter
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.counter["log_records_dropped"] += 1
+
+
+class BlockingStopQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Waits for room instead of failing when the queue is full
+        self.queue.put(self._sentinel)
+
+
+class JSONLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "func": record.funcName,
+            "line": record.lineno,
+            "msg": record.getMessage()
+        }
+        return json.dumps(entry, ensure_ascii=False)
+
+
 def set_logger(bot):
+    """
+    Every handler doing disk or console I/O sits behind a QueueListener
+    thread. The loggers only put records on a bounded queue.
+    """
     logger = logging.getLogger("chronoxia")
     logger.setLevel(logging.INFO)
 
@@ -490,12 +652,22 @@ def set_logger(bot):
         logger.setLevel(logging.INFO)
 
     fhandler = logging.handlers.RotatingFileHandler(
-        filename='data/chronoxia/chronoxia.log', encoding='utf-8', mode='a',
+        filename=dataIO.path('data/chronoxia/chronoxia.log'),
+        encoding='utf-8', mode='a',
         maxBytes=10 ** 7, backupCount=5)
     fhandler.setFormatter(chrono_format)
 
-    logger.addHandler(fhandler)
-    logger.addHandler(stdout_handler)
+    chrono_handlers = [fhandler, stdout_handler]
+
+    if bot.settings.log_json:
+        jhandler = logging.handlers.RotatingFileHandler(
+            filename=dataIO.path('data/chronoxia/chronoxia.jsonl'),
+            encoding='utf-8', mode='a', maxBytes=10 ** 7, backupCount=5)
+        jhandler.setFormatter(JSONLinesFormatter())
+        chrono_handlers.append(jhandler)
+
+    for h in chrono_handlers:
+        h.addFilter(logging.Filter("chronoxia"))
 
     dpy_logger = logging.getLogger("discord")
     if bot.settings.debug:
@@ -503,12 +675,24 @@ def set_logger(bot):
     else:
         dpy_logger.setLevel(logging.WARNING)
     handler = logging.FileHandler(
-        filename='data/chronoxia/discord.log', encoding='utf-8', mode='a')
+        filename=dataIO.path('data/chronoxia/discord.log'),
+        encoding='utf-8', mode='a')
     handler.setFormatter(logging.Formatter(
         '%(asctime)s %(levelname)s %(module)s %(funcName)s %(lineno)d: '
         '%(message)s',
         datefmt="[%d/%m/%Y %H:%M]"))
-    dpy_logger.addHandler(handler)
+    handler.addFilter(logging.Filter("discord"))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue, bot.counter)
+    logger.addHandler(queue_handler)
+    dpy_logger.addHandler(queue_handler)
+
+    bot.log_listener = BlockingStopQueueListener(
+        log_queue, *(chrono_handlers + [handler]),
+        respect_handler_level=True)
+    bot.log_listener.start()
+    bot.metrics.add_gauge("log_queue_depth", log_queue.qsize)
 
     return logger
 
@@ -550,8 +734,16 @@ def load_cogs(bot):
     except:
         registry = {}
 
+    profile = [] if bot.settings._profile_startup else None
+    dataIO.lazy = bot.settings._lazy_cogs
+
+    start, json_start = time.perf_counter(), dataIO.load_seconds
     bot.load_extension('cogs.owner')
     owner_cog = bot.get_cog('Owner')
+    if profile is not None:
+        json_time = dataIO.load_seconds - json_start
+        profile.append(("cogs.owner", 0.0, json_time,
+                        time.perf_counter() - start - json_time))
 
     # Assuming the user deleted the Owner Cog
     if owner_cog is None:
@@ -581,23 +773,53 @@ def load_cogs(bot):
             continue
         to_load = registry.get(extension, False)
         if to_load:
+            timings = {}
+            json_start = dataIO.load_seconds
             try:
-                owner_cog._load_cog(extension)
+                owner_cog._load_cog(extension, timings)
             except Exception as e:
                 print("{}: {}".format(e.__class__.__name__, str(e)))
                 bot.logger.exception(e)
                 failed.append(extension)
                 registry[extension] = False
+            else:
+                if profile is not None:
+                    json_time = dataIO.load_seconds - json_start
+                    profile.append((extension, timings["import"], json_time,
+                                    timings["setup"] - json_time))
 
-    dataIO.save_json("data/chronxoia/cogs.json", registry)
+    dataIO.save_json("data/chronoxia/cogs.json", registry)
+
+    if profile is not None:
+        print_startup_profile(profile)
 
     if failed:
         print("\nFailed to load: {}\n".format(" ".join(failed)))
 
 
+# Startup Profile
+def print_startup_profile(profile):
+    mode = "lazy" if dataIO.lazy else "eager"
+    lines = ["Startup profile ({} data loading, ms)".format(mode),
+             "{:<20} {:>9} {:>9} {:>9} {:>9}".format(
+                 "cog", "import", "json", "setup", "total")]
+    totals = [0.0, 0.0, 0.0]
+    for name, *times in sorted(profile, key=lambda p: -sum(p[1:])):
+        totals = [t + x for t, x in zip(totals, times)]
+        lines.append("{:<20} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            name, *[t * 1000 for t in times + [sum(times)]]))
+    lines.append("{:<20} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+        "total", *[t * 1000 for t in totals + [sum(totals)]]))
+    print("\n".join(lines) + "\n")
+
+
 # Def Main
 def main(bot):
     check_folders()
+    dataIO.start_flusher(bot.loop)
+    metrics_file = dataIO.path(METRICS_FILE)
+    bot.loop.create_task(bot.metrics.write_loop(bot.loop, metrics_file,
+                                                METRICS_INTERVAL))
     if not bot.settings.no_prompt:
         interactive_setup(bot.settings)
     load_cogs(bot)
@@ -649,6 +871,8 @@ if __name__ == '__main__':
                              exc_info=e)
         loop.run_until_complete(bot.logout())
     finally:
+        dataIO.flush()
+        bot.log_listener.stop()
         loop.close()
         if bot._shutdown_mode is True:
             exit(0)
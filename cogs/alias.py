@@ -1,19 +1,25 @@
 from discord.ext import commands
 from .utils.chat_formatting import box
-from .utils.dataIO import dataIO
 from .utils import checks
-from __main__ import user_allowed, send_cmd_help
-from copy import deepcopy
-import os
+from __main__ import send_cmd_help
+from copy import copy
 import discord
 
 
 class Alias:
+    legacy_file = "data/alias/aliases.json"
+
     def __init__(self, bot):
         self.bot = bot
-        self.file_path = "data/alias/aliases.json"
-        self.aliases = dataIO.load_json(self.file_path)
-        self.remove_old()
+        # Each guild's data is its {alias: command} mapping
+        self.aliases = bot.config.namespace("Alias", legacy=self.legacy_file,
+                                            on_load=self.fix_aliases)
+        self.aliases.subscribe(self.aliases_changed)
+        bot.dispatcher.register("alias", self.aliases.guild, self.run_alias)
+
+    def __unload(self):
+        self.aliases.unsubscribe(self.aliases_changed)
+        self.bot.dispatcher.unregister("alias")
 
     @commands.group(pass_context=True, no_pm=True)
     async def alias(self, ctx):
@@ -41,11 +47,8 @@ class Alias:
         prefix = self.get_prefix(server, to_execute)
         if prefix is not None:
             to_execute = to_execute[len(prefix):]
-        if server.id not in self.aliases:
-            self.aliases[server.id] = {}
         if command not in self.bot.commands:
-            self.aliases[server.id][command] = to_execute
-            dataIO.save_json(self.file_path, self.aliases)
+            self.aliases.set(server.id, command, to_execute)
             await self.bot.say("Alias '{}' added.".format(command))
         else:
             await self.bot.say("Cannot add '{}' because it's a real bot "
@@ -55,8 +58,8 @@ class Alias:
     async def _help_alias(self, ctx, command):
         """Tries to execute help for the base command of the alias"""
         server = ctx.message.server
-        if server.id in self.aliases:
-            server_aliases = self.aliases[server.id]
+        server_aliases = self.aliases.guild(server.id)
+        if server_aliases:
             if command in server_aliases:
                 help_cmd = server_aliases[command].split(" ")[0]
                 new_content = self.bot.settings.get_prefixes(server)[0]
@@ -73,8 +76,8 @@ class Alias:
     async def _show_alias(self, ctx, command):
         """Shows what command the alias executes."""
         server = ctx.message.server
-        if server.id in self.aliases:
-            server_aliases = self.aliases[server.id]
+        server_aliases = self.aliases.guild(server.id)
+        if server_aliases:
             if command in server_aliases:
                 await self.bot.say(box(server_aliases[command]))
             else:
@@ -86,9 +89,7 @@ class Alias:
         """Deletes an alias"""
         command = command.lower()
         server = ctx.message.server
-        if server.id in self.aliases:
-            self.aliases[server.id].pop(command, None)
-            dataIO.save_json(self.file_path, self.aliases)
+        self.aliases.delete(server.id, command)
         await self.bot.say("Alias '{}' deleted.".format(command))
 
     @alias.command(name="list", pass_context=True, no_pm=True)
@@ -97,9 +98,10 @@ class Alias:
 
         Responds in DM"""
         server = ctx.message.server
-        if server.id in self.aliases:
+        server_aliases = self.aliases.guild(server.id)
+        if server_aliases:
             message = "```Alias list:\n"
-            for alias in sorted(self.aliases[server.id]):
+            for alias in sorted(server_aliases):
                 if len(message) + len(alias) + 3 > 2000:
                     await self.bot.whisper(message)
                     message = "```\n"
@@ -110,25 +112,15 @@ class Alias:
             else:
                 await self.bot.say("There are no aliases on this server.")
 
-    async def on_message(self, message):
-        if len(message.content) < 2 or message.channel.is_private:
-            return
-
-        msg = message.content
-        server = message.server
-        prefix = self.get_prefix(server, msg)
-
-        if not prefix:
-            return
-
-        if server.id in self.aliases and user_allowed(message):
-            alias = self.first_word(msg[len(prefix):]).lower()
-            if alias in self.aliases[server.id]:
-                new_command = self.aliases[server.id][alias]
-                args = message.content[len(prefix + alias):]
-                new_message = deepcopy(message)
-                new_message.content = prefix + new_command + args
-                await self.bot.process_commands(new_message)
+    async def run_alias(self, message, route):
+        """Called by the bot's dispatcher when a message names an alias"""
+        prefix = route.prefix
+        alias = self.first_word(route.content[len(prefix):]).lower()
+        args = route.content[len(prefix + alias):]
+        new_message = copy(message)
+        new_message.content = prefix + route.alias + args
+        new_route = self.bot.dispatcher.rewrite(route, new_message.content)
+        await self.bot.process_commands(new_message, new_route)
 
     def part_of_existing_command(self, alias, server):
         '''Command or alias'''
@@ -137,55 +129,40 @@ class Alias:
                 return True
         return False
 
-    def remove_old(self):
-        for sid in self.aliases:
-            to_delete = []
-            to_add = []
-            for aliasname, alias in self.aliases[sid].items():
-                lower = aliasname.lower()
-                if aliasname != lower:
-                    to_delete.append(aliasname)
-                    to_add.append((lower, alias))
-                if aliasname != self.first_word(aliasname):
-                    to_delete.append(aliasname)
-                    continue
-                server = discord.Object(id=sid)
-                prefix = self.get_prefix(server, alias)
-                if prefix is not None:
-                    self.aliases[sid][aliasname] = alias[len(prefix):]
-            for alias in to_delete:  # Fixes caps and bad prefixes
-                del self.aliases[sid][alias]
-            for alias, command in to_add:  # For fixing caps
-                self.aliases[sid][alias] = command
-        dataIO.save_json(self.file_path, self.aliases)
+    def aliases_changed(self, sid, alias, command):
+        self.bot.dispatcher.invalidate(sid)
+
+    def fix_aliases(self, sid, aliases):
+        """Fixes caps, multi-word names and prefixed commands"""
+        to_delete = []
+        to_add = []
+        changed = False
+        server = discord.Object(id=sid)
+        for aliasname, alias in aliases.items():
+            lower = aliasname.lower()
+            if aliasname != lower:
+                to_delete.append(aliasname)
+                to_add.append((lower, alias))
+            if aliasname != self.first_word(aliasname):
+                to_delete.append(aliasname)
+                continue
+            prefix = self.get_prefix(server, alias)
+            if prefix is not None:
+                aliases[aliasname] = alias[len(prefix):]
+                changed = True
+        for alias in to_delete:
+            aliases.pop(alias, None)
+        for alias, command in to_add:
+            aliases[alias] = command
+        return changed or bool(to_delete)
 
     def first_word(self, msg):
         return msg.split(" ")[0]
 
     def get_prefix(self, server, msg):
         prefixes = self.bot.settings.get_prefixes(server)
-        for p in prefixes:
-            if msg.startswith(p):
-                return p
-        return None
-
-
-def check_folder():
-    if not os.path.exists("data/alias"):
-        print("Creating data/alias folder...")
-        os.makedirs("data/alias")
-
-
-def check_file():
-    aliases = {}
-
-    f = "data/alias/aliases.json"
-    if not dataIO.is_valid_json(f):
-        print("Creating default alias's aliases.json...")
-        dataIO.save_json(f, aliases)
+        return self.bot.dispatcher.get_trie(prefixes).match(msg)
 
 
 def setup(bot):
-    check_folder()
-    check_file()
     bot.add_cog(Alias(bot))
@@ -1,23 +1,28 @@
 import discord
 from discord.ext import commands
-import threading
+from discord.voice_client import StreamPlayer, ProcessPlayer
 import os
 from random import shuffle, choice
 from cogs.utils.dataIO import dataIO
 from cogs.utils import checks
 from cogs.utils.chat_formatting import pagify
-from urllib.parse import urlparse
+from urllib.parse import urlparse, parse_qs
 from __main__ import send_cmd_help, settings
 from json import JSONDecodeError
 import re
 import logging
 import collections
 import copy
+import heapq
+import itertools
 import asyncio
 import math
 import time
 import inspect
 import subprocess
+import threading
+import audioop
+from concurrent.futures import ThreadPoolExecutor
 
 __author__ = "tekulvw"
 __version__ = "0.1.1"
@@ -29,6 +34,11 @@ try:
 except:
     youtube_dl = None
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 try:
     if not discord.opus.is_loaded():
         discord.opus.load_opus('libopus-0.dll')
@@ -39,6 +49,32 @@ except:  # Missing opus
 else:
     opus = True
 
+# Threads available to youtube_dl for resolving and downloading songs
+RESOLVER_WORKERS = 8
+
+# Song metadata is reused for a day, keeping at most this many entries
+INFO_CACHE_TTL = 24 * 60 * 60
+INFO_CACHE_SIZE = 5000
+
+# A cached song's popularity halves for every day it isn't played
+CACHE_HALF_LIFE = 24 * 60 * 60
+
+# Song downloads running at once across every server, kept below
+#   RESOLVER_WORKERS so metadata lookups still get a thread
+DOWNLOAD_WORKERS = 4
+
+# Pre-encoded songs: OPUS_MAGIC, then every 20ms Opus packet prefixed
+#   with its length as 2 big endian bytes
+OPUS_MAGIC = b"CHRONOPUS1\n"
+
+# PCM effects run on this many 20ms frames at a time
+EFFECTS_BATCH = 10
+# Loudness normalisation plays songs at their ReplayGain, boosting quiet
+#   songs by at most NORMALIZE_MAX_GAIN
+NORMALIZE_MAX_GAIN = 4.0
+# The limiter starts bending samples above this level, full scale being 1
+LIMITER_THRESHOLD = 0.8
+
 youtube_dl_options = {
     'source_address': '0.0.0.0',
     'format': 'bestaudio/best',
@@ -221,34 +257,1020 @@ class Playlist:
             return None
 
 
-class Downloader(threading.Thread):
+class InfoCache:
+    """Song metadata already returned by youtube_dl
+
+    Entries are keyed by normalized url, which for YouTube is the video id,
+    expire after ttl seconds and the least recently used ones are dropped
+    past max_size. Only used from the event loop."""
+
+    # Enough to show a song and to rebuild playlists from their entries
+    kept_keys = ("_type", "id", "title", "url", "webpage_url", "duration",
+                 "creator", "uploader", "view_count", "extractor", "ie_key",
+                 "entries")
+
+    def __init__(self, path=None, ttl=INFO_CACHE_TTL,
+                 max_size=INFO_CACHE_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # key: [fetched, used, info]
+        if path is not None and dataIO.is_valid_json(path):
+            saved = dataIO.load_json(path)
+            for key, entry in sorted(saved.items(), key=lambda e: e[1][1]):
+                self._entries[key] = entry
+            self._expire()
+
+    @staticmethod
+    def normalize(url):
+        if url.startswith("[SEARCH:]"):
+            return "search:" + " ".join(url[9:].lower().split())
+        parsed = urlparse(url)
+        host = parsed.netloc.lower()
+        for prefix in ("www.", "m."):
+            if host.startswith(prefix):
+                host = host[len(prefix):]
+        path = parsed.path.rstrip("/")
+        query = parse_qs(parsed.query)
+        if host == "youtube.com" and path == "/watch" and "v" in query:
+            return "youtube:" + query["v"][0]
+        if host == "youtu.be" and path:
+            return "youtube:" + path[1:]
+        if host == "youtube.com" and path == "/playlist" and "list" in query:
+            return "youtube-playlist:" + query["list"][0]
+        if parsed.query:
+            return "{}{}?{}".format(host, path, parsed.query)
+        return host + path
+
+    def get(self, url):
+        key = self.normalize(url)
+        entry = self._entries.get(key)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            self.misses += 1
+            return None
+        entry[1] = time.time()
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return copy.deepcopy(entry[2])
+
+    def put(self, info, *urls):
+        info = {k: v for k, v in info.items() if k in self.kept_keys}
+        if info.get("entries") is not None:
+            info["entries"] = [{k: v for k, v in e.items()
+                                if k in self.kept_keys}
+                               for e in info["entries"] if e]
+        now = time.time()
+        for url in urls:
+            key = self.normalize(url)
+            self._entries[key] = [now, now, info]
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self.save()
+
+    def save(self):
+        if self.path is not None:
+            dataIO.mark_dirty(self.path, self._entries)
+
+    def _expire(self):
+        now = time.time()
+        for key in [k for k, e in self._entries.items()
+                    if now - e[0] > self.ttl]:
+            del self._entries[key]
+
+
+class CacheIndex:
+    """Sizes, last use and play counts of the files in the audio cache
+
+    The directory is scanned once when the index is created, after that
+    the total size is kept up to date as songs are added and evicted.
+    A song's size includes extra_size(song_id), the copies made of it
+    elsewhere that on_remove deletes along with it. Eviction removes the
+    least popular files first: a song's play count decays with
+    CACHE_HALF_LIFE since it was last played. Each song also keeps its
+    ReplayGain once it's been measured. Only used from the event loop."""
+
+    def __init__(self, cache_path, path=None, on_remove=None,
+                 extra_size=None):
+        self.cache_path = cache_path
+        self.path = path
+        self.on_remove = on_remove
+        self.extra_size = extra_size
+        self.hits = 0
+        self.misses = 0
+        self.total = 0  # bytes
+        self._entries = {}  # song id: [size, last used, plays, gain]
+        saved = {}
+        if path is not None and dataIO.is_valid_json(path):
+            saved = dataIO.load_json(path)
+        for entry in os.scandir(cache_path):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            size = stat.st_size + self._extra_size(entry.name)
+            _, used, plays, *gain = saved.get(entry.name,
+                                              (0, stat.st_mtime, 0))
+            self._entries[entry.name] = [size, used, plays,
+                                         gain[0] if gain else None]
+            self.total += size
+        self.save()
+
+    def __contains__(self, song_id):
+        return song_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def size(self):
+        """Cache size in MB"""
+        return self.total / 10**6
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def lookup(self, song_id):
+        """Counts a play of song_id, returns whether it's cached"""
+        # Stats the file even on a hit, it may be gone since it was indexed
+        if not self.add(song_id):
+            entry = self._entries.pop(song_id, None)
+            if entry is not None:
+                self.total -= entry[0]
+                self.save()
+            self.misses += 1
+            return False
+        self.hits += 1
+        self.touch(song_id)
+        return True
+
+    def add(self, song_id):
+        """Indexes a file that just landed in the cache"""
+        try:
+            size = os.path.getsize(os.path.join(self.cache_path, song_id))
+        except OSError:
+            return False
+        size += self._extra_size(song_id)
+        old = self._entries.get(song_id)
+        if old is not None:
+            self.total -= old[0]
+            old[0] = size
+        else:
+            self._entries[song_id] = [size, time.time(), 0, None]
+        self.total += size
+        self.save()
+        return True
+
+    def _extra_size(self, song_id):
+        return self.extra_size(song_id) if self.extra_size else 0
+
+    def touch(self, song_id):
+        entry = self._entries[song_id]
+        entry[1] = time.time()
+        entry[2] += 1
+        self.save()
+
+    def gain(self, song_id):
+        """The song's ReplayGain as a factor, None if not measured yet"""
+        entry = self._entries.get(song_id)
+        return entry[3] if entry is not None else None
+
+    def set_gain(self, song_id, gain):
+        entry = self._entries.get(song_id)
+        if entry is not None:
+            entry[3] = gain
+            self.save()
+
+    def score(self, entry, now):
+        _, used, plays, _ = entry
+        return (1 + plays) * 0.5 ** ((now - used) / CACHE_HALF_LIFE)
+
+    def evict(self, max_size, required=(), desired=()):
+        """Deletes the least popular files until the cache fits max_size
+        MB. required files are never removed, desired ones only if the
+        rest wasn't enough. Returns the MB freed"""
+        limit = max_size * 10**6
+        if self.total <= limit:
+            return 0.0
+        before = self.total
+        now = time.time()
+        heap = [(self.score(e, now), song_id)
+                for song_id, e in self._entries.items()
+                if song_id not in required]
+        heapq.heapify(heap)
+        spared = []
+        while heap and self.total > limit:
+            _, song_id = heapq.heappop(heap)
+            if song_id in desired:
+                spared.append(song_id)
+                continue
+            self.remove(song_id)
+        for song_id in spared:
+            if self.total <= limit:
+                break
+            self.remove(song_id)
+        return (before - self.total) / 10**6
+
+    def clear(self, required=(), desired=()):
+        """Deletes everything but required and desired files"""
+        before = self.total
+        for song_id in [s for s in self._entries
+                        if s not in required and s not in desired]:
+            self.remove(song_id)
+        return (before - self.total) / 10**6
+
+    def remove(self, song_id):
+        try:
+            os.remove(os.path.join(self.cache_path, song_id))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # In use on Windows, keep it indexed
+            return
+        self.total -= self._entries.pop(song_id)[0]
+        self.save()
+        if self.on_remove is not None:
+            self.on_remove(song_id)
+
+    def save(self):
+        if self.path is not None:
+            dataIO.mark_dirty(self.path, self._entries)
+
+
+def encode_opus_frames(source, destination, use_avconv=False):
+    """Decodes source once and writes it as Opus frames for
+    OpusFramePlayer. Blocking. Returns the number of frames written"""
+    encoder = discord.opus.Encoder(48000, 2)  # What VoiceClient uses
+    args = ["avconv" if use_avconv else "ffmpeg", "-loglevel", "error",
+            "-i", source, "-f", "s16le", "-ar", str(encoder.sampling_rate),
+            "-ac", str(encoder.channels), "pipe:1"]
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    tmp_file = destination + ".tmp"
+    frames = 0
+    try:
+        with open(tmp_file, "wb") as f:
+            f.write(OPUS_MAGIC)
+            while True:
+                pcm = process.stdout.read(encoder.frame_size)
+                if len(pcm) != encoder.frame_size:
+                    break  # The player drops a partial last frame too
+                packet = encoder.encode(pcm, encoder.samples_per_frame)
+                f.write(len(packet).to_bytes(2, "big"))
+                f.write(packet)
+                frames += 1
+    finally:
+        process.stdout.close()
+        process.wait()
+    if process.returncode != 0 or not frames:
+        os.remove(tmp_file)
+        return 0
+    os.replace(tmp_file, destination)
+    return frames
+
+
+class OpusFramePlayer(StreamPlayer):
+    """Plays a file written by encode_opus_frames
+
+    Packets go to the voice socket as they are, there's no ffmpeg process
+    and no encoding. Volume can't be applied to encoded audio, so it's
+    only used at 100%."""
+
+    def __init__(self, filename, client, *, after=None):
+        stream = open(filename, "rb")
+        if stream.read(len(OPUS_MAGIC)) != OPUS_MAGIC:
+            stream.close()
+            raise ValueError("{} isn't an Opus frame file".format(filename))
+        super().__init__(stream, client.encoder, client._connected,
+                         client.play_audio, after)
+
+    def _do_run(self):
+        self.loops = 0
+        self._start = time.time()
+        while not self._end.is_set():
+            if not self._resumed.is_set():
+                self._resumed.wait()
+
+            if not self._connected.is_set():
+                self.stop()
+                break
+
+            self.loops += 1
+            header = self.buff.read(2)
+            packet = self.buff.read(int.from_bytes(header, "big"))
+            if len(header) != 2 or not packet:
+                self.stop()
+                break
+
+            self.player(packet, encode=False)
+            next_time = self._start + self.delay * self.loops
+            delay = max(0, self.delay + (next_time - time.time()))
+            time.sleep(delay)
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self.buff.close()
+
+
+def decoder_process(filename, use_avconv=False, gain=1.0):
+    """ffmpeg (or avconv) decoding filename to the PCM voice clients play,
+    scaled by gain"""
+    args = ["avconv" if use_avconv else "ffmpeg", "-loglevel", "error",
+            "-i", filename, "-vn", "-f", "s16le", "-ar", "48000", "-ac", "2"]
+    if gain != 1.0:
+        args += ["-af", "volume={:.2f}".format(gain)]
+    args.append("pipe:1")
+    return subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+
+
+def measure_track_gain(source, use_avconv=False):
+    """ReplayGain of source as a factor, lowered so the song's peak
+    doesn't clip and at most NORMALIZE_MAX_GAIN. Measured by ffmpeg's
+    replaygain filter, avconv has none. None if it couldn't be measured.
+    Blocking"""
+    args = ["avconv" if use_avconv else "ffmpeg", "-nostats", "-i", source,
+            "-vn", "-af", "replaygain", "-f", "null", "-"]
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE)
+    _, output = process.communicate()
+    if process.returncode != 0:
+        return None
+    output = output.decode("utf-8", "replace")
+    gain = re.search(r"track_gain = ([-+]?[\d.]+) dB", output)
+    peak = re.search(r"track_peak = ([\d.]+)", output)
+    if gain is None:
+        return None
+    gain = 10 ** (float(gain.group(1)) / 20)
+    if peak is not None and float(peak.group(1)) > 0:
+        gain = min(gain, 1 / float(peak.group(1)))
+    return round(min(gain, NORMALIZE_MAX_GAIN), 4)
+
+
+def crossfade_frames(tail, head):
+    """Mixes the last frames of a song into the first ones of the next"""
+    if numpy is not None and tail and head:
+        count = min(len(tail), len(head))
+        out = numpy.frombuffer(b"".join(tail[:count]), dtype="<i2")
+        into = numpy.frombuffer(b"".join(head[:count]), dtype="<i2")
+        ramp = numpy.linspace(0, 1, len(out) + 2, dtype=numpy.float32)[1:-1]
+        mixed = (out * (1 - ramp) + into * ramp).astype("<i2").tobytes()
+        size = len(tail[0])
+        return ([mixed[i:i + size] for i in range(0, len(mixed), size)] +
+                tail[count:])
+    steps = len(tail) + 1
+    mixed = []
+    for i, (out, into) in enumerate(zip(tail, head), 1):
+        mixed.append(audioop.add(audioop.mul(out, 2, 1 - i / steps),
+                                 audioop.mul(into, 2, i / steps), 2))
+    return mixed + tail[len(mixed):]
+
+
+def soft_clip(samples, threshold=LIMITER_THRESHOLD):
+    """Bends float samples above threshold smoothly towards full scale,
+    in place"""
+    over = numpy.abs(samples) > threshold
+    if over.any():
+        knee = 1 - threshold
+        loud = samples[over]
+        bent = threshold + knee * numpy.tanh(
+            (numpy.abs(loud) - threshold) / knee)
+        samples[over] = numpy.copysign(bent, loud)
+    return samples
+
+
+class PCMEffects:
+    """Gain and a soft-clip limiter for 16 bit stereo PCM, applied to a
+    batch of frames at once
+
+    The limiter needs numpy, plain gain falls back to audioop without
+    it. A player reading ahead plays its frames through regain(), a
+    cheap rescale to the volume set since they were processed. Loudness
+    normalisation isn't done here, songs are decoded at their
+    ReplayGain."""
+
+    def __init__(self, gain=1.0, *, limiter=False):
+        self.gain = gain
+        self.limiter = limiter
+
+    @property
+    def active(self):
+        return self.gain != 1.0 or self.limiter
+
+    @property
+    def level(self):
+        """The gain process() applies"""
+        return min(self.gain, 2.0)
+
+    def process(self, data, gain=None):
+        """data holds whole frames. gain is a level, the current one by
+        default"""
+        gain = self.level if gain is None else gain
+        if not (gain != 1.0 or self.limiter) or not data:
+            return data
+        if numpy is None or not self.limiter:
+            return audioop.mul(data, 2, gain)  # Cheaper than a numpy pass
+        samples = numpy.frombuffer(data, dtype="<i2").astype(numpy.float32)
+        samples *= gain / 32768
+        soft_clip(samples)
+        numpy.clip(samples, -1.0, 32767 / 32768, out=samples)
+        samples *= 32768
+        return samples.astype("<i2").tobytes()
+
+    def regain(self, data, applied, level=None):
+        """data processed at level applied, scaled to level, the current
+        one by default. Silence stays silent"""
+        level = self.level if level is None else level
+        if level == applied or not applied:
+            return data
+        return audioop.mul(data, 2, level / applied)
+
+
+class EffectsReader:
+    """Reads a decoder's PCM a batch of frames at a time, runs it through
+    effects and hands it out a frame at a time like the stream it wraps.
+    applied is the effects' level the last frame read was processed at"""
+
+    def __init__(self, stream, effects, frame_size, batch=EFFECTS_BATCH):
+        self.stream = stream
+        self.effects = effects
+        self.frame_size = frame_size
+        self.batch = batch
+        self.applied = 1.0
+        self._buffer = b""
+        self._pos = 0
+
+    def read(self, size):
+        if self._pos >= len(self._buffer):
+            data = self.stream.read(self.frame_size * self.batch)
+            # A partial frame ends playback anyway
+            data = data[:len(data) - len(data) % 4]
+            self.applied = self.effects.level
+            self._buffer = self.effects.process(data, self.applied)
+            self._pos = 0
+        chunk = self._buffer[self._pos:self._pos + size]
+        self._pos += size
+        return chunk
+
+    def close(self):
+        self.stream.close()
+
+
+class EffectsPlayer(ProcessPlayer):
+    """discord.py's ffmpeg player with its PCM going through PCMEffects.
+    volume is the effects' gain instead of audioop on every frame"""
+
+    def __init__(self, process, client, effects, *, after=None):
+        super().__init__(process, client, after)
+        self.effects = effects
+        self.buff = EffectsReader(self.buff, effects, self.frame_size)
+
+    @property
+    def volume(self):
+        return self.effects.gain
+
+    @volume.setter
+    def volume(self, value):
+        self.effects.gain = max(value, 0.0)
+
+
+class _Frames:
+    """Stands in for a decoder process that already has been read, frames
+    are (frame, level applied) like GaplessPlayer reads them"""
+
+    def __init__(self, frames):
+        self.stdout = self
+        self.applied = 1.0
+        self._frames = collections.deque(frames)
+
+    def read(self, size):
+        if not self._frames:
+            return b""
+        frame, self.applied = self._frames.popleft()
+        return frame
+
+    def kill(self):
+        self._frames.clear()
+
+    def poll(self):
+        return 0
+
+
+class _Track:
+    __slots__ = ("process", "token", "stdout")
+
+    def __init__(self, process, token, stdout=None):
+        self.process = process
+        self.token = token
+        self.stdout = stdout if stdout is not None else process.stdout
+
+    def close(self):
+        self.process.kill()
+        if self.process.poll() is None:
+            self.process.communicate()
+
+
+class GaplessPlayer(StreamPlayer):
+    """One long-lived player per server that songs are fed into
+
+    The thread and its frame clock outlive songs. The next song's decoder
+    is started ahead with queue_next(), so when the current one runs out
+    the player switches buffers without missing a frame, optionally
+    crossfading the two. on_advance(token, gap) is called from the
+    player's thread on every switch, gap being how late the first frame
+    of the new song is on the player's clock. When there's nothing left
+    to play the player idles, is_done() is True and after() is called,
+    until play() gives it a new song. stop() ends it for good.
+
+    play() drops the queued song, and so does a queue_next() for an older
+    generation: one started before the last play().
+
+    Songs go through effects in batches as they're read, volume being
+    their gain. Frames read ahead for a crossfade are rescaled as they're
+    played if the volume changed since. Each song's decoder scales it by
+    the decoder_gain it's given, in ffmpeg."""
+
+    def __init__(self, client, *, after=None, on_advance=None,
+                 crossfade=0, use_avconv=False, effects=None):
+        super().__init__(None, client.encoder, client._connected,
+                         client.play_audio, after)
+        self.on_advance = on_advance
+        self.crossfade = crossfade  # ms
+        self.use_avconv = use_avconv
+        self.effects = effects if effects is not None else PCMEffects()
+        self.current = None
+        self.next = None
+        self.generation = 0  # Bumped by play()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # (frame, effects level applied) read from current
+        self._ahead = collections.deque()
+
+    def start(self):
+        if self.ident is None:  # Already running otherwise
+            super().start()
+
+    @property
+    def volume(self):
+        return self.effects.gain
+
+    @volume.setter
+    def volume(self, value):
+        self.effects.gain = max(value, 0.0)
+
+    def _track(self, filename, token, decoder_gain):
+        process = decoder_process(filename, self.use_avconv, decoder_gain)
+        reader = EffectsReader(process.stdout, self.effects, self.frame_size)
+        return _Track(process, token, reader)
+
+    def play(self, filename, token=None, decoder_gain=1.0):
+        """Plays filename now, replacing whatever is playing"""
+        track = self._track(filename, token, decoder_gain)
+        with self._lock:
+            old, self.current = self.current, track
+            queued, self.next = self.next, None
+            self.generation += 1
+            self._ahead.clear()
+            self.loops = 0
+            self._start = time.time()
+        for stale in (old, queued):
+            if stale is not None:
+                stale.close()
+        self._wakeup.set()
+
+    def queue_next(self, filename, token=None, generation=None,
+                   decoder_gain=1.0):
+        """Starts decoding the song that follows the current one. Blocks
+        while the decoder is spawned, don't call it from the event loop.
+        Does nothing if play() was called since generation was read"""
+        track = None
+        if filename is not None:
+            track = self._track(filename, token, decoder_gain)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                old = track
+            else:
+                old, self.next = self.next, track
+        if old is not None:
+            old.close()
+
+    @property
+    def next_token(self):
+        next_track = self.next
+        return next_track.token if next_track is not None else None
+
+    def is_done(self):
+        return super().is_done() or self.current is None
+
+    def is_running(self):
+        """Whether the thread is up and can take songs with play()"""
+        return self.is_alive() and not self._end.is_set()
+
+    def stop(self):
+        super().stop()
+        self._wakeup.set()
+
+    def _read(self, track):
+        frame = track.stdout.read(self.frame_size)
+        return frame, track.stdout.applied
+
+    def _next_frame(self):
+        """The (frame, level applied) to play now, switching songs if the
+        current one ran out. None if there's nothing to play"""
+        with self._lock:
+            current = self.current
+            if current is None:
+                return None
+            lookahead = max(1, self.crossfade // 20)
+            while len(self._ahead) < lookahead:
+                frame = self._read(current)
+                if len(frame[0]) != self.frame_size:
+                    break
+                self._ahead.append(frame)
+            else:
+                return self._ahead.popleft()
+            # The current song ended, _ahead holds its last frames
+            tail = list(self._ahead)
+            self._ahead.clear()
+            current.close()
+            if self.next is None:
+                # Nothing queued, play out the tail then idle
+                if tail:
+                    self.current = _Track(_Frames(tail), current.token)
+                    return self._read(self.current)
+                self.current = None
+                return None
+            self.current, self.next = self.next, None
+            due = self._start + self.delay * (self.loops + 1)
+            if self.crossfade and tail:
+                head = [self._read(self.current) for _ in tail]
+                head = [f for f in head if len(f[0]) == self.frame_size]
+                # Mixed at one level, the songs may have been read at two
+                level = self.effects.level
+                mixed = crossfade_frames(
+                    [self.effects.regain(f, a, level) for f, a in tail],
+                    [self.effects.regain(f, a, level) for f, a in head])
+                self._ahead.extend((frame, level) for frame in mixed)
+            else:
+                self._ahead.extend(tail)
+            if not self._ahead:
+                frame = self._read(self.current)
+                if len(frame[0]) == self.frame_size:
+                    self._ahead.append(frame)
+            gap = max(0.0, time.time() - due)
+            token = self.current.token
+        if self.on_advance is not None:
+            self.on_advance(token, gap)
+        return self._ahead.popleft() if self._ahead else None
+
+    def _do_run(self):
+        self.loops = 0
+        self._start = time.time()
+        while not self._end.is_set():
+            if not self._resumed.is_set():
+                self._resumed.wait()
+
+            if not self._connected.is_set():
+                self.stop()
+                break
+
+            frame = self._next_frame()
+            if frame is None:
+                # Idle until play() or stop()
+                self._call_after()
+                # Timed so a disconnect is noticed, nothing wakes us then
+                while self.current is None and not self._end.is_set() \
+                        and self._connected.is_set():
+                    if self._wakeup.wait(1):
+                        self._wakeup.clear()
+                continue
+
+            self.loops += 1
+            # Only a rescale if the volume changed since it was read
+            self.player(self.effects.regain(*frame))
+            next_time = self._start + self.delay * self.loops
+            delay = max(0, self.delay + (next_time - time.time()))
+            time.sleep(delay)
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            for track in (self.current, self.next):
+                if track is not None:
+                    track.close()
+
+
+class OpusTrackCache:
+    """Opus encoded copies of the songs in the audio cache
+
+    Songs are encoded in the background, one at a time, the first time
+    they're played or downloaded. on_encoded is called with the song id
+    of each finished copy, a false return means the song left the cache
+    meanwhile and the copy is deleted. Only used from the event loop."""
+
+    def __init__(self, path, *, loop, on_encoded=None):
+        self.path = path
+        self.loop = loop
+        self.on_encoded = on_encoded
+        self.encoded = 0
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = set()
+
+    def filename(self, song_id):
+        return os.path.join(self.path, song_id)
+
+    def has(self, song_id):
+        return os.path.isfile(self.filename(song_id))
+
+    def size(self, song_id):
+        try:
+            return os.path.getsize(self.filename(song_id))
+        except OSError:
+            return 0
+
+    def ensure(self, source, song_id, use_avconv=False):
+        """Schedules song_id to be encoded unless it already is"""
+        if song_id in self._pending or self.has(song_id):
+            return
+        self._pending.add(song_id)
+        future = self.loop.run_in_executor(
+            self._executor, encode_opus_frames, source,
+            self.filename(song_id), use_avconv)
+        future.add_done_callback(lambda f: self._encoded(song_id, f))
+
+    def _encoded(self, song_id, future):
+        self._pending.discard(song_id)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            log.error("Opus encoding of songid {} failed".format(song_id),
+                      exc_info=future.exception())
+        elif future.result():
+            if self.on_encoded is not None and not self.on_encoded(song_id):
+                self.discard(song_id)
+                log.debug("songid {} was evicted while being encoded to "
+                          "opus".format(song_id))
+                return
+            self.encoded += 1
+            log.debug("encoded songid {} to opus".format(song_id))
+
+    def discard(self, song_id):
+        try:
+            os.remove(self.filename(song_id))
+        except OSError:
+            pass
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class SingleFlight:
+    """Runs one call per key at a time, concurrent callers of the same
+    key share its result. saved counts the calls that were shared"""
+
+    def __init__(self):
+        self.saved = 0
+        self._calls = {}  # key: future
+
+    def do(self, key, coro_func):
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(coro_func())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        else:
+            self.saved += 1
+        # One caller being cancelled doesn't cancel the call for the rest
+        return asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+
+class _DownloadJob:
+    __slots__ = ("downloader", "future", "priority", "started", "dropped")
+
+    def __init__(self, downloader, future, priority):
+        self.downloader = downloader
+        self.future = future
+        self.priority = priority
+        self.started = False
+        self.dropped = False
+
+    def wait(self):
+        return asyncio.shield(self.future)
+
+
+class DownloadScheduler:
+    """Starts song downloads for every server, max_active at a time
+
+    on_finished is called with each finished job's future. Servers take
+    turns, one job each. Songs about to play go before any
+    prefetch. Every server's jobs are kept by url, so asking again for a
+    song that's queued, downloading or prefetched returns the same job.
+    A prefetch asked for again as about to play is promoted. Only used
+    from the event loop."""
+
+    def __init__(self, make_downloader, max_active=DOWNLOAD_WORKERS, *,
+                 on_finished=None, loop):
+        self.make_downloader = make_downloader
+        self.on_finished = on_finished
+        self.max_active = max_active
+        self.active = 0
+        self.loop = loop
+        self._jobs = {}  # sid: {url: job}
+        self._urgent = collections.OrderedDict()  # sid: deque of jobs
+        self._prefetch = collections.OrderedDict()
+        self._pump_scheduled = False
+
+    def request(self, sid, url, priority=False):
+        jobs = self._jobs.setdefault(sid, {})
+        job = jobs.get(url)
+        if job is not None and job.future.done() and priority:
+            job = None  # Finished prefetch, the file may be gone since
+        if job is None:
+            job = _DownloadJob(self.make_downloader(url),
+                               self.loop.create_future(), priority)
+            jobs[url] = job
+            self._enqueue(sid, job)
+        elif priority and not job.priority:
+            job.priority = True
+            if not job.started:
+                self._enqueue(sid, job)
+        if not self._pump_scheduled:
+            # Requests made in the same loop iteration take turns too
+            self._pump_scheduled = True
+            self.loop.call_soon(self._pump)
+        return job
+
+    def retain(self, sid, urls):
+        """Forgets the server's prefetches that aren't in urls"""
+        jobs = self._jobs.get(sid, {})
+        for url in [u for u, j in jobs.items()
+                    if u not in urls and not j.priority]:
+            jobs.pop(url).dropped = True
+        if not jobs:
+            self._jobs.pop(sid, None)
+
+    def cancel(self, sid):
+        """Forgets every prefetch of the server. Downloads that are about
+        to play have someone waiting on them, so they're kept"""
+        self.retain(sid, ())
+
+    def release(self, sid, url, job):
+        """Forgets a job about to play once its waiter is done with it"""
+        jobs = self._jobs.get(sid)
+        if jobs is not None and jobs.get(url) is job:
+            del jobs[url]
+            job.dropped = True
+            if not jobs:
+                del self._jobs[sid]
+
+    def get(self, sid, url):
+        return self._jobs.get(sid, {}).get(url)
+
+    def songs(self):
+        for jobs in self._jobs.values():
+            for job in jobs.values():
+                if job.downloader.song is not None:
+                    yield job.downloader.song
+
+    def pending(self):
+        return sum(len(q) for q in self._urgent.values()) + \
+            sum(len(q) for q in self._prefetch.values())
+
+    def _enqueue(self, sid, job):
+        waiting = self._urgent if job.priority else self._prefetch
+        waiting.setdefault(sid, collections.deque()).append(job)
+
+    def _next_job(self):
+        for waiting in (self._urgent, self._prefetch):
+            while waiting:
+                sid, jobs = next(iter(waiting.items()))
+                job = jobs.popleft()
+                if jobs:
+                    waiting.move_to_end(sid)
+                else:
+                    del waiting[sid]
+                if not job.started and not job.dropped:
+                    return job
+        return None
+
+    def _pump(self):
+        self._pump_scheduled = False
+        while self.active < self.max_active:
+            job = self._next_job()
+            if job is None:
+                return
+            job.started = True
+            self.active += 1
+            job.downloader.start().add_done_callback(
+                lambda f, job=job: self._finished(job, f))
+
+    def _finished(self, job, future):
+        self.active -= 1
+        if not job.future.done():
+            if future.cancelled():
+                job.future.cancel()
+            else:
+                job.future.set_result(future.result())
+                if self.on_finished is not None:
+                    self.on_finished(job.future)
+        self._pump()
+
+
+class Downloader:
+    """Resolves a url's info, and optionally downloads it.
+
+    youtube_dl is blocking, so the work runs on the executor that's passed
+    in while the event loop keeps going. start() schedules it and wait()
+    returns an awaitable that completes when it's done."""
     def __init__(self, url, max_duration=None, download=False,
-                 cache_path="data/audio/cache", *args, **kwargs):
-        super().__init__(*args, **kwargs)
+                 cache_path="data/audio/cache", *, loop=None, executor=None,
+                 info_cache=None, single_flight=None):
         self.url = url
         self.max_duration = max_duration
-        self.done = threading.Event()
         self.song = None
         self.failed = False
+        self.hit_max_length = False
+        self.cache_path = cache_path
         self._download = download
-        self.hit_max_length = threading.Event()
         self._yt = None
-
-    def run(self):
+        self._yt_options = dict(youtube_dl_options,
+                                outtmpl=os.path.join(cache_path, "%(id)s"))
+        self._loop = loop or asyncio.get_event_loop()
+        self._executor = executor
+        self._info_cache = info_cache
+        self._single_flight = single_flight
+        self._future = None
+
+    def start(self):
+        if self._future is not None:
+            raise RuntimeError("Downloader already started")
+        self._future = asyncio.ensure_future(self._run(), loop=self._loop)
+        return self._future
+
+    def wait(self):
+        if self._future is None:
+            self.start()
+        # Several coroutines may wait on the same downloader, one of them
+        # being cancelled shouldn't cancel the download for the others
+        return asyncio.shield(self._future)
+
+    def is_alive(self):
+        return self._future is not None and not self._future.done()
+
+    async def _run(self):
         try:
-            self.get_info()
-            if self._download:
-                self.download()
+            if not self._get_cached_info():
+                requested = self.url
+                await self._loop.run_in_executor(self._executor,
+                                                 self.get_info)
+                if self._info_cache is not None and self.song is not None:
+                    self._info_cache.put(self.song.__dict__, requested,
+                                         self.url)
+            if self._download and self._single_flight is not None:
+                # Downloads of the same song id running for other servers
+                #   are joined instead of writing the file twice
+                self.duration_check()
+                await self._single_flight.do(self.song.id,
+                                             self._download_in_executor)
+            elif self._download:
+                await self._download_in_executor()
         except MaximumLength:
-            self.hit_max_length.set()
+            self.hit_max_length = True
         except:
             self.failed = True
-        self.done.set()
+        return self.song
+
+    def _download_in_executor(self):
+        return self._loop.run_in_executor(self._executor, self.download)
+
+    def _get_cached_info(self):
+        if self._info_cache is None:
+            return False
+        info = self._info_cache.get(self.url)
+        if info is None:
+            return False
+        if "[SEARCH:]" in self.url:
+            self.url = "https://youtube.com/watch?v={}".format(info["id"])
+        self.song = Song(**info)
+        return True
 
     def download(self):
         self.duration_check()
 
-        if not os.path.isfile('data/audio/cache' + self.song.id):
+        if not os.path.isfile(os.path.join(self.cache_path, self.song.id)):
+            if self._yt is None:
+                self._yt = youtube_dl.YoutubeDL(self._yt_options)
             video = self._yt.extract_info(self.url)
             self.song = Song(**video)
 
@@ -262,7 +1284,7 @@ class Downloader(threading.Thread):
 
     def get_info(self):
         if self._yt is None:
-            self._yt = youtube_dl.YoutubeDL(youtube_dl_options)
+            self._yt = youtube_dl.YoutubeDL(self._yt_options)
         if "[SEARCH:]" not in self.url:
             video = self._yt.extract_info(self.url, download=False,
                                           process=False)
@@ -275,6 +1297,10 @@ class Downloader(threading.Thread):
             video = self._yt.extract_info(self.url, download=False,
                                           process=False)
 
+        if video.get("entries") is not None:
+            # Playlist entries can be lazy, fetch them while we're off the
+            #   event loop
+            video["entries"] = list(video["entries"])
         self.song = Song(**video)
 
 
@@ -285,10 +1311,42 @@ class Audio:
         self.bot = bot
         self.queue = {}  # add deque's, repeat
         self.downloaders = {}  # sid: object
+        self.executor = ThreadPoolExecutor(max_workers=RESOLVER_WORKERS)
+        # One thread so a server's prerolls are applied in order
+        self.preroll_executor = ThreadPoolExecutor(max_workers=1)
+        # ReplayGain is measured one song at a time in the background
+        self.gain_executor = ThreadPoolExecutor(max_workers=1)
+        self._measuring = set()
+        self.download_flights = SingleFlight()
+        self.download_scheduler = DownloadScheduler(
+            self._new_song_download, on_finished=self._index_download,
+            loop=self.bot.loop)
+        self.info_cache = InfoCache(
+            dataIO.path("data/audio/info_cache.json"))
         self.settings = dataIO.load_json("data/audio/settings.json")
+        dataIO.watch("data/audio/settings.json", self._settings_changed,
+                     owner=self)
+        # Server settings moved out of settings.json, into one file each
+        self.config = bot.config.namespace("Audio", legacy=(
+            "data/audio/settings.json", "SERVERS"))
         self.server_specific_setting_keys = ["VOLUME", "VOTE_ENABLED",
                                              "VOTE_THRESHOLD", "NOPPL_DISCONNECT"]
-        self.cache_path = "data/audio/cache"
+        # Every shard has its own song cache and index, so that only one
+        #   process deletes from it
+        self.cache_path = dataIO.path("data/audio/cache")
+        os.makedirs(self.cache_path, exist_ok=True)
+        opus_path = dataIO.path("data/audio/opus")
+        os.makedirs(opus_path, exist_ok=True)
+        self.opus_cache = OpusTrackCache(opus_path, loop=self.bot.loop,
+                                         on_encoded=self._opus_encoded)
+        # Opus copies count towards MAX_CACHE as part of their song
+        index_path = dataIO.path("data/audio/cache_index.json")
+        self.cache_index = CacheIndex(self.cache_path, index_path,
+                                      on_remove=self.opus_cache.discard,
+                                      extra_size=self.opus_cache.size)
+        for name in os.listdir(opus_path):
+            if name not in self.cache_index:
+                self.opus_cache.discard(name)  # Orphaned or half written
         self.local_playlist_path = "data/audio/localtracks"
         self._old_game = False
 
@@ -296,10 +1354,20 @@ class Audio:
 
         self.connect_timers = {}
 
+        self._queue_tasks = {}  # sid: task running queue_manager
+        self._song_ended_at = {}  # sid: when its last song ended
+        self._prerolling = {}  # sid: (url, future) handing it to the player
+        self._queue_wakeups = set()
+
+        self._settings_dirty = False
+        self.settings_writes_avoided = 0
+        if self.settings.pop("SERVERS", None) is not None:
+            self._settings_dirty = True
+
         if player == "ffmpeg":
-            self.settings["AVCONV"] = False
+            self.set_setting("AVCONV", False)
         elif player == "avconv":
-            self.settings["AVCONV"] = True
+            self.set_setting("AVCONV", True)
         self.save_settings()
 
     async def _add_song_status(self, song):
@@ -314,16 +1382,29 @@ class Audio:
         if server.id not in self.queue:
             self._setup_queue(server)
         self.queue[server.id]["QUEUE"].append(url)
+        self._wake_queue(server.id)
 
     def _add_to_temp_queue(self, server, url):
         if server.id not in self.queue:
             self._setup_queue(server)
         self.queue[server.id]["TEMP_QUEUE"].append(url)
+        self._wake_queue(server.id)
 
     def _addleft_to_queue(self, server, url):
         if server.id not in self.queue:
-            self._setup_queue()
+            self._setup_queue(server)
         self.queue[server.id]["QUEUE"].appendleft(url)
+        self._wake_queue(server.id)
+
+    def _new_downloader(self, url, max_duration=None, download=False):
+        return Downloader(url, max_duration, download=download,
+                          cache_path=self.cache_path, loop=self.bot.loop,
+                          executor=self.executor, info_cache=self.info_cache,
+                          single_flight=self.download_flights)
+
+    def _new_song_download(self, url):
+        return self._new_downloader(url, self.settings["MAX_LENGTH"],
+                                    download=True)
 
     def _cache_desired_files(self):
         filelist = []
@@ -333,6 +1414,7 @@ class Audio:
                 filelist.append(song.id)
             except AttributeError:
                 pass
+        filelist.extend(song.id for song in self.download_scheduler.songs())
         shuffle(filelist)
         return filelist
 
@@ -356,15 +1438,10 @@ class Audio:
         return filelist
 
     def _cache_size(self):
-        songs = os.listdir(self.cache_path)
-        size = sum(map(lambda s: os.path.getsize(
-            os.path.join(self.cache_path, s)) / 10**6, songs))
-        return size
+        return self.cache_index.size()
 
     def _cache_too_large(self):
-        if self._cache_size() > self._cache_max():
-            return True
-        return False
+        return self._cache_size() > self._cache_max()
 
     def _clear_queue(self, server):
         if server.id not in self.queue:
@@ -405,7 +1482,28 @@ class Audio:
 
         use_avconv = self.settings["AVCONV"]
         options = '-b:a 64k -bufsize 64k'
-
+        vol = self.get_server_settings(server)['VOLUME'] / 100
+        decoder_gain = self._decoder_gain(server, None if local else filename)
+        # With FFMPEG_GAIN the volume is part of ffmpeg's filters
+        effects = PCMEffects(1.0 if self.settings["FFMPEG_GAIN"] else vol,
+                             limiter=self.settings["LIMITER"])
+        gapless = self.settings["GAPLESS"]
+        opus_filename = self.opus_cache.filename(filename)
+        use_opus = (not local and not gapless and
+                    self.settings["OPUS_CACHE"] and not effects.active and
+                    decoder_gain == 1 and self.opus_cache.has(filename))
+
+        old_player = getattr(voice_client, "audio_player", None)
+        if gapless and isinstance(old_player, GaplessPlayer) and \
+                old_player.is_running():
+            log.debug("feeding gapless player on sid {}".format(server.id))
+            old_player.crossfade = self.settings["CROSSFADE"]
+            old_player.effects.limiter = effects.limiter
+            old_player.play(song_filename, decoder_gain=decoder_gain)
+            old_player.volume = effects.gain
+            return voice_client
+        if isinstance(old_player, (OpusFramePlayer, GaplessPlayer)):
+            old_player.stop()  # No process to kill
         try:
             voice_client.audio_player.process.kill()
             log.debug("killed old player")
@@ -416,12 +1514,44 @@ class Audio:
 
         log.debug("making player on sid {}".format(server.id))
 
-        voice_client.audio_player = voice_client.create_ffmpeg_player(
-            song_filename, use_avconv=use_avconv, options=options)
+        def song_ended(player):
+            # Called from the player's thread
+            self._song_ended_at[server.id] = time.time()
+            self.bot.loop.call_soon_threadsafe(self._wake_queue, server.id)
+
+        def song_advanced(token, gap):
+            # Called from the gapless player's thread
+            self.bot.loop.call_soon_threadsafe(self._gapless_advanced,
+                                               server.id, token, gap)
+
+        if gapless:
+            log.debug("starting gapless player on sid {}".format(server.id))
+            voice_client.audio_player = GaplessPlayer(
+                voice_client, after=song_ended, on_advance=song_advanced,
+                crossfade=self.settings["CROSSFADE"], use_avconv=use_avconv,
+                effects=effects)
+            voice_client.audio_player.play(song_filename,
+                                           decoder_gain=decoder_gain)
+        elif use_opus:
+            log.debug("playing pre-encoded opus on sid {}".format(server.id))
+            voice_client.audio_player = OpusFramePlayer(
+                opus_filename, voice_client, after=song_ended)
+        elif effects.active:
+            # Batched, not the per frame volume of the stock player
+            log.debug("playing through effects on sid {}".format(server.id))
+            process = decoder_process(song_filename, use_avconv, decoder_gain)
+            voice_client.audio_player = EffectsPlayer(
+                process, voice_client, effects, after=song_ended)
+        else:
+            if decoder_gain != 1:
+                options += ' -af volume={:.2f}'.format(decoder_gain)
+            # Its volume is 1 and stays so until the volume command
+            voice_client.audio_player = voice_client.create_ffmpeg_player(
+                song_filename, use_avconv=use_avconv, options=options,
+                after=song_ended)
 
         # Set initial volume
-        vol = self.get_server_settings(server)['VOLUME'] / 100
-        voice_client.audio_player.volume = vol
+        voice_client.audio_player.volume = effects.gain
 
         return voice_client  # Just for ease of use, it's modified in-place
 
@@ -453,71 +1583,150 @@ class Audio:
         """
         Doesn't actually download, just get's info for uses like queue_list
         """
-        downloaders = []
-        for url in url_list:
-            d = Downloader(url)
-            d.start()
-            downloaders.append(d)
+        downloaders = [self._new_downloader(url) for url in url_list]
 
-        while any([d.is_alive() for d in downloaders]):
-            await asyncio.sleep(0.1)
+        if downloaders:
+            await asyncio.wait([d.wait() for d in downloaders])
 
         songs = [d.song for d in downloaders if d.song is not None]
         return songs
 
-    async def _download_next(self, server, curr_dl, next_dl):
-        """Checks to see if we need to download the next, and does.
-
-        Both curr_dl and next_dl should already be started."""
-        if curr_dl.song is None:
-            # Only happens when the downloader thread hasn't initialized fully
-            #   There's no reason to wait if we can't compare
+    def _prefetch(self, server):
+        """Schedules downloads of the next PREFETCH_DEPTH songs in the
+        server's queue and forgets the ones that were skipped or removed"""
+        depth = self.settings["PREFETCH_DEPTH"]
+        upcoming = list(itertools.islice(itertools.chain(
+            self.queue[server.id]["TEMP_QUEUE"],
+            self.queue[server.id]["QUEUE"]), depth))
+        self.download_scheduler.retain(server.id, upcoming)
+        for url in upcoming:
+            if self._valid_playable_url(url) or "[SEARCH:]" in url:
+                self.download_scheduler.request(server.id, url)
+
+    def _preroll(self, server):
+        """Hands the next song to the server's gapless player once it's
+        downloaded, so it starts the moment the current one ends"""
+        player = getattr(self.voice_client(server), "audio_player", None)
+        if not isinstance(player, GaplessPlayer) or not player.is_running():
             return
-
-        max_length = self.settings["MAX_LENGTH"]
-
-        while next_dl.is_alive():
-            await asyncio.sleep(0.5)
-
-        if curr_dl.song.id != next_dl.song.id:
-            log.debug("downloader ID's mismatch on sid {}".format(server.id) +
-                      " gonna start dl-ing the next thing on the queue"
-                      " id {}".format(next_dl.song.id))
-            try:
-                next_dl.duration_check()
-            except MaximumLength:
+        temp_queue = self.queue[server.id]["TEMP_QUEUE"]
+        queue = self.queue[server.id]["QUEUE"]
+        url = temp_queue[0] if temp_queue else queue[0] if queue else None
+        song = None
+        if url is not None:
+            job = self.download_scheduler.get(server.id, url)
+            if job is None:
+                return  # Local song, played after a normal restart
+            if not job.future.done():
+                job.future.add_done_callback(
+                    lambda f: self._wake_queue(server.id))
                 return
-            self.downloaders[server.id] = Downloader(next_dl.url, max_length,
-                                                     download=True)
-            self.downloaders[server.id].start()
+            song = job.downloader.song
+            if song is None or job.downloader.hit_max_length or \
+                    song.id not in self.cache_index:
+                url = None
+        queued = player.next_token
+        prerolling = self._prerolling.get(server.id)
+        if (queued[0] if queued else None) == url or \
+                (prerolling is not None and prerolling[0] == url):
+            return
+        if url is None:
+            filename = token = None
+        else:
+            filename = os.path.join(self.cache_path, song.id)
+            token = (url, song)
+        future = self.bot.loop.run_in_executor(
+            self.preroll_executor, player.queue_next, filename, token,
+            player.generation,
+            self._decoder_gain(server, song.id) if song else 1.0)
+        self._prerolling[server.id] = (url, future)
+        future.add_done_callback(
+            lambda f: self._preroll_done(server.id, f))
+
+    def _preroll_done(self, sid, future):
+        prerolling = self._prerolling.get(sid)
+        if prerolling is not None and prerolling[1] is future:
+            del self._prerolling[sid]
+
+    def _gapless_advanced(self, sid, token, gap):
+        """The gapless player moved on to the song _preroll gave it"""
+        if sid not in self.queue or token is None:
+            return
+        url, song = token
+        temp_queue = self.queue[sid]["TEMP_QUEUE"]
+        queue = self.queue[sid]["QUEUE"]
+        last_song = self.queue[sid]["NOW_PLAYING"]
+        if temp_queue and temp_queue[0] == url:
+            temp_queue.popleft()
+        elif queue and queue[0] == url:
+            queue.popleft()
+            if self.queue[sid]["REPEAT"] and last_song:
+                queue.append(last_song.webpage_url)
+        else:
+            log.debug("sid {} queue changed while {} was prerolled".format(
+                sid, url))
+        self.queue[sid]["NOW_PLAYING"] = song
+        self.skip_votes[sid] = []
+        self.cache_index.lookup(song.id)
+        self.bot.metrics.observe("audio_transition_gap_seconds", gap,
+                                 ("mode", "gapless"))
+        self.bot.loop.create_task(self._update_bot_status())
+        self._wake_queue(sid)  # Preroll the one after
+
+    def _index_download(self, future):
+        if not future.cancelled() and future.result() is not None:
+            self.cache_index.add(future.result().id)
+            self._encode_opus(future.result().id)
+            self._measure_gain(future.result().id)
+
+    def _encode_opus(self, song_id):
+        if self.settings["OPUS_CACHE"] and song_id in self.cache_index:
+            self.opus_cache.ensure(os.path.join(self.cache_path, song_id),
+                                   song_id, self.settings["AVCONV"])
+
+    def _measure_gain(self, song_id):
+        """Measures the song's ReplayGain in the background, once"""
+        if not self.settings["NORMALIZE"] or song_id in self._measuring or \
+                song_id not in self.cache_index or \
+                self.cache_index.gain(song_id) is not None:
+            return
+        self._measuring.add(song_id)
+        future = self.bot.loop.run_in_executor(
+            self.gain_executor, measure_track_gain,
+            os.path.join(self.cache_path, song_id), self.settings["AVCONV"])
+        future.add_done_callback(lambda f: self._gain_measured(song_id, f))
+
+    def _gain_measured(self, song_id, future):
+        self._measuring.discard(song_id)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            log.error("Measuring the ReplayGain of songid {} failed".format(
+                song_id), exc_info=future.exception())
+            gain = None
+        else:
+            gain = future.result()
+        if gain is None:
+            log.debug("no ReplayGain for songid {}, it plays as it "
+                      "is".format(song_id))
+            gain = 1.0  # Not tried again every time it's played
+        self.cache_index.set_gain(song_id, gain)
+
+    def _opus_encoded(self, song_id):
+        # Indexed again so the song's size includes its Opus copy
+        return song_id in self.cache_index and self.cache_index.add(song_id)
 
     def _dump_cache(self, ignore_desired=False):
-        reqd = self._cache_required_files()
+        """Evicts the least popular songs until the cache fits its max
+        size. Now playing songs are kept, and so are the ones being
+        downloaded unless ignore_desired"""
+        reqd = set(self._cache_required_files())
         log.debug("required cache files:\n\t{}".format(reqd))
 
-        opt = self._cache_desired_files()
+        opt = () if ignore_desired else set(self._cache_desired_files())
         log.debug("desired cache files:\n\t{}".format(opt))
 
-        prev_size = self._cache_size()
-
-        for file in os.listdir(self.cache_path):
-            if file not in reqd:
-                if ignore_desired or file not in opt:
-                    try:
-                        os.remove(os.path.join(self.cache_path, file))
-                    except OSError:
-                        # A directory got in the cache?
-                        pass
-                    except WindowsError:
-                        # Removing a file in use, reqd failed
-                        pass
-
-        post_size = self._cache_size()
-        dumped = prev_size - post_size
-
-        if not ignore_desired and self._cache_too_large():
-            log.debug("must dump desired files")
-            return dumped + self._dump_cache(ignore_desired=True)
+        dumped = self.cache_index.evict(self._cache_max(), reqd, opt)
 
         log.debug("dumped {} MB of audio files".format(dumped))
 
@@ -525,6 +1734,19 @@ class Audio:
 
     # TODO: _enable_controls()
 
+    def _decoder_gain(self, server, song_id=None):
+        """What ffmpeg scales a song by: its ReplayGain when normalising,
+        times the volume with FFMPEG_GAIN. song_id is None for local
+        songs, which aren't measured"""
+        gain = 1.0
+        if self.settings["FFMPEG_GAIN"]:
+            gain = self.get_server_settings(server)['VOLUME'] / 100
+        if self.settings["NORMALIZE"] and song_id is not None:
+            track_gain = self.cache_index.gain(song_id)
+            if track_gain is not None:
+                gain *= track_gain
+        return gain
+
     # returns list of active voice channels
     # assuming list does not change during the execution of this function
     # if that happens, blame asyncio.
@@ -583,24 +1805,17 @@ class Audio:
         if server.id not in self.downloaders:  # We don't have a downloader
             log.debug("sid {} not in downloaders, making one".format(
                 server.id))
-            self.downloaders[server.id] = Downloader(url, max_length)
+            self.downloaders[server.id] = self._new_downloader(url, max_length)
 
         if self.downloaders[server.id].url != url:  # Our downloader is old
             # I'm praying to Jeezus that we don't accidentally lose a running
             #   Downloader
             log.debug("sid {} in downloaders but wrong url".format(server.id))
-            self.downloaders[server.id] = Downloader(url, max_length)
+            self.downloaders[server.id] = self._new_downloader(url, max_length)
 
-        try:
-            # We're assuming we have the right thing in our downloader object
-            self.downloaders[server.id].start()
-            log.debug("starting our downloader for sid {}".format(server.id))
-        except RuntimeError:
-            # Queue manager already started it for us, isn't that nice?
-            pass
-
-        # Getting info w/o download
-        self.downloaders[server.id].done.wait()
+        # Getting info w/o download. Starts the downloader unless the queue
+        #   manager already started it for us
+        await self.downloaders[server.id].wait()
 
         # This will throw a maxlength exception if required
         self.downloaders[server.id].duration_check()
@@ -609,17 +1824,22 @@ class Audio:
         log.debug("sid {} wants to play songid {}".format(server.id, song.id))
 
         # Now we check to see if we have a cache hit
-        cache_location = os.path.join(self.cache_path, song.id)
-        if not os.path.exists(cache_location):
+        if not self.cache_index.lookup(song.id):
             log.debug("cache miss on song id {}".format(song.id))
-            self.downloaders[server.id] = Downloader(url, max_length,
-                                                     download=True)
-            self.downloaders[server.id].start()
-
-            while self.downloaders[server.id].is_alive():
-                await asyncio.sleep(0.5)
-
-            song = self.downloaders[server.id].song
+            # Joins a prefetch of this song if there's one, and goes ahead
+            #   of every prefetch otherwise
+            job = self.download_scheduler.request(server.id, url,
+                                                  priority=True)
+            self.downloaders[server.id] = job.downloader
+            try:
+                await job.wait()
+            finally:
+                # The song is protected by self.downloaders from now on
+                self.download_scheduler.release(server.id, url, job)
+
+            song = job.downloader.song
+            if song is not None and song.id in self.cache_index:
+                self.cache_index.touch(song.id)
         else:
             log.debug("cache hit on song id {}".format(song.id))
 
@@ -758,11 +1978,8 @@ class Audio:
 
     async def _parse_sc_playlist(self, url):
         playlist = []
-        d = Downloader(url)
-        d.start()
-
-        while d.is_alive():
-            await asyncio.sleep(0.5)
+        d = self._new_downloader(url)
+        await d.wait()
 
         for entry in d.song.entries:
             if entry["url"][4] != "s":
@@ -774,13 +1991,10 @@ class Audio:
         return playlist
 
     async def _parse_yt_playlist(self, url):
-        d = Downloader(url)
-        d.start()
+        d = self._new_downloader(url)
+        await d.wait()
         playlist = []
 
-        while d.is_alive():
-            await asyncio.sleep(0.5)
-
         for entry in d.song.entries:
             try:
                 song_url = "https://www.youtube.com/watch?v={}".format(
@@ -827,6 +2041,15 @@ class Audio:
 
         voice_client.audio_player.start()
         log.debug("starting player on sid {}".format(server.id))
+        ended = self._song_ended_at.pop(server.id, None)
+        if ended is not None and time.time() - ended < 10:
+            # Longer than that the queue was empty, it's no transition
+            self.bot.metrics.observe("audio_transition_gap_seconds",
+                                     time.time() - ended, ("mode", "restart"))
+        if not local:
+            # For the next time it's played
+            self._encode_opus(song.id)
+            self._measure_gain(song.id)
 
         return song
 
@@ -941,6 +2164,7 @@ class Audio:
         else:
             self._setup_queue(server)
         self.queue[server.id]["QUEUE"].extend(songlist)
+        self._wake_queue(server.id)
 
     def _set_queue_channel(self, server, channel):
         if server.id not in self.queue:
@@ -988,6 +2212,7 @@ class Audio:
         await self._disconnect_voice_client(server)
 
     def _stop_downloader(self, server):
+        self.download_scheduler.cancel(server.id)
         if server.id not in self.downloaders:
             return
 
@@ -1053,7 +2278,7 @@ class Audio:
                                    self._cache_min()))
             return
 
-        self.settings["MAX_CACHE"] = size
+        self.set_setting("MAX_CACHE", size)
         await self.bot.say("Max cache size set to {} MB.".format(size))
         self.save_settings()
 
@@ -1075,6 +2300,76 @@ class Audio:
                                " if the voice channel is empty.")
         self.save_settings()
 
+    @audioset.command(name="gapless")
+    @checks.is_owner()
+    async def audioset_gapless(self):
+        """Toggles gapless playback
+
+        Each server keeps one player, the next song is decoded before the
+        current one ends. Replaces the Opus cache while it's on."""
+        self.set_setting("GAPLESS", not self.settings["GAPLESS"])
+        if self.settings["GAPLESS"]:
+            await self.bot.say("Gapless playback enabled.")
+        else:
+            await self.bot.say("Gapless playback disabled.")
+        self.save_settings()
+
+    @audioset.command(name="crossfade")
+    @checks.is_owner()
+    async def audioset_crossfade(self, ms: int):
+        """Crossfade between songs in gapless mode (milliseconds)"""
+        if not 0 <= ms <= 10000:
+            await self.bot.say("Crossfade must be between 0 and 10000 ms.")
+            return
+        self.set_setting("CROSSFADE", ms)
+        await self.bot.say("Crossfade set to {} ms.".format(ms))
+        self.save_settings()
+
+    @audioset.command(name="normalize")
+    @checks.is_owner()
+    async def audioset_normalize(self):
+        """Toggles evening out the loudness of songs
+
+        Songs play at their ReplayGain, which ffmpeg measures in the
+        background after they're downloaded. Until then they play as
+        they are."""
+        self.set_setting("NORMALIZE", not self.settings["NORMALIZE"])
+        if self.settings["NORMALIZE"]:
+            await self.bot.say("Loudness normalisation enabled.")
+        else:
+            await self.bot.say("Loudness normalisation disabled.")
+        self.save_settings()
+
+    @audioset.command(name="limiter")
+    @checks.is_owner()
+    async def audioset_limiter(self):
+        """Toggles softening peaks instead of clipping them
+
+        Mostly useful with volumes above 100."""
+        if numpy is None and not self.settings["LIMITER"]:
+            await self.bot.say("You need to run `pip3 install numpy`")
+            return
+        self.set_setting("LIMITER", not self.settings["LIMITER"])
+        if self.settings["LIMITER"]:
+            await self.bot.say("Limiter enabled.")
+        else:
+            await self.bot.say("Limiter disabled.")
+        self.save_settings()
+
+    @audioset.command(name="ffmpeggain")
+    @checks.is_owner()
+    async def audioset_ffmpeggain(self):
+        """Toggles letting ffmpeg apply the volume
+
+        Saves scaling every frame in Python, volume changes apply from the
+        next song."""
+        self.set_setting("FFMPEG_GAIN", not self.settings["FFMPEG_GAIN"])
+        if self.settings["FFMPEG_GAIN"]:
+            await self.bot.say("Volume is now applied by ffmpeg.")
+        else:
+            await self.bot.say("Volume is now applied by the player.")
+        self.save_settings()
+
     @audioset.command(name="maxlength")
     @checks.is_owner()
     async def audioset_maxlength(self, length: int):
@@ -1083,15 +2378,41 @@ class Audio:
             await self.bot.say("Wow, a non-positive length value...aren't"
                                " you smart.")
             return
-        self.settings["MAX_LENGTH"] = length
+        self.set_setting("MAX_LENGTH", length)
         await self.bot.say("Maximum length is now {} seconds.".format(length))
         self.save_settings()
 
+    @audioset.command(name="prefetch")
+    @checks.is_owner()
+    async def audioset_prefetch(self, songs: int):
+        """Upcoming songs downloaded ahead in each queue"""
+        if songs < 0:
+            await self.bot.say("Can't be less than zero.")
+            return
+        self.set_setting("PREFETCH_DEPTH", songs)
+        await self.bot.say("The next {} songs of each queue will be "
+                           "downloaded ahead.".format(songs))
+        self.save_settings()
+
+    @audioset.command(name="opus")
+    @checks.is_owner()
+    async def audioset_opus(self):
+        """Toggles playing songs from pre-encoded Opus copies
+
+        Each cached song is encoded once in the background. Songs played
+        at 100% volume then need no ffmpeg or encoder."""
+        self.set_setting("OPUS_CACHE", not self.settings["OPUS_CACHE"])
+        if self.settings["OPUS_CACHE"]:
+            await self.bot.say("Songs will be pre-encoded to Opus.")
+        else:
+            await self.bot.say("Songs will be played through ffmpeg.")
+        self.save_settings()
+
     @audioset.command(name="player")
     @checks.is_owner()
     async def audioset_player(self):
         """Toggles between Ffmpeg and Avconv"""
-        self.settings["AVCONV"] = not self.settings["AVCONV"]
+        self.set_setting("AVCONV", not self.settings["AVCONV"])
         if self.settings["AVCONV"]:
             await self.bot.say("Player toggled. You're now using avconv.")
         else:
@@ -1102,7 +2423,7 @@ class Audio:
     @checks.is_owner()  # cause effect is cross-server
     async def audioset_status(self):
         """Enables/disables songs' titles as status"""
-        self.settings["TITLE_STATUS"] = not self.settings["TITLE_STATUS"]
+        self.set_setting("TITLE_STATUS", not self.settings["TITLE_STATUS"])
         if self.settings["TITLE_STATUS"]:
             await self.bot.say("If only one server is playing music, songs'"
                                " titles will now show up as status")
@@ -1132,8 +2453,14 @@ class Audio:
 
             # Set volume of playing audio
             vc = self.voice_client(server)
-            if vc:
+            if vc and self.settings["FFMPEG_GAIN"]:
+                msg += ("\nVolume is applied by ffmpeg, the new volume "
+                        "applies from the next song.")
+            elif vc:
                 vc.audio_player.volume = percent / 100
+                if isinstance(vc.audio_player, OpusFramePlayer):
+                    msg += ("\nThe current song is pre-encoded, the new "
+                            "volume applies from the next one.")
 
             self.save_settings()
         else:
@@ -1179,6 +2506,21 @@ class Audio:
         await self.bot.say("Currently playing music in {} servers.".format(
             count))
 
+    @audiostat.command(name="downloads")
+    @checks.is_owner()
+    async def audiostat_downloads(self):
+        """Song downloads saved by joining one already running."""
+        await self.bot.say("{} downloads were shared with another server "
+                           "downloading the same song.".format(
+                               self.download_flights.saved))
+
+    @audiostat.command(name="writes")
+    @checks.is_owner()
+    async def audiostat_writes(self):
+        """Settings writes avoided since the cog was loaded."""
+        await self.bot.say("Avoided {} writes of the audio settings.".format(
+            self.settings_writes_avoided))
+
     @commands.group(pass_context=True)
     async def cache(self, ctx):
         """Cache management tools."""
@@ -1190,7 +2532,8 @@ class Audio:
     @checks.is_owner()
     async def cache_dump(self):
         """Dumps the cache."""
-        dumped = self._dump_cache()
+        dumped = self.cache_index.clear(set(self._cache_required_files()),
+                                        set(self._cache_desired_files()))
         await self.bot.say("Dumped {:.3f} MB of audio files.".format(dumped))
 
     @cache.command(name="minimum")
@@ -1205,6 +2548,15 @@ class Audio:
         await self.bot.say("Cache is currently at {:.3f} MB.".format(
             self._cache_size()))
 
+    @cache.command(name="stats")
+    async def cache_stats(self):
+        """Songs cached and how often plays were served from the cache."""
+        index = self.cache_index
+        await self.bot.say("{} songs, {:.3f} MB. {} of {} plays served from "
+                           "the cache ({:.1%}).".format(
+                               len(index), index.size(), index.hits,
+                               index.hits + index.misses, index.hit_ratio()))
+
     @commands.group(pass_context=True, hidden=True, no_pm=True)
     @checks.is_owner()
     async def disconnect(self, ctx):
@@ -1976,14 +3328,14 @@ class Audio:
             await asyncio.sleep(5)
 
     def get_server_settings(self, server):
+        """Returns a copy of the server's settings with the defaults filled
+        in. Defaults are only resolved here, they're never saved"""
         try:
             sid = server.id
         except:
             sid = server
 
-        if sid not in self.settings["SERVERS"]:
-            self.settings["SERVERS"][sid] = {}
-        ret = self.settings["SERVERS"][sid]
+        ret = dict(self.config.guild(sid))
 
         # Not the cleanest way. Some refactoring is suggested if more settings
         # have to be added
@@ -1998,7 +3350,9 @@ class Audio:
                     ret[setting] *= 100
         # ^This will make it so that only users with an outdated config will
         # have their volume set * 100. In theory.
-        self.save_settings()
+
+        # This used to write settings.json on every call
+        self.settings_writes_avoided += 1
 
         return ret
 
@@ -2028,7 +3382,6 @@ class Audio:
         """This function assumes that there's something in the queue for us to
             play"""
         server = self.bot.get_server(sid)
-        max_length = self.settings["MAX_LENGTH"]
 
         # This is a reference, or should be at least
         temp_queue = self.queue[server.id]["TEMP_QUEUE"]
@@ -2068,39 +3421,49 @@ class Audio:
             log.debug("set now_playing for sid {}".format(server.id))
             self.bot.loop.create_task(self._update_bot_status())
 
-        elif server.id in self.downloaders:
-            # We're playing but we might be able to download a new song
-            curr_dl = self.downloaders.get(server.id)
-            if len(temp_queue) > 0:
-                next_dl = Downloader(temp_queue.peekleft(),
-                                     max_length)
-            elif len(queue) > 0:
-                next_dl = Downloader(queue.peekleft(), max_length)
-            else:
-                next_dl = None
+        else:
+            # We're playing, get the next songs ready
+            self._prefetch(server)
+            if self.settings["GAPLESS"]:
+                self._preroll(server)
 
-            if next_dl is not None:
-                # Download next song
-                next_dl.start()
-                await self._download_next(server, curr_dl, next_dl)
+    def _wake_queue(self, sid):
+        """Asks for the server's queue to be looked at.
 
-    async def queue_scheduler(self):
-        while self == self.bot.get_cog('Audio'):
-            tasks = []
-            queue = copy.deepcopy(self.queue)
-            for sid in queue:
-                if len(queue[sid]["QUEUE"]) == 0 and \
-                        len(queue[sid]["TEMP_QUEUE"]) == 0:
-                    continue
-                # log.debug("scheduler found a non-empty queue"
-                #           " for sid: {}".format(sid))
-                tasks.append(
-                    self.bot.loop.create_task(self.queue_manager(sid)))
-            completed = [t.done() for t in tasks]
-            while not all(completed):
-                completed = [t.done() for t in tasks]
-                await asyncio.sleep(0.5)
-            await asyncio.sleep(1)
+        Called when a song is queued or ends. Servers with nothing going
+        on have no task running at all."""
+        if self != self.bot.get_cog('Audio'):
+            return
+        self._queue_wakeups.add(sid)
+        task = self._queue_tasks.get(sid)
+        if task is None or task.done():
+            self._queue_tasks[sid] = self.bot.loop.create_task(
+                self._queue_runner(sid))
+
+    def _queue_has_songs(self, sid):
+        if sid not in self.queue:
+            return False
+        return len(self.queue[sid]["QUEUE"]) > 0 or \
+            len(self.queue[sid]["TEMP_QUEUE"]) > 0
+
+    async def _queue_runner(self, sid):
+        """Runs queue_manager until the server's wakeups are handled"""
+        while sid in self._queue_wakeups:
+            self._queue_wakeups.discard(sid)
+            server = self.bot.get_server(sid)
+            if server is None or not self._queue_has_songs(sid):
+                continue
+            was_playing = self.is_playing(server)
+            try:
+                await self.queue_manager(sid)
+            except Exception:
+                log.exception("queue manager failed on sid {}".format(sid))
+                self.bot.loop.call_later(1, self._wake_queue, sid)
+                return
+            if not was_playing or not self.is_playing(server):
+                # Either a song just started and the next one can be
+                #   fetched, or it was skipped and we try the next one
+                self._queue_wakeups.add(sid)
 
     async def reload_monitor(self):
         while self == self.bot.get_cog('Audio'):
@@ -2112,13 +3475,33 @@ class Audio:
             except:
                 pass
 
+        self.executor.shutdown(wait=False)
+        self.preroll_executor.shutdown(wait=False)
+        self.gain_executor.shutdown(wait=False)
+        self.opus_cache.shutdown()
+        dataIO.unwatch(self)
+
     def save_settings(self):
-        dataIO.save_json('data/audio/settings.json', self.settings)
+        """Writes the settings if a setter changed them"""
+        if not self._settings_dirty:
+            self.settings_writes_avoided += 1
+            return
+        self._settings_dirty = False
+        dataIO.mark_dirty('data/audio/settings.json', self.settings)
+
+    def _settings_changed(self):
+        # Another shard changed a setting
+        self.settings = dataIO.load_json("data/audio/settings.json")
+        self.settings.pop("SERVERS", None)
+
+    def set_setting(self, key, value):
+        if self.settings.get(key) != value:
+            self.settings[key] = value
+            self._settings_dirty = True
 
     def set_server_setting(self, server, key, value):
-        if server.id not in self.settings["SERVERS"]:
-            self.settings["SERVERS"][server.id] = {}
-        self.settings["SERVERS"][server.id][key] = value
+        if self.config.get(server.id, key) != value:
+            self.config.set(server.id, key, value)
 
     def voice_client(self, server):
         return self.bot.voice_client_in(server)
@@ -2163,7 +3546,7 @@ class Audio:
 
 def check_folders():
     folders = ("data/audio", "data/audio/cache", "data/audio/playlists",
-               "data/audio/localtracks", "data/audio/sfx")
+               "data/audio/localtracks", "data/audio/sfx", "data/audio/opus")
     for folder in folders:
         if not os.path.exists(folder):
             print("Creating " + folder + " folder...")
@@ -2174,7 +3557,9 @@ def check_files():
     default = {"VOLUME": 50, "MAX_LENGTH": 3700, "VOTE_ENABLED": True,
                "MAX_CACHE": 0, "SOUNDCLOUD_CLIENT_ID": None,
                "TITLE_STATUS": True, "AVCONV": False, "VOTE_THRESHOLD": 50,
-               "SERVERS": {}}
+               "PREFETCH_DEPTH": 2, "OPUS_CACHE": False, "GAPLESS": False,
+               "CROSSFADE": 0, "NORMALIZE": False, "LIMITER": False,
+               "FFMPEG_GAIN": False}
     settings_path = "data/audio/settings.json"
 
     if not os.path.isfile(settings_path):
@@ -2241,7 +3626,6 @@ def setup(bot):
     n = Audio(bot, player=player)  # Praise 26
     bot.add_cog(n)
     bot.add_listener(n.voice_state_update, 'on_voice_state_update')
-    bot.loop.create_task(n.queue_scheduler())
     bot.loop.create_task(n.disconnect_timer())
     bot.loop.create_task(n.reload_monitor())
     bot.loop.create_task(n.cache_scheduler())
@@ -1,18 +1,28 @@
 from discord.ext import commands
-from .utils.dataIO import dataIO
 from .utils import checks
-from __main__ import user_allowed
-import os
 import re
 
 
 class CustomCommands:
     """Custom commands."""
 
+    legacy_file = "data/customcom/commands.json"
+
     def __init__(self, bot):
         self.bot = bot
-        self.file_path = "data/customcom/commands.json"
-        self.c_commands = dataIO.load_json(self.file_path)
+        # Each guild's data is its {command: text} mapping
+        self.c_commands = bot.config.namespace("CustomCommands",
+                                               legacy=self.legacy_file)
+        self.c_commands.subscribe(self.commands_changed)
+        bot.dispatcher.register("customcom", self.c_commands.guild,
+                                self.checkCC)
+
+    def __unload(self):
+        self.c_commands.unsubscribe(self.commands_changed)
+        self.bot.dispatcher.unregister("customcom")
+
+    def commands_changed(self, sid, command, text):
+        self.bot.dispatcher.invalidate(sid)
 
     @commands.command(pass_context=True, no_pm=True)
     @checks.mod_or_permissions(administrator=True)
@@ -27,13 +37,9 @@ class CustomCommands:
         if command in self.bot.commands.keys():
             await self.bot.say("That command is already a standard command.")
             return
-        if not server.id in self.c_commands:
-            self.c_commands[server.id] = {}
-        cmdlist = self.c_commands[server.id]
+        cmdlist = self.c_commands.guild(server.id)
         if command not in cmdlist:
-            cmdlist[command] = text
-            self.c_commands[server.id] = cmdlist
-            dataIO.save_json(self.file_path, self.c_commands)
+            self.c_commands.set(server.id, command, text)
             await self.bot.say("Custom command successfully added.")
         else:
             await self.bot.say("This command already exists. Use editcom to edit it.")
@@ -48,12 +54,10 @@ class CustomCommands:
         """
         server = ctx.message.server
         command = command.lower()
-        if server.id in self.c_commands:
-            cmdlist = self.c_commands[server.id]
+        cmdlist = self.c_commands.guild(server.id)
+        if cmdlist:
             if command in cmdlist:
-                cmdlist[command] = text
-                self.c_commands[server.id] = cmdlist
-                dataIO.save_json(self.file_path, self.c_commands)
+                self.c_commands.set(server.id, command, text)
                 await self.bot.say("Custom command successfully edited.")
             else:
                 await self.bot.say("That command doesn't exist. Use addcom [command] [text]")
@@ -69,12 +73,10 @@ class CustomCommands:
         !delcom yourcommand"""
         server = ctx.message.server
         command = command.lower()
-        if server.id in self.c_commands:
-            cmdlist = self.c_commands[server.id]
+        cmdlist = self.c_commands.guild(server.id)
+        if cmdlist:
             if command in cmdlist:
-                cmdlist.pop(command, None)
-                self.c_commands[server.id] = cmdlist
-                dataIO.save_json(self.file_path, self.c_commands)
+                self.c_commands.delete(server.id, command)
                 await self.bot.say("Custom command successfully deleted.")
             else:
                 await self.bot.say("That command doesn't exist.")
@@ -85,53 +87,28 @@ class CustomCommands:
     async def customcommands(self, ctx):
         """Shows custom commands list"""
         server = ctx.message.server
-        if server.id in self.c_commands:
-            cmdlist = self.c_commands[server.id]
-            if cmdlist:
-                i = 0
-                msg = ["```Custom commands:\n"]
-                for cmd in sorted([cmd for cmd in cmdlist.keys()]):
-                    if len(msg[i]) + len(ctx.prefix) + len(cmd) + 5 > 2000:
-                        msg[i] += "```"
-                        i += 1
-                        msg.append("``` {}{}\n".format(ctx.prefix, cmd))
-                    else:
-                        msg[i] += " {}{}\n".format(ctx.prefix, cmd)
-                msg[i] += "```"
-                for cmds in msg:
-                    await self.bot.whisper(cmds)
-            else:
-                await self.bot.say("There are no custom commands in this server. Use addcom [command] [text]")
+        cmdlist = self.c_commands.guild(server.id)
+        if cmdlist:
+            i = 0
+            msg = ["```Custom commands:\n"]
+            for cmd in sorted([cmd for cmd in cmdlist.keys()]):
+                if len(msg[i]) + len(ctx.prefix) + len(cmd) + 5 > 2000:
+                    msg[i] += "```"
+                    i += 1
+                    msg.append("``` {}{}\n".format(ctx.prefix, cmd))
+                else:
+                    msg[i] += " {}{}\n".format(ctx.prefix, cmd)
+            msg[i] += "```"
+            for cmds in msg:
+                await self.bot.whisper(cmds)
         else:
             await self.bot.say("There are no custom commands in this server. Use addcom [command] [text]")
 
-    async def checkCC(self, message):
-        if len(message.content) < 2 or message.channel.is_private:
-            return
-
-        server = message.server
-        prefix = self.get_prefix(message)
-
-        if not prefix:
-            return
-
-        if server.id in self.c_commands and user_allowed(message):
-            cmdlist = self.c_commands[server.id]
-            cmd = message.content[len(prefix):]
-            if cmd in cmdlist.keys():
-                cmd = cmdlist[cmd]
-                cmd = self.format_cc(cmd, message)
-                await self.bot.send_message(message.channel, cmd)
-            elif cmd.lower() in cmdlist.keys():
-                cmd = cmdlist[cmd.lower()]
-                cmd = self.format_cc(cmd, message)
-                await self.bot.send_message(message.channel, cmd)
-
-    def get_prefix(self, message):
-        for p in self.bot.settings.get_prefixes(message.server):
-            if message.content.startswith(p):
-                return p
-        return False
+    async def checkCC(self, message, route):
+        """Called by the bot's dispatcher when a message names a custom
+        command on its server"""
+        cmd = self.format_cc(route.custom, message)
+        await self.bot.send_message(message.channel, cmd)
 
     def format_cc(self, command, message):
         results = re.findall("\{([^}]+)\}", command)
@@ -165,20 +142,5 @@ class CustomCommands:
         return str(getattr(first, second, raw_result))
 
 
-def check_folders():
-    if not os.path.exists("data/customcom"):
-        print("Creating data/customcom folder...")
-        os.makedirs("data/customcom")
-
-def check_files():
-    f = "data/customcom/commands.json"
-    if not dataIO.is_valid_json(f):
-        print("Creating empty commands.json...")
-        dataIO.save_json(f, {})
-
 def setup(bot):
-    check_folders()
-    check_files()
-    n = CustomCommands(bot)
-    bot.add_listener(n.checkCC, "on_message")
-    bot.add_cog(n)
+    bot.add_cog(CustomCommands(bot))
@@ -162,8 +162,8 @@ class Downloader:
         for row in retlist:
             msg += "\t" + "".join(word.ljust(col_width) for word in row) + "\n"
         msg += "\nRepositories list: {}".format(REPOS_LIST)
-        for page in pagify(msg, delims=['\n'], shorten_by=8):
-            await self.bot.say(box(page))
+        for page in pagify(msg, delims=['\n'], box_lang=""):
+            await self.bot.say(page)
 
     @cog.command()
     async def info(self, repo_name: str, cog: str=None):
@@ -303,12 +303,11 @@ class Downloader:
             return
 
         patchnote_lang = 'Prolog'
-        shorten_by = 8 + len(patchnote_lang)
         for note in self.patch_notes_handler(installed_updated_cogs):
             if note is None:
                 continue
-            for page in pagify(note, delims=['\n'], shorten_by=shorten_by):
-                await self.bot.say(box(page, patchnote_lang))
+            for page in pagify(note, delims=['\n'], box_lang=patchnote_lang):
+                await self.bot.say(page)
 
         await self.bot.say("Cogs updated. Reload updated cogs? (yes/no)")
         answer = await self.bot.wait_for_message(timeout=15,
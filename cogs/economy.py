@@ -3,15 +3,17 @@ from discord.ext import commands
 from cogs.utils.dataIO import dataIO
 from collections import namedtuple, defaultdict, deque
 from datetime import datetime
-from copy import deepcopy
 from .utils import checks
-from cogs.utils.chat_formatting import pagify, box
+from cogs.utils.chat_formatting import pagify
 from enum import Enum
 from __main__ import send_cmd_help
 import os
 import time
 import logging
 import random
+import sqlite3
+
+log = logging.getLogger("chronoxia.economy")
 
 default_settings = {"PAYDAY_TIME": 300, "PAYDAY_CREDITS": 120,
                     "SLOT_MIN": 5, "SLOT_MAX": 100, "SLOT_TIME": 0,
@@ -54,6 +56,10 @@ class SameSenderAndReceiver(BankError):
     pass
 
 
+class BalanceTooHigh(BankError):
+    pass
+
+
 NUM_ENC = "\N{COMBINING ENCLOSING KEYCAP}"
 
 
@@ -110,28 +116,104 @@ SLOT_PAYOUTS_MSG = ("Slot machine payouts:\n"
                     "Two symbols: Bet * 2".format(**SMReel.__dict__))
 
 
+Account = namedtuple("Account", "id name balance created_at server member")
+
+# The largest value a SQLite INTEGER column holds
+MAX_BALANCE = 2 ** 63 - 1
+
+
 class Bank:
+    """Accounts ledger backed by SQLite
+
+    Every balance change is a single row update. bank.json is imported
+    the first time the database is created and left untouched afterwards"""
 
     def __init__(self, bot, file_path):
-        self.accounts = dataIO.load_json(file_path)
         self.bot = bot
+        self.file_path = file_path
+        self.db_path = os.path.splitext(file_path)[0] + ".db"
+        # Shards share the database, give them time to take turns
+        self._conn = sqlite3.connect(self.db_path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+        if not self._is_imported():
+            self._import_json(file_path)
+
+    def _create_tables(self):
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS accounts ("
+                               "server_id TEXT NOT NULL, "
+                               "user_id TEXT NOT NULL, "
+                               "name TEXT, "
+                               "balance INTEGER NOT NULL, "
+                               "created_at TEXT NOT NULL, "
+                               "PRIMARY KEY (server_id, user_id))")
+            # Kept up to date by SQLite on every balance change, so the
+            # leaderboards never have to sort the whole table
+            self._conn.execute("CREATE INDEX IF NOT EXISTS "
+                               "accounts_server_balance ON accounts "
+                               "(server_id, balance DESC)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS "
+                               "accounts_balance ON accounts (balance DESC)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS legacy_accounts ("
+                               "user_id TEXT PRIMARY KEY, "
+                               "balance INTEGER NOT NULL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta ("
+                               "key TEXT PRIMARY KEY, value TEXT)")
+
+    def _is_imported(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = "
+                                 "'json_imported'").fetchone()
+        return row is not None
+
+    def _import_json(self, file_path):
+        try:
+            data = dataIO.load_json(file_path)
+        except (FileNotFoundError, ValueError):
+            data = {}
+        rows = []
+        legacy = []
+        for key, value in data.items():
+            if "balance" in value:  # Old format, one account per user
+                legacy.append((key, value["balance"]))
+                continue
+            for user_id, acc in value.items():
+                rows.append((key, user_id, acc.get("name"), acc["balance"],
+                             acc["created_at"]))
+        with self._conn:
+            # On a sharded first start every shard gets here, only the
+            #   first one to take the write lock imports
+            self._conn.execute("BEGIN IMMEDIATE")
+            if self._is_imported():
+                return
+            self._conn.executemany("INSERT OR REPLACE INTO accounts VALUES "
+                                   "(?, ?, ?, ?, ?)", rows)
+            self._conn.executemany("INSERT OR REPLACE INTO legacy_accounts "
+                                   "VALUES (?, ?)", legacy)
+            self._conn.execute("INSERT OR IGNORE INTO meta VALUES "
+                               "('json_imported', ?)",
+                               (datetime.utcnow().isoformat(),))
+        if rows or legacy:
+            log.info("Imported {} bank accounts from {}".format(
+                len(rows) + len(legacy), file_path))
 
     def create_account(self, user, *, initial_balance=0):
         server = user.server
         if not self.account_exists(user):
-            if server.id not in self.accounts:
-                self.accounts[server.id] = {}
-            if user.id in self.accounts:  # Legacy account
-                balance = self.accounts[user.id]["balance"]
+            row = self._conn.execute("SELECT balance FROM legacy_accounts "
+                                     "WHERE user_id = ?",
+                                     (user.id,)).fetchone()
+            if row is not None:  # Legacy account
+                balance = row[0]
             else:
                 balance = initial_balance
             timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            account = {"name": user.name,
-                       "balance": balance,
-                       "created_at": timestamp
-                       }
-            self.accounts[server.id][user.id] = account
-            self._save_bank()
+            with self._conn:
+                self._conn.execute("INSERT INTO accounts VALUES "
+                                   "(?, ?, ?, ?, ?)",
+                                   (server.id, user.id, user.name, balance,
+                                    timestamp))
             return self.get_account(user)
         else:
             raise AccountAlreadyExists()
@@ -143,49 +225,40 @@ class Bank:
             return False
         return True
 
-    def withdraw_credits(self, user, amount):
-        server = user.server
-
+    def _check_amount(self, amount):
         if amount < 0:
             raise NegativeValue()
+        if amount > MAX_BALANCE:
+            raise BalanceTooHigh()
 
-        account = self._get_account(user)
-        if account["balance"] >= amount:
-            account["balance"] -= amount
-            self.accounts[server.id][user.id] = account
-            self._save_bank()
-        else:
-            raise InsufficientBalance()
+    def withdraw_credits(self, user, amount):
+        self._check_amount(amount)
+        with self._conn:
+            self._withdraw(user, amount)
 
     def deposit_credits(self, user, amount):
-        server = user.server
-        if amount < 0:
-            raise NegativeValue()
-        account = self._get_account(user)
-        account["balance"] += amount
-        self.accounts[server.id][user.id] = account
-        self._save_bank()
+        self._check_amount(amount)
+        with self._conn:
+            self._deposit(user, amount)
 
     def set_credits(self, user, amount):
-        server = user.server
-        if amount < 0:
-            raise NegativeValue()
-        account = self._get_account(user)
-        account["balance"] = amount
-        self.accounts[server.id][user.id] = account
-        self._save_bank()
+        self._check_amount(amount)
+        with self._conn:
+            cur = self._conn.execute("UPDATE accounts SET balance = ? "
+                                     "WHERE server_id = ? AND user_id = ?",
+                                     (amount, user.server.id, user.id))
+            if cur.rowcount == 0:
+                raise NoAccount()
 
     def transfer_credits(self, sender, receiver, amount):
-        if amount < 0:
-            raise NegativeValue()
+        self._check_amount(amount)
         if sender is receiver:
             raise SameSenderAndReceiver()
         if self.account_exists(sender) and self.account_exists(receiver):
-            sender_acc = self._get_account(sender)
-            if sender_acc["balance"] < amount:
-                raise InsufficientBalance()
-            self.withdraw_credits(sender, amount)
-            self.deposit_credits(receiver, amount)
+            # Both updates are committed together or not at all
+            with self._conn:
+                self._withdraw(sender, amount)
+                self._deposit(receiver, amount)
         else:
             raise NoAccount()
 
@@ -197,36 +270,78 @@ class Bank:
             return False
 
     def wipe_bank(self, server):
-        self.accounts[server.id] = {}
-        self._save_bank()
+        with self._conn:
+            self._conn.execute("DELETE FROM accounts WHERE server_id = ?",
+                               (server.id,))
 
     def get_server_accounts(self, server):
-        if server.id in self.accounts:
-            raw_server_accounts = deepcopy(self.accounts[server.id])
-            accounts = []
-            for k, v in raw_server_accounts.items():
-                v["id"] = k
-                v["server"] = server
-                acc = self._create_account_obj(v)
-                accounts.append(acc)
-            return accounts
-        else:
-            return []
+        cur = self._conn.execute("SELECT user_id, name, balance, created_at "
+                                 "FROM accounts WHERE server_id = ?",
+                                 (server.id,))
+        accounts = []
+        for user_id, name, balance, created_at in cur:
+            acc = {"id": user_id, "name": name, "balance": balance,
+                   "created_at": created_at, "server": server}
+            accounts.append(self._create_account_obj(acc))
+        return accounts
 
     def get_all_accounts(self):
         accounts = []
-        for server_id, v in self.accounts.items():
+        cur = self._conn.execute("SELECT server_id, user_id, name, balance, "
+                                 "created_at FROM accounts")
+        for server_id, user_id, name, balance, created_at in cur:
             server = self.bot.get_server(server_id)
             if server is None:
                 # Servers that have since been left will be ignored
-                # Same for users_id from the old bank format
                 continue
-            raw_server_accounts = deepcopy(self.accounts[server.id])
-            for k, v in raw_server_accounts.items():
-                v["id"] = k
-                v["server"] = server
-                acc = self._create_account_obj(v)
-                accounts.append(acc)
+            acc = {"id": user_id, "name": name, "balance": balance,
+                   "created_at": created_at, "server": server}
+            accounts.append(self._create_account_obj(acc))
+        return accounts
+
+    def get_server_leaderboard(self, server, top):
+        """Returns the top accounts of the server, richest first
+
+        Only walks the balance index until enough members who are
+        still in the server have been found"""
+        cur = self._conn.execute("SELECT user_id, name, balance, created_at "
+                                 "FROM accounts WHERE server_id = ? "
+                                 "ORDER BY balance DESC", (server.id,))
+        accounts = []
+        for user_id, name, balance, created_at in cur:
+            if server.get_member(user_id) is None:  # User left
+                continue
+            acc = {"id": user_id, "name": name, "balance": balance,
+                   "created_at": created_at, "server": server}
+            accounts.append(self._create_account_obj(acc))
+            if len(accounts) == top:
+                break
+        cur.close()
+        return accounts
+
+    def get_global_leaderboard(self, top):
+        """Returns the top accounts across all servers, richest first
+
+        Users with accounts on several servers are only listed once,
+        with their highest balance"""
+        cur = self._conn.execute("SELECT server_id, user_id, name, balance, "
+                                 "created_at FROM accounts "
+                                 "ORDER BY balance DESC")
+        accounts = []
+        seen = set()
+        for server_id, user_id, name, balance, created_at in cur:
+            if user_id in seen:
+                continue
+            server = self.bot.get_server(server_id)
+            if server is None or server.get_member(user_id) is None:
+                continue
+            seen.add(user_id)
+            acc = {"id": user_id, "name": name, "balance": balance,
+                   "created_at": created_at, "server": server}
+            accounts.append(self._create_account_obj(acc))
+            if len(accounts) == top:
+                break
+        cur.close()
         return accounts
 
     def get_balance(self, user):
@@ -243,19 +358,36 @@ class Bank:
         account["member"] = account["server"].get_member(account["id"])
         account["created_at"] = datetime.strptime(account["created_at"],
                                                   "%Y-%m-%d %H:%M:%S")
-        Account = namedtuple("Account", "id name balance "
-                             "created_at server member")
         return Account(**account)
 
-    def _save_bank(self):
-        dataIO.save_json("data/economy/bank.json", self.accounts)
+    def _withdraw(self, user, amount):
+        cur = self._conn.execute("UPDATE accounts SET balance = balance - ? "
+                                 "WHERE server_id = ? AND user_id = ? "
+                                 "AND balance >= ?",
+                                 (amount, user.server.id, user.id, amount))
+        if cur.rowcount == 0:
+            self._get_account(user)  # Raises NoAccount if that's the reason
+            raise InsufficientBalance()
+
+    def _deposit(self, user, amount):
+        # SQLite would silently turn an overflowing sum into a float
+        cur = self._conn.execute("UPDATE accounts SET balance = balance + ? "
+                                 "WHERE server_id = ? AND user_id = ? "
+                                 "AND balance <= ?",
+                                 (amount, user.server.id, user.id,
+                                  MAX_BALANCE - amount))
+        if cur.rowcount == 0:
+            self._get_account(user)  # Raises NoAccount if that's the reason
+            raise BalanceTooHigh()
 
     def _get_account(self, user):
-        server = user.server
-        try:
-            return deepcopy(self.accounts[server.id][user.id])
-        except KeyError:
+        row = self._conn.execute("SELECT name, balance, created_at "
+                                 "FROM accounts WHERE server_id = ? "
+                                 "AND user_id = ?",
+                                 (user.server.id, user.id)).fetchone()
+        if row is None:
             raise NoAccount()
+        return {"name": row[0], "balance": row[1], "created_at": row[2]}
 
 
 class SetParser:
@@ -285,16 +417,15 @@ class Economy:
 
     Get rich and have fun with imaginary currency!"""
 
+    legacy_file = "data/economy/settings.json"
+
     def __init__(self, bot):
-        global default_settings
         self.bot = bot
         self.bank = Bank(bot, "data/economy/bank.json")
-        self.file_path = "data/economy/settings.json"
-        self.settings = dataIO.load_json(self.file_path)
-        if "PAYDAY_TIME" in self.settings:  # old format
-            default_settings = self.settings
-            self.settings = {}
-        self.settings = defaultdict(lambda: default_settings, self.settings)
+        self.config = bot.config.namespace("Economy", legacy={
+            "settings": self.legacy_file})
+        self._import_old_format()
+        self.settings = self.config.view("settings", default=self.defaults)
         self.payday_register = defaultdict(dict)
         self.slot_register = defaultdict(dict)
 
@@ -358,6 +489,9 @@ class Economy:
             await self.bot.say("You can't transfer credits to yourself.")
         except InsufficientBalance:
             await self.bot.say("You don't have that sum in your bank account.")
+        except BalanceTooHigh:
+            await self.bot.say("That would take their balance past the "
+                               "bank's limit.")
         except NoAccount:
             await self.bot.say("That user has no bank account.")
 
@@ -395,6 +529,9 @@ class Economy:
                     user.name, credits.sum))
         except InsufficientBalance:
             await self.bot.say("User doesn't have enough credits.")
+        except BalanceTooHigh:
+            await self.bot.say("Balances can't go past {}.".format(
+                MAX_BALANCE))
         except NoAccount:
             await self.bot.say("User has no bank account.")
 
@@ -467,12 +604,8 @@ class Economy:
         server = ctx.message.server
         if top < 1:
             top = 10
-        bank_sorted = sorted(self.bank.get_server_accounts(server),
-                             key=lambda x: x.balance, reverse=True)
-        bank_sorted = [a for a in bank_sorted if a.member] #  exclude users who left
-        if len(bank_sorted) < top:
-            top = len(bank_sorted)
-        topten = bank_sorted[:top]
+        topten = self.bank.get_server_leaderboard(server, top)
+        top = len(topten)
         highscore = ""
         place = 1
         for acc in topten:
@@ -481,8 +614,8 @@ class Economy:
             highscore += str(acc.balance) + "\n"
             place += 1
         if highscore != "":
-            for page in pagify(highscore, shorten_by=12):
-                await self.bot.say(box(page, lang="py"))
+            for page in pagify(highscore, box_lang="py"):
+                await self.bot.say(page)
         else:
             await self.bot.say("There are no accounts in the bank.")
 
@@ -493,16 +626,8 @@ class Economy:
         Defaults to top 10"""
         if top < 1:
             top = 10
-        bank_sorted = sorted(self.bank.get_all_accounts(),
-                             key=lambda x: x.balance, reverse=True)
-        bank_sorted = [a for a in bank_sorted if a.member] #  exclude users who left
-        unique_accounts = []
-        for acc in bank_sorted:
-            if not self.already_in_list(unique_accounts, acc):
-                unique_accounts.append(acc)
-        if len(unique_accounts) < top:
-            top = len(unique_accounts)
-        topten = unique_accounts[:top]
+        topten = self.bank.get_global_leaderboard(top)
+        top = len(topten)
         highscore = ""
         place = 1
         for acc in topten:
@@ -512,17 +637,11 @@ class Economy:
             highscore += str(acc.balance) + "\n"
             place += 1
         if highscore != "":
-            for page in pagify(highscore, shorten_by=12):
-                await self.bot.say(box(page, lang="py"))
+            for page in pagify(highscore, box_lang="py"):
+                await self.bot.say(page)
         else:
             await self.bot.say("There are no accounts in the bank.")
 
-    def already_in_list(self, accounts, user):
-        for acc in accounts:
-            if user.id == acc.id:
-                return True
-        return False
-
     @commands.command()
     async def payouts(self):
         """Shows slot machine payouts"""
@@ -632,7 +751,7 @@ class Economy:
         server = ctx.message.server
         self.settings[server.id]["SLOT_MIN"] = bid
         await self.bot.say("Minimum bid is now {} credits.".format(bid))
-        dataIO.save_json(self.file_path, self.settings)
+        self.config.save(server.id)
 
     @economyset.command(pass_context=True)
     async def slotmax(self, ctx, bid: int):
@@ -640,7 +759,7 @@ class Economy:
         server = ctx.message.server
         self.settings[server.id]["SLOT_MAX"] = bid
         await self.bot.say("Maximum bid is now {} credits.".format(bid))
-        dataIO.save_json(self.file_path, self.settings)
+        self.config.save(server.id)
 
     @economyset.command(pass_context=True)
     async def slottime(self, ctx, seconds: int):
@@ -648,7 +767,7 @@ class Economy:
         server = ctx.message.server
         self.settings[server.id]["SLOT_TIME"] = seconds
         await self.bot.say("Cooldown is now {} seconds.".format(seconds))
-        dataIO.save_json(self.file_path, self.settings)
+        self.config.save(server.id)
 
     @economyset.command(pass_context=True)
     async def paydaytime(self, ctx, seconds: int):
@@ -657,7 +776,7 @@ class Economy:
         self.settings[server.id]["PAYDAY_TIME"] = seconds
         await self.bot.say("Value modified. At least {} seconds must pass "
                            "between each payday.".format(seconds))
-        dataIO.save_json(self.file_path, self.settings)
+        self.config.save(server.id)
 
     @economyset.command(pass_context=True)
     async def paydaycredits(self, ctx, credits: int):
@@ -666,7 +785,7 @@ class Economy:
         self.settings[server.id]["PAYDAY_CREDITS"] = credits
         await self.bot.say("Every payday will now give {} credits."
                            "".format(credits))
-        dataIO.save_json(self.file_path, self.settings)
+        self.config.save(server.id)
 
     @economyset.command(pass_context=True)
     async def registercredits(self, ctx, credits: int):
@@ -677,7 +796,22 @@ class Economy:
         self.settings[server.id]["REGISTER_CREDITS"] = credits
         await self.bot.say("Registering an account will now give {} credits."
                            "".format(credits))
-        dataIO.save_json(self.file_path, self.settings)
+        self.config.save(server.id)
+
+    def defaults(self):
+        """Settings of a server that never changed them"""
+        return {**default_settings, **self.config.guild(None)}
+
+    def _import_old_format(self):
+        # The old settings.json was a single set of settings for every
+        # server, they become the defaults
+        if self.config.guild(None) or \
+                not dataIO.is_valid_json(self.legacy_file):
+            return
+        legacy = dataIO.load_json(self.legacy_file)
+        if "PAYDAY_TIME" in legacy:
+            self.config.guild(None).update(legacy)
+            self.config.save(None)
 
     # What would I ever do without stackoverflow?
     def display_time(self, seconds, granularity=2):
@@ -707,23 +841,9 @@ def check_folders():
         os.makedirs("data/economy")
 
 
-def check_files():
-
-    f = "data/economy/settings.json"
-    if not dataIO.is_valid_json(f):
-        print("Creating default economy's settings.json...")
-        dataIO.save_json(f, {})
-
-    f = "data/economy/bank.json"
-    if not dataIO.is_valid_json(f):
-        print("Creating empty bank.json...")
-        dataIO.save_json(f, {})
-
-
 def setup(bot):
     global logger
     check_folders()
-    check_files()
     logger = logging.getLogger("chronoxia.economy")
     if logger.level == 0:
         # Prevents the logger from being loaded again in case of module reload
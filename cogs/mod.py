@@ -1,7 +1,8 @@
 import discord
 from discord.ext import commands
-from .utils.dataIO import dataIO
+from .utils.dataIO import dataIO, LazyJSON
 from .utils import checks
+from .utils.permissions import MOD, ADMIN
 from __main__ import send_cmd_help, settings
 from datetime import datetime
 from collections import deque, defaultdict
@@ -87,25 +88,81 @@ class TempCache:
         return (user.id, server.id, action) in self._cache
 
 
+class WordFilter:
+    """
+    Matches a list of filtered words in a single pass.
+    The words are merged into one regex factored by common prefixes,
+    so the cost depends on the message's length rather than on how
+    many words are being filtered
+    """
+    def __init__(self, words):
+        trie = {}
+        for w in words:
+            node = trie
+            for char in w:
+                node = node.setdefault(char, {})
+            node[""] = w
+        self._regex = re.compile(self._build_pattern(trie)) if trie else None
+
+    def _build_pattern(self, node):
+        alternatives = []
+        for char in sorted(c for c in node if c):
+            alternatives.append(re.escape(char) +
+                                self._build_pattern(node[char]))
+        if not alternatives:
+            return ""
+        if len(alternatives) == 1:
+            pattern = alternatives[0]
+        else:
+            pattern = "(?:" + "|".join(alternatives) + ")"
+        if "" in node:
+            # A shorter word ends here, the rest is optional
+            pattern = "(?:" + pattern + ")?"
+        return pattern
+
+    def search(self, text):
+        """Returns the first filtered word found in text, or None"""
+        if self._regex is None:
+            return None
+        match = self._regex.search(text)
+        return match.group(0) if match else None
+
+
 class Mod:
     """Moderation tools."""
 
+    whitelist_list = LazyJSON("data/mod/whitelist.json", convert=set)
+    blacklist_list = LazyJSON("data/mod/blacklist.json", convert=set)
+    ignore_list = LazyJSON("data/mod/ignorelist.json",
+                           convert=lambda d: {k: set(v) for k, v in d.items()})
+    past_names = LazyJSON("data/mod/past_names.json")
+    _perms_cache = LazyJSON("data/mod/perms_cache.json",
+                            convert=lambda d: defaultdict(dict, d))
+
     def __init__(self, bot):
         self.bot = bot
-        self.whitelist_list = dataIO.load_json("data/mod/whitelist.json")
-        self.blacklist_list = dataIO.load_json("data/mod/blacklist.json")
-        self.ignore_list = dataIO.load_json("data/mod/ignorelist.json")
-        self.filter = dataIO.load_json("data/mod/filter.json")
-        self.past_names = dataIO.load_json("data/mod/past_names.json")
-        self.past_nicknames = dataIO.load_json("data/mod/past_nicknames.json")
-        settings = dataIO.load_json("data/mod/settings.json")
-        self.settings = defaultdict(lambda: default_settings.copy(), settings)
+        bot.permissions.attach_lists(self)
+        # The lists are bot-wide, other shards' changes are read again
+        dataIO.watch_lazy(self)
+        # Each guild's file holds its settings, filter, cases and nicknames
+        self.config = bot.config.namespace("Mod", legacy={
+            "settings": "data/mod/settings.json",
+            "filter": "data/mod/filter.json",
+            "cases": "data/mod/modlog.json",
+            "past_nicknames": "data/mod/past_nicknames.json"})
+        self.settings = self.config.view("settings",
+                                         default=default_settings.copy)
+        self.filter = self.config.view("filter", default=list)
+        self.cases = self.config.view("cases")
+        self.past_nicknames = self.config.view("past_nicknames")
+        self._filter_cache = {}
         self.cache = defaultdict(lambda: deque(maxlen=3))
-        self.cases = dataIO.load_json("data/mod/modlog.json")
         self.last_case = defaultdict(dict)
         self.temp_cache = TempCache(bot)
-        perms_cache = dataIO.load_json("data/mod/perms_cache.json")
-        self._perms_cache = defaultdict(dict, perms_cache)
+
+    def __unload(self):
+        self.bot.permissions.detach_lists()
+        dataIO.unwatch(self)
 
     @commands.group(pass_context=True, no_pm=True)
     @checks.serverowner_or_permissions(administrator=True)
@@ -165,7 +222,7 @@ class Mod:
                 return
             self.settings[server.id]["mod-log"] = None
             await self.bot.say("Mod log deactivated.")
-        dataIO.save_json("data/mod/settings.json", self.settings)
+        self.config.save(server.id)
 
     @modset.command(pass_context=True, no_pm=True)
     async def banmentionspam(self, ctx, max_mentions : int=False):
@@ -187,7 +244,7 @@ class Mod:
                 return
             self.settings[server.id]["ban_mention_spam"] = False
             await self.bot.say("Autoban for mention spam disabled.")
-        dataIO.save_json("data/mod/settings.json", self.settings)
+        self.config.save(server.id)
 
     @modset.command(pass_context=True, no_pm=True)
     async def deleterepeats(self, ctx):
@@ -200,14 +257,13 @@ class Mod:
         else:
             self.settings[server.id]["delete_repeats"] = False
             await self.bot.say("Repeated messages will be ignored.")
-        dataIO.save_json("data/mod/settings.json", self.settings)
+        self.config.save(server.id)
 
     @modset.command(pass_context=True, no_pm=True)
     async def resetcases(self, ctx):
         """Resets modlog's cases"""
         server = ctx.message.server
         self.cases[server.id] = {}
-        dataIO.save_json("data/mod/modlog.json", self.cases)
         await self.bot.say("Cases have been reset.")
 
     @modset.command(pass_context=True, no_pm=True)
@@ -225,7 +281,7 @@ class Mod:
             else:
                 await self.bot.say("Delete delay set to {}"
                                    " seconds.".format(time))
-            dataIO.save_json("data/mod/settings.json", self.settings)
+            self.config.save(server.id)
         else:
             try:
                 delay = self.settings[server.id]["delete_delay"]
@@ -279,7 +335,7 @@ class Mod:
                                                  default_settings[action])
             if value != enabled:
                 self.settings[server.id][action] = enabled
-                dataIO.save_json("data/mod/settings.json", self.settings)
+                self.config.save(server.id)
             msg = ('Case creation for %s actions %s %s.' %
                    (name.lower(),
                     'was already' if enabled == value else 'is now',
@@ -302,7 +358,7 @@ class Mod:
             self.settings[server.id]["respect_hierarchy"] = False
             await self.bot.say("Role hierarchy will be ignored when "
                                "moderation commands are issued.")
-        dataIO.save_json("data/mod/settings.json", self.settings)
+        self.config.save(server.id)
 
     @commands.command(no_pm=True, pass_context=True)
     @checks.admin_or_permissions(kick_members=True)
@@ -1016,8 +1072,9 @@ class Mod:
     async def _blacklist_add(self, user: discord.Member):
         """Adds user to bot's blacklist"""
         if user.id not in self.blacklist_list:
-            self.blacklist_list.append(user.id)
-            dataIO.save_json("data/mod/blacklist.json", self.blacklist_list)
+            self.blacklist_list.add(user.id)
+            dataIO.save_json("data/mod/blacklist.json",
+                             sorted(self.blacklist_list))
             await self.bot.say("User has been added to blacklist.")
         else:
             await self.bot.say("User is already blacklisted.")
@@ -1027,7 +1084,8 @@ class Mod:
         """Removes user from bot's blacklist"""
         if user.id in self.blacklist_list:
             self.blacklist_list.remove(user.id)
-            dataIO.save_json("data/mod/blacklist.json", self.blacklist_list)
+            dataIO.save_json("data/mod/blacklist.json",
+                             sorted(self.blacklist_list))
             await self.bot.say("User has been removed from blacklist.")
         else:
             await self.bot.say("User is not in blacklist.")
@@ -1035,8 +1093,9 @@ class Mod:
     @blacklist.command(name="clear")
     async def _blacklist_clear(self):
         """Clears the blacklist"""
-        self.blacklist_list = []
-        dataIO.save_json("data/mod/blacklist.json", self.blacklist_list)
+        self.blacklist_list.clear()
+        dataIO.save_json("data/mod/blacklist.json",
+                         sorted(self.blacklist_list))
         await self.bot.say("Blacklist is now empty.")
 
     @commands.group(pass_context=True)
@@ -1054,8 +1113,9 @@ class Mod:
                 msg = "\nAll users not in whitelist will be ignored (owner, admins and mods excluded)"
             else:
                 msg = ""
-            self.whitelist_list.append(user.id)
-            dataIO.save_json("data/mod/whitelist.json", self.whitelist_list)
+            self.whitelist_list.add(user.id)
+            dataIO.save_json("data/mod/whitelist.json",
+                             sorted(self.whitelist_list))
             await self.bot.say("User has been added to whitelist." + msg)
         else:
             await self.bot.say("User is already whitelisted.")
@@ -1065,7 +1125,8 @@ class Mod:
         """Removes user from bot's whitelist"""
         if user.id in self.whitelist_list:
             self.whitelist_list.remove(user.id)
-            dataIO.save_json("data/mod/whitelist.json", self.whitelist_list)
+            dataIO.save_json("data/mod/whitelist.json",
+                             sorted(self.whitelist_list))
             await self.bot.say("User has been removed from whitelist.")
         else:
             await self.bot.say("User is not in whitelist.")
@@ -1073,8 +1134,9 @@ class Mod:
     @whitelist.command(name="clear")
     async def _whitelist_clear(self):
         """Clears the whitelist"""
-        self.whitelist_list = []
-        dataIO.save_json("data/mod/whitelist.json", self.whitelist_list)
+        self.whitelist_list.clear()
+        dataIO.save_json("data/mod/whitelist.json",
+                         sorted(self.whitelist_list))
         await self.bot.say("Whitelist is now empty.")
 
     @commands.group(pass_context=True, no_pm=True)
@@ -1093,15 +1155,15 @@ class Mod:
         current_ch = ctx.message.channel
         if not channel:
             if current_ch.id not in self.ignore_list["CHANNELS"]:
-                self.ignore_list["CHANNELS"].append(current_ch.id)
-                dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+                self.ignore_list["CHANNELS"].add(current_ch.id)
+                self.save_ignore_list()
                 await self.bot.say("Channel added to ignore list.")
             else:
                 await self.bot.say("Channel already in ignore list.")
         else:
             if channel.id not in self.ignore_list["CHANNELS"]:
-                self.ignore_list["CHANNELS"].append(channel.id)
-                dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+                self.ignore_list["CHANNELS"].add(channel.id)
+                self.save_ignore_list()
                 await self.bot.say("Channel added to ignore list.")
             else:
                 await self.bot.say("Channel already in ignore list.")
@@ -1111,8 +1173,8 @@ class Mod:
         """Ignores current server"""
         server = ctx.message.server
         if server.id not in self.ignore_list["SERVERS"]:
-            self.ignore_list["SERVERS"].append(server.id)
-            dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+            self.ignore_list["SERVERS"].add(server.id)
+            self.save_ignore_list()
             await self.bot.say("This server has been added to the ignore list.")
         else:
             await self.bot.say("This server is already being ignored.")
@@ -1134,14 +1196,14 @@ class Mod:
         if not channel:
             if current_ch.id in self.ignore_list["CHANNELS"]:
                 self.ignore_list["CHANNELS"].remove(current_ch.id)
-                dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+                self.save_ignore_list()
                 await self.bot.say("This channel has been removed from the ignore list.")
             else:
                 await self.bot.say("This channel is not in the ignore list.")
         else:
             if channel.id in self.ignore_list["CHANNELS"]:
                 self.ignore_list["CHANNELS"].remove(channel.id)
-                dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+                self.save_ignore_list()
                 await self.bot.say("Channel removed from ignore list.")
             else:
                 await self.bot.say("That channel is not in the ignore list.")
@@ -1152,11 +1214,15 @@ class Mod:
         server = ctx.message.server
         if server.id in self.ignore_list["SERVERS"]:
             self.ignore_list["SERVERS"].remove(server.id)
-            dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+            self.save_ignore_list()
             await self.bot.say("This server has been removed from the ignore list.")
         else:
             await self.bot.say("This server is not in the ignore list.")
 
+    def save_ignore_list(self):
+        data = {k: sorted(v) for k, v in self.ignore_list.items()}
+        dataIO.save_json("data/mod/ignorelist.json", data)
+
     def count_ignored(self):
         msg = "```Currently ignoring:\n"
         msg += str(len(self.ignore_list["CHANNELS"])) + " channels\n"
@@ -1198,14 +1264,15 @@ class Mod:
             return
         server = ctx.message.server
         added = 0
-        if server.id not in self.filter.keys():
+        if server.id not in self.filter:
             self.filter[server.id] = []
         for w in words:
             if w.lower() not in self.filter[server.id] and w != "":
                 self.filter[server.id].append(w.lower())
                 added += 1
         if added:
-            dataIO.save_json("data/mod/filter.json", self.filter)
+            self._filter_cache.pop(server.id, None)
+            self.config.save(server.id)
             await self.bot.say("Words added to filter.")
         else:
             await self.bot.say("Words already in the filter.")
@@ -1217,13 +1284,13 @@ class Mod:
         Use double quotes to remove sentences
         Examples:
         filter remove word1 word2 word3
-        filter remove \"This is a sentence\"""
+        filter remove \"This is a sentence\""""
         if words == ():
             await send_cmd_help(ctx)
             return
         server = ctx.message.server
         removed = 0
-        if server.id not in self.filter.keys():
+        if server.id not in self.filter:
             await self.bot.say("There are no filtered words in this server.")
             return
         for w in words:
@@ -1231,7 +1298,8 @@ class Mod:
                 self.filter[server.id].remove(w.lower())
                 removed += 1
         if removed:
-            dataIO.save_json("data/mod/filter.json", self.filter)
+            self._filter_cache.pop(server.id, None)
+            self.config.save(server.id)
             await self.bot.say("Words removed from filter.")
         else:
             await self.bot.say("Those words weren't in the filter.")
@@ -1343,17 +1411,11 @@ class Mod:
             raise TypeError('Only messages, members or roles may be passed')
 
         server = obj.server
-        admin_role = settings.get_server_admin(server)
 
         if isinstance(obj, discord.Role):
-            return obj.name == admin_role
+            return obj.name == settings.get_server_admin(server)
 
-        if user.id == settings.owner:
-            return True
-        elif discord.utils.get(user.roles, name=admin_role):
-            return True
-        else:
-            return False
+        return self.bot.permissions.tier(user, server) >= ADMIN
 
     def is_mod_or_superior(self, obj):
         if isinstance(obj, discord.Message):
@@ -1366,20 +1428,13 @@ class Mod:
             raise TypeError('Only messages, members or roles may be passed')
 
         server = obj.server
-        admin_role = settings.get_server_admin(server)
-        mod_role = settings.get_server_mod(server)
 
         if isinstance(obj, discord.Role):
+            admin_role = settings.get_server_admin(server)
+            mod_role = settings.get_server_mod(server)
             return obj.name in [admin_role, mod_role]
 
-        if user.id == settings.owner:
-            return True
-        elif discord.utils.get(user.roles, name=admin_role):
-            return True
-        elif discord.utils.get(user.roles, name=mod_role):
-            return True
-        else:
-            return False
+        return self.bot.permissions.tier(user, server) >= MOD
 
     def is_allowed_by_hierarchy(self, server, mod, user):
         toggled = self.settings[server.id].get("respect_hierarchy",
@@ -1400,9 +1455,6 @@ class Mod:
         if mod_channel is None:
             return
 
-        if server.id not in self.cases:
-            self.cases[server.id] = {}
-
         case_n = len(self.cases[server.id]) + 1
 
         case = {
@@ -1435,7 +1487,7 @@ class Mod:
         if mod:
             self.last_case[server.id][mod.id] = case_n
 
-        dataIO.save_json("data/mod/modlog.json", self.cases)
+        self.config.save(server.id)
 
     async def update_case(self, server, *, case, mod=None, reason=None,
                           until=False):
@@ -1466,7 +1518,7 @@ class Mod:
 
         case_msg = self.format_case_msg(case)
 
-        dataIO.save_json("data/mod/modlog.json", self.cases)
+        self.config.save(server.id)
 
         if case["message"] is None:  # The case's message was never sent
             raise CaseMessageNotFound()
@@ -1528,19 +1580,27 @@ class Mod:
 
         return case_msg
 
+    def get_word_filter(self, server):
+        """Returns the server's compiled WordFilter, building it if needed"""
+        word_filter = self._filter_cache.get(server.id)
+        if word_filter is None:
+            word_filter = WordFilter(self.filter.get(server.id, []))
+            self._filter_cache[server.id] = word_filter
+        return word_filter
+
     async def check_filter(self, message):
         server = message.server
-        if server.id in self.filter.keys():
-            for w in self.filter[server.id]:
-                if w in message.content.lower():
-                    try:
-                        await self.bot.delete_message(message)
-                        logger.info("Message deleted in server {}."
-                                    "Filtered: {}"
-                                    "".format(server.id, w))
-                        return True
-                    except:
-                        pass
+        if server.id in self.filter:
+            w = self.get_word_filter(server).search(message.content.lower())
+            if w is not None:
+                try:
+                    await self.bot.delete_message(message)
+                    logger.info("Message deleted in server {}."
+                                "Filtered: {}"
+                                "".format(server.id, w))
+                    return True
+                except:
+                    pass
         return False
 
     async def check_duplicates(self, message):
@@ -1649,7 +1709,7 @@ class Mod:
                     names = deque(self.past_names[before.id], maxlen=20)
                     names.append(after.name)
                     self.past_names[before.id] = list(names)
-            dataIO.save_json("data/mod/past_names.json", self.past_names)
+            dataIO.mark_dirty("data/mod/past_names.json", self.past_names)
 
         if before.nick != after.nick and after.nick is not None:
             server = before.server
@@ -1663,8 +1723,7 @@ class Mod:
             if after.nick not in nicks:
                 nicks.append(after.nick)
                 self.past_nicknames[server.id][before.id] = list(nicks)
-                dataIO.save_json("data/mod/past_nicknames.json",
-                                 self.past_nicknames)
+                self.config.save(server.id)
 
     def are_overwrites_empty(self, overwrites):
         """There is currently no cleaner way to check if a
@@ -1710,11 +1769,7 @@ def check_files():
         "blacklist.json"      : [],
         "whitelist.json"      : [],
         "ignorelist.json"     : ignore_list,
-        "filter.json"         : {},
         "past_names.json"     : {},
-        "past_nicknames.json" : {},
-        "settings.json"       : {},
-        "modlog.json"         : {},
         "perms_cache.json"    : {}
     }
 
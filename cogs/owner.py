@@ -13,6 +13,7 @@ import threading
 import datetime
 import glob
 import os
+import time
 import aiohttp
 
 log = logging.getLogger("chronoxia.owner")
@@ -48,9 +49,14 @@ class Owner:
         self.file_path = "data/chronoxia/disabled_commands.json"
         self.disabled_commands = dataIO.load_json(self.file_path)
         self.session = aiohttp.ClientSession(loop=self.bot.loop)
+        # Under sharding, follow what the owner did on the other shards
+        dataIO.watch("data/chronoxia/cogs.json", self._registry_changed,
+                     owner=self)
+        dataIO.watch(self.file_path, self._disabled_changed, owner=self)
 
     def __unload(self):
         self.session.close()
+        dataIO.unwatch(self)
 
     @commands.command()
     @checks.is_owner()
@@ -234,13 +240,10 @@ class Owner:
                 result = result.replace(w.lower(), r)
                 result = result.replace(w.upper(), r)
 
-        result = list(pagify(result, shorten_by=16))
-
-        for i, page in enumerate(result):
+        for i, page in enumerate(pagify(result, box_lang="py")):
             if i != 0 and i % 4 == 0:
-                last = await self.bot.say("There are still {} messages. "
-                                          "Type `more` to continue."
-                                          "".format(len(result) - (i+1)))
+                last = await self.bot.say("There are more messages. "
+                                          "Type `more` to continue.")
                 msg = await self.bot.wait_for_message(author=author,
                                                       channel=channel,
                                                       check=check,
@@ -252,7 +255,7 @@ class Owner:
                         pass
                     finally:
                         break
-            await self.bot.say(box(page, lang="py"))
+            await self.bot.say(page)
 
     @commands.group(name="set", pass_context=True)
     async def _set(self, ctx):
@@ -560,6 +563,7 @@ class Owner:
         else:
             comm_obj.enabled = False
             comm_obj.hidden = True
+            self.bot.invalidate_help()
             self.disabled_commands.append(command)
             dataIO.save_json(self.file_path, self.disabled_commands)
             await self.bot.say("Command has been disabled.")
@@ -578,6 +582,7 @@ class Owner:
             comm_obj = await self.get_command(command)
             comm_obj.enabled = True
             comm_obj.hidden = False
+            self.bot.invalidate_help()
         except:  # In case it was in the disabled list but not currently loaded
             pass # No point in even checking what returns
 
@@ -604,6 +609,37 @@ class Owner:
                 cmd_obj.hidden = True
             except:
                 pass
+        self.bot.invalidate_help()
+
+    def _disabled_changed(self):
+        enabled = set(self.disabled_commands)
+        self.disabled_commands = dataIO.load_json(self.file_path)
+        enabled.difference_update(self.disabled_commands)
+        self.bot.loop.create_task(self._update_disabled(enabled))
+
+    async def _update_disabled(self, enabled):
+        for cmd in enabled:
+            cmd_obj = await self.get_command(cmd)
+            if cmd_obj not in (KeyError, False):
+                cmd_obj.enabled = True
+                cmd_obj.hidden = False
+        await self.disable_commands()
+
+    def _registry_changed(self):
+        registry = dataIO.load_json("data/chronoxia/cogs.json")
+        for cogname, enabled in registry.items():
+            if cogname == "cogs.owner":
+                continue
+            loaded = cogname in self.bot.extensions
+            try:
+                if enabled and not loaded:
+                    self._load_cog(cogname)
+                elif not enabled and loaded:
+                    self._unload_cog(cogname)
+            except Exception:
+                log.exception("Couldn't follow another shard in loading or "
+                              "unloading {}".format(cogname))
+        self.bot.loop.create_task(self.disable_commands())
 
     @commands.command()
     @checks.is_owner()
@@ -799,18 +835,35 @@ class Owner:
             destination = ctx.message.channel
 
         if self.bot._last_exception:
-            for page in pagify(self.bot._last_exception):
-                await self.bot.send_message(destination, box(page, lang="py"))
+            for page in pagify(self.bot._last_exception, box_lang="py"):
+                await self.bot.send_message(destination, page)
         else:
             await self.bot.say("No exception has occurred yet.")
 
-    def _load_cog(self, cogname):
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def metrics(self, ctx, raw: bool=False):
+        """Shows counters, gauges and latency histograms
+
+        If raw (yes is specified), shows the Prometheus text that is
+        periodically written to data/chronoxia/metrics.prom"""
+        metrics = self.bot.metrics
+        text = metrics.render() if raw else metrics.summary()
+        for page in pagify(text, box_lang=""):
+            await self.bot.say(page)
+
+    def _load_cog(self, cogname, timings=None):
         if not self._does_cogfile_exist(cogname):
             raise CogNotFoundError(cogname)
         try:
+            start = time.perf_counter()
             mod_obj = importlib.import_module(cogname)
             importlib.reload(mod_obj)
+            imported = time.perf_counter()
             self.bot.load_extension(mod_obj.__name__)
+            if timings is not None:
+                timings["import"] = imported - start
+                timings["setup"] = time.perf_counter() - imported
         except SyntaxError as e:
             raise CogLoadError(*e.args)
         except:
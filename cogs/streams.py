@@ -1,6 +1,6 @@
 import discord
 from discord.ext import commands
-from .utils.dataIO import dataIO
+from .utils.dataIO import dataIO, LazyJSON
 from .utils.chat_formatting import escape_mass_mentions
 from .utils import checks
 from __main__ import send_cmd_help
@@ -12,6 +12,15 @@ import re
 import aiohttp
 import asyncio
 import logging
+import time
+
+
+log = logging.getLogger("chronoxia.streams")
+
+# Requests in flight at the same time to each provider
+PROVIDER_CONCURRENCY = 10
+# Logins per request to Twitch's multi channel streams endpoint
+TWITCH_BATCH_SIZE = 100
 
 
 class Streams:
@@ -19,13 +28,27 @@ class Streams:
 
     Twitch, Hitbox and Beam alerts"""
 
+    # Overridable so the checker can be pointed at a fake server
+    twitch_api = "https://api.twitch.tv/kraken"
+    hitbox_api = "https://api.hitbox.tv"
+    beam_api = "https://beam.pro/api/v1"
+
+    twitch_streams = LazyJSON("data/streams/twitch.json")
+    hitbox_streams = LazyJSON("data/streams/hitbox.json")
+    beam_streams = LazyJSON("data/streams/beam.json")
+    settings = LazyJSON("data/streams/settings.json",
+                        convert=lambda d: defaultdict(dict, d))
+
     def __init__(self, bot):
         self.bot = bot
-        self.twitch_streams = dataIO.load_json("data/streams/twitch.json")
-        self.hitbox_streams = dataIO.load_json("data/streams/hitbox.json")
-        self.beam_streams = dataIO.load_json("data/streams/beam.json")
-        settings = dataIO.load_json("data/streams/settings.json")
-        self.settings = defaultdict(dict, settings)
+        connector = aiohttp.TCPConnector(limit=PROVIDER_CONCURRENCY * 3,
+                                         loop=self.bot.loop)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             loop=self.bot.loop)
+        self.last_sweep = None  # (seconds, streams checked)
+
+    def __unload(self):
+        self.session.close()
 
     @commands.command()
     async def hitbox(self, stream: str):
@@ -314,10 +337,21 @@ class Streams:
 
         dataIO.save_json("data/streams/settings.json", self.settings)
 
+    @streamset.command(name="sweep")
+    @checks.is_owner()
+    async def streamset_sweep(self):
+        """Shows how long the last check of all streams took"""
+        if self.last_sweep is None:
+            await self.bot.say("No streams have been checked yet.")
+            return
+        seconds, count = self.last_sweep
+        await self.bot.say("Checked {} streams in {:.2f} seconds."
+                           "".format(count, seconds))
+
     async def hitbox_online(self, stream):
-        url = "https://api.hitbox.tv/media/live/" + stream
+        url = self.hitbox_api + "/media/live/" + stream
         try:
-            async with aiohttp.get(url) as r:
+            async with self.session.get(url) as r:
                 data = await r.json(encoding='utf-8')
             if "livestream" not in data:
                 return None
@@ -331,13 +365,11 @@ class Streams:
             return "error"
 
     async def twitch_online(self, stream):
-        session = aiohttp.ClientSession()
-        url = "https://api.twitch.tv/kraken/streams/" + stream
+        url = self.twitch_api + "/streams/" + stream
         header = {'Client-ID': self.settings.get("TWITCH_TOKEN", "")}
         try:
-            async with session.get(url, headers=header) as r:
+            async with self.session.get(url, headers=header) as r:
                 data = await r.json(encoding='utf-8')
-            await session.close()
             if r.status == 400:
                 return 400
             elif r.status == 404:
@@ -351,10 +383,31 @@ class Streams:
             return "error"
         return "error"
 
+    async def twitch_online_many(self, streams):
+        """Checks up to TWITCH_BATCH_SIZE streams with a single request
+
+        Returns a dict of stream name: embed, False or "error"."""
+        url = self.twitch_api + "/streams"
+        header = {'Client-ID': self.settings.get("TWITCH_TOKEN", "")}
+        params = {"channel": ",".join(streams), "limit": len(streams)}
+        try:
+            async with self.session.get(url, headers=header,
+                                        params=params) as r:
+                data = await r.json(encoding='utf-8')
+            if r.status != 200:
+                return {s: "error" for s in streams}
+            online = {}
+            for stream in data["streams"]:
+                name = stream["channel"]["name"].lower()
+                online[name] = self.twitch_embed({"stream": stream})
+        except:
+            return {s: "error" for s in streams}
+        return {s: online.get(s.lower(), False) for s in streams}
+
     async def beam_online(self, stream):
-        url = "https://beam.pro/api/v1/channels/" + stream
+        url = self.beam_api + "/channels/" + stream
         try:
-            async with aiohttp.get(url) as r:
+            async with self.session.get(url) as r:
                 data = await r.json(encoding='utf-8')
             if "online" in data:
                 if data["online"] is True:
@@ -425,37 +478,69 @@ class Streams:
             embed.set_footer(text="Playing: " + data["type"]["name"])
         return embed
 
+    async def _check_twitch_streams(self, streams):
+        semaphore = asyncio.Semaphore(PROVIDER_CONCURRENCY)
+        names = [s["NAME"] for s in streams]
+
+        async def check(batch):
+            async with semaphore:
+                return await self.twitch_online_many(batch)
+
+        batches = [names[i:i + TWITCH_BATCH_SIZE]
+                   for i in range(0, len(names), TWITCH_BATCH_SIZE)]
+        results = {}
+        for result in await asyncio.gather(*[check(b) for b in batches]):
+            results.update(result)
+        return [results[name] for name in names]
+
+    async def _check_streams(self, streams, parser):
+        semaphore = asyncio.Semaphore(PROVIDER_CONCURRENCY)
+
+        async def check(stream):
+            async with semaphore:
+                return await parser(stream["NAME"])
+
+        return await asyncio.gather(*[check(s) for s in streams])
+
+    async def check_all_streams(self):
+        """Checks every stream once. Returns a list of (stream, status)"""
+        streams = (list(self.twitch_streams), list(self.hitbox_streams),
+                   list(self.beam_streams))
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            self._check_twitch_streams(streams[0]),
+            self._check_streams(streams[1], self.hitbox_online),
+            self._check_streams(streams[2], self.beam_online))
+        checked = []
+        for stream_list, statuses in zip(streams, results):
+            checked.extend(zip(stream_list, statuses))
+        self.last_sweep = (time.perf_counter() - start, len(checked))
+        log.debug("Checked {} streams in {:.2f}s".format(len(checked),
+                                                        self.last_sweep[0]))
+        return checked
+
     async def stream_checker(self):
         CHECK_DELAY = 60
 
         while self == self.bot.get_cog("Streams"):
             save = False
 
-            streams = ((self.twitch_streams, self.twitch_online),
-                       (self.hitbox_streams, self.hitbox_online),
-                       (self.beam_streams,   self.beam_online))
-
-            for stream_type in streams:
-                streams = stream_type[0]
-                parser = stream_type[1]
-                for stream in streams:
-                    online = await parser(stream["NAME"])
-                    if isinstance(online, discord.Embed) and not stream["ALREADY_ONLINE"]:
+            for stream, online in await self.check_all_streams():
+                if isinstance(online, discord.Embed) and not stream["ALREADY_ONLINE"]:
+                    save = True
+                    stream["ALREADY_ONLINE"] = True
+                    for channel in stream["CHANNELS"]:
+                        channel_obj = self.bot.get_channel(channel)
+                        if channel_obj is None:
+                            continue
+                        mention = self.settings.get(channel_obj.server.id, {}).get("MENTION", "")
+                        can_speak = channel_obj.permissions_for(channel_obj.server.me).send_messages
+                        if channel_obj and can_speak:
+                            await self.bot.send_message(channel_obj, mention, embed=online)
+                else:
+                    if stream["ALREADY_ONLINE"] and not online:
                         save = True
-                        stream["ALREADY_ONLINE"] = True
-                        for channel in stream["CHANNELS"]:
-                            channel_obj = self.bot.get_channel(channel)
-                            if channel_obj is None:
-                                continue
-                            mention = self.settings.get(channel_obj.server.id, {}).get("MENTION", "")
-                            can_speak = channel_obj.permissions_for(channel_obj.server.me).send_messages
-                            if channel_obj and can_speak:
-                                await self.bot.send_message(channel_obj, mention, embed=online)
-                    else:
-                        if stream["ALREADY_ONLINE"] and not online:
-                            save = True
-                            stream["ALREADY_ONLINE"] = False
-                    await asyncio.sleep(0.5)
+                        stream["ALREADY_ONLINE"] = False
 
             if save:
                 dataIO.save_json("data/streams/twitch.json", self.twitch_streams)
@@ -1,9 +1,8 @@
 from discord.ext import commands
 from random import choice
-from .utils.dataIO import dataIO
 from .utils import checks
 from .utils.chat_formatting import box
-from collections import Counter, defaultdict, namedtuple
+from collections import Counter, namedtuple
 import discord
 import time
 import os
@@ -21,12 +20,13 @@ TriviaLine = namedtuple("Question", "question answers")
 
 class Trivia:
     """General commands."""
+
     def __init__(self, bot):
         self.bot = bot
         self.trivia_sessions = []
-        self.file_path = "data/trivia/settings.json"
-        settings = dataIO.load_json(self.file_path)
-        self.settings = defaultdict(lambda: DEFAULTS.copy(), settings)
+        self.config = bot.config.namespace("Trivia", legacy={
+            "settings": "data/trivia/settings.json"})
+        self.settings = self.config.view("settings", default=DEFAULTS.copy)
 
     @commands.group(pass_context=True, no_pm=True)
     @checks.mod_or_permissions(administrator=True)
@@ -49,7 +49,7 @@ class Trivia:
         server = ctx.message.server
         if score > 0:
             self.settings[server.id]["MAX_SCORE"] = score
-            self.save_settings()
+            self.config.save(server.id)
             await self.bot.say("Points required to win set to {}".format(score))
         else:
             await self.bot.say("Score must be superior to 0.")
@@ -60,7 +60,7 @@ class Trivia:
         server = ctx.message.server
         if seconds > 4:
             self.settings[server.id]["DELAY"] = seconds
-            self.save_settings()
+            self.config.save(server.id)
             await self.bot.say("Maximum seconds to answer set to {}".format(seconds))
         else:
             await self.bot.say("Seconds must be at least 5.")
@@ -75,7 +75,7 @@ class Trivia:
         else:
             self.settings[server.id]["BOT_PLAYS"] = True
             await self.bot.say("I'll gain a point everytime you don't answer in time.")
-        self.save_settings()
+        self.config.save(server.id)
 
     @triviaset.command(pass_context=True)
     async def revealanswer(self, ctx):
@@ -87,7 +87,7 @@ class Trivia:
         else:
             self.settings[server.id]["REVEAL_ANSWER"] = True
             await self.bot.say("I'll reveal the answer if no one knows it.")
-        self.save_settings()
+        self.config.save(server.id)
 
     @commands.group(pass_context=True, invoke_without_command=True, no_pm=True)
     async def trivia(self, ctx, list_name: str):
@@ -198,9 +198,6 @@ class Trivia:
         if instance in self.trivia_sessions:
             self.trivia_sessions.remove(instance)
 
-    def save_settings(self):
-        dataIO.save_json(self.file_path, self.settings)
-
 
 class TriviaSession():
     def __init__(self, bot, trivia_list, message, settings):
@@ -247,7 +244,7 @@ class TriviaSession():
         self.count += 1
         self.timer = int(time.perf_counter())
         msg = "**Question number {}!**\n\n{}".format(self.count, self.current_line.question)
-        await self.bot.say(msg)
+        await self.bot.say(msg, coalesce=True)
 
         while self.status != "correct answer" and abs(self.timer - int(time.perf_counter())) <= self.settings["DELAY"]:
             if abs(self.timeout - int(time.perf_counter())) >= self.settings["TIMEOUT"]:
@@ -271,7 +268,7 @@ class TriviaSession():
                 msg += " **+1** for me!"
                 self.scores[self.bot.user] += 1
             self.current_line = None
-            await self.bot.say(msg)
+            await self.bot.say(msg, coalesce=True)
             await self.bot.type()
             await asyncio.sleep(3)
             if not self.status == "stop":
@@ -293,7 +290,8 @@ class TriviaSession():
                         self.status = "correct answer"
                         self.scores[message.author] += 1
                         msg = "You got it {}! **+1** to you!".format(message.author.name)
-                        await self.bot.send_message(message.channel, msg)
+                        await self.bot.send_message(message.channel, msg,
+                                                    coalesce=True)
                         return True
 
 
@@ -305,13 +303,6 @@ def check_folders():
             os.makedirs(folder)
 
 
-def check_files():
-    if not os.path.isfile("data/trivia/settings.json"):
-        print("Creating empty settings.json...")
-        dataIO.save_json("data/trivia/settings.json", {})
-
-
 def setup(bot):
     check_folders()
-    check_files()
     bot.add_cog(Trivia(bot))
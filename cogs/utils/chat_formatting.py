@@ -31,29 +31,96 @@ def italics(text):
     return "*{}*".format(text)
 
 
+FENCE = "```"
+
+
 def pagify(text, delims=["\n"], *, escape=True, shorten_by=8,
-           page_length=2000):
-    """DOES NOT RESPECT MARKDOWN BOXES OR INLINE CODE"""
-    in_text = text
-    if escape:
-        num_mentions = text.count("@here") + text.count("@everyone")
-        shorten_by += num_mentions
+           page_length=2000, box_lang=None):
+    """Lazily splits a string, or an iterable of lines, into pages
+
+    Each page is cut at the last delimiter that fits, in one pass over the
+    text. Code blocks that span a page break are closed and reopened with
+    the same language. With box_lang every page is wrapped in box() and
+    the box counts towards page_length."""
+    if isinstance(text, str):
+        pieces = iter((text,))
+    else:
+        pieces = _joined_lines(text)
     page_length -= shorten_by
-    while len(in_text) > page_length:
-        closest_delim = max([in_text.rfind(d, 0, page_length)
-                             for d in delims])
-        closest_delim = closest_delim if closest_delim != -1 else page_length
+    if box_lang is not None:
+        page_length -= len(box("", box_lang))
+    buf = ""
+    pos = 0
+    exhausted = False
+    block = None  # Language of the code block left open, if any
+    while True:
+        if not exhausted and len(buf) - pos <= page_length:
+            parts = [buf[pos:]]
+            size = len(parts[0])
+            for piece in pieces:
+                parts.append(piece)
+                size += len(piece)
+                if size > page_length:
+                    break
+            else:
+                exhausted = True
+            buf = "".join(parts)
+            pos = 0
+
+        opener = "" if block is None else FENCE + block + "\n"
+        limit = page_length - len(opener)
+        window = pos + limit
         if escape:
-            to_send = escape_mass_mentions(in_text[:closest_delim])
+            limit -= (buf.count("@here", pos, window) +
+                      buf.count("@everyone", pos, window))
+        if block is not None or buf.find(FENCE, pos, window) != -1:
+            limit -= len(FENCE) + 1
+        limit = max(limit, 1)
+
+        if exhausted and len(buf) - pos <= limit:
+            cut = len(buf)
         else:
-            to_send = in_text[:closest_delim]
-        yield to_send
-        in_text = in_text[closest_delim:]
+            window = pos + limit
+            cut = max(buf.rfind(d, pos + 1, window) for d in delims)
+            if cut == -1:
+                cut = window
+            fence = buf.find(FENCE, cut - 2, cut + 2)
+            if pos < fence < cut:  # Don't split a fence in half
+                cut = fence
+
+        fences = buf.count(FENCE, pos, cut)
+        if fences % 2:
+            if block is None:
+                block = _fence_lang(buf, buf.rfind(FENCE, pos, cut), cut)
+            else:
+                block = None
+        page = opener + buf[pos:cut]
+        if block is not None:
+            page += "\n" + FENCE
+        if escape:
+            page = escape_mass_mentions(page)
+        if box_lang is not None:
+            page = box(page, box_lang)
+        yield page
 
-    if escape:
-        yield escape_mass_mentions(in_text)
-    else:
-        yield in_text
+        pos = cut
+        if exhausted and pos >= len(buf):
+            return
+
+
+def _joined_lines(lines):
+    first = True
+    for line in lines:
+        yield line if first else "\n" + line
+        first = False
+
+
+def _fence_lang(text, start, end):
+    """Language named after the fence at start, if any"""
+    start += len(FENCE)
+    newline = text.find("\n", start, end)
+    lang = text[start:newline if newline != -1 else end]
+    return lang if lang.isalnum() else ""
 
 
 def strikethrough(text):
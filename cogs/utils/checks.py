@@ -1,6 +1,7 @@
 from discord.ext import commands
 import discord.utils
-from __main__ import settings
+from __main__ import settings, permissions
+from .permissions import MOD, ADMIN
 
 #
 # This is a modified version of checks.py, originally made by Rapptz
@@ -48,20 +49,26 @@ def role_or_permissions(ctx, check, **perms):
     role = discord.utils.find(check, author.roles)
     return role is not None
 
+def tier_or_permissions(ctx, tier, **perms):
+    if check_permissions(ctx, perms):
+        return True
+
+    if ctx.message.channel.is_private:
+        return False # can't have roles in PMs
+
+    author = ctx.message.author
+    server = ctx.message.server
+    return permissions.tier(author, server, ignore_case=True) >= tier
+
 def mod_or_permissions(**perms):
     def predicate(ctx):
-        server = ctx.message.server
-        mod_role = settings.get_server_mod(server).lower()
-        admin_role = settings.get_server_admin(server).lower()
-        return role_or_permissions(ctx, lambda r: r.name.lower() in (mod_role,admin_role), **perms)
+        return tier_or_permissions(ctx, MOD, **perms)
 
     return commands.check(predicate)
 
 def admin_or_permissions(**perms):
     def predicate(ctx):
-        server = ctx.message.server
-        admin_role = settings.get_server_admin(server)
-        return role_or_permissions(ctx, lambda r: r.name.lower() == admin_role.lower(), **perms)
+        return tier_or_permissions(ctx, ADMIN, **perms)
 
     return commands.check(predicate)
 
@@ -0,0 +1,237 @@
+from collections import OrderedDict
+import logging
+import os
+
+from .dataIO import dataIO
+
+log = logging.getLogger("chronoxia.config")
+
+CONFIG_ROOT = "data/config"
+# Guild documents kept in memory across all namespaces
+GUILD_CACHE_SIZE = 2000
+
+
+class Config:
+    """Namespaced settings store shared by the bot and its cogs
+
+    Each namespace lives in data/config/<namespace>/ as global.json plus
+    one json file per guild. Guild files are read the first time they're
+    used and the least recently used ones are dropped from memory past
+    GUILD_CACHE_SIZE, so memory follows active guilds. Writes go through
+    dataIO's write-behind flusher."""
+
+    def __init__(self, root=CONFIG_ROOT, max_guilds=GUILD_CACHE_SIZE):
+        self.root = root
+        self.max_guilds = max_guilds
+        self._namespaces = {}
+        self._guilds = OrderedDict()  # (namespace, guild id): data
+
+    def namespace(self, name, *, legacy=None, on_load=None):
+        """Returns the namespace called name, creating it if needed
+
+        legacy names an old {server id: data} json file that is split
+        into guild files the first time the namespace is created. A
+        (file, key) pair names such a map stored under key in file. A
+        {name: file} dict merges several of them, each guild's data
+        from a file going under name in its guild file.
+        on_load(guild_id, data) is called on each guild's data after it's
+        read. It may fix it up in place and returns True if it did, so
+        the fixed data is written back."""
+        namespace = self._namespaces.get(name)
+        if namespace is None:
+            namespace = Namespace(self, name)
+            self._namespaces[name] = namespace
+            if legacy is not None:
+                # Shards starting together import it once
+                with dataIO.locked():
+                    namespace._import_legacy(legacy)
+        namespace.on_load = on_load
+        return namespace
+
+    def _cached(self, key):
+        data = self._guilds.get(key)
+        if data is not None:
+            self._guilds.move_to_end(key)
+        return data
+
+    def _cache(self, key, data):
+        self._guilds[key] = data
+        while len(self._guilds) > self.max_guilds:
+            # Unsaved changes stay with dataIO, whose load_json flushes
+            # dirty files and serves the ones it's still writing, so a
+            # guild read again doesn't get an older copy
+            self._guilds.popitem(last=False)
+
+    def loaded_guilds(self):
+        return len(self._guilds)
+
+
+class Namespace:
+    """One cog's (or the core's) settings, global and per guild
+
+    get/set/delete write through and notify subscribers. Code that edits
+    the dict returned by guild() in place calls save() afterwards."""
+
+    def __init__(self, config, name):
+        self.config = config
+        self.name = name
+        self.on_load = None
+        self.path = os.path.join(config.root, name)
+        self._subscribers = []
+        self._global = None
+        os.makedirs(os.path.join(self.path, "guilds"), exist_ok=True)
+
+    def _filename(self, guild_id):
+        if guild_id is None:
+            return os.path.join(self.path, "global.json")
+        return os.path.join(self.path, "guilds", "{}.json".format(guild_id))
+
+    def _read(self, guild_id):
+        try:
+            data = dataIO.load_json(self._filename(guild_id))
+        except FileNotFoundError:
+            data = {}
+        if self.on_load is not None and self.on_load(guild_id, data):
+            dataIO.mark_dirty(self._filename(guild_id), data)
+        return data
+
+    def guild(self, guild_id):
+        """The live data of a guild, or the global data if guild_id is
+        None. Loaded on first use"""
+        if guild_id is None:
+            if self._global is None:
+                self._global = self._read(None)
+            return self._global
+        key = (self.name, guild_id)
+        data = self.config._cached(key)
+        if data is None:
+            data = self._read(guild_id)
+            self.config._cache(key, data)
+        return data
+
+    def get(self, guild_id, key, default=None):
+        return self.guild(guild_id).get(key, default)
+
+    def set(self, guild_id, key, value):
+        data = self.guild(guild_id)
+        data[key] = value
+        self._save(guild_id, data, key, value)
+
+    def delete(self, guild_id, key):
+        data = self.guild(guild_id)
+        if key in data:
+            del data[key]
+            self._save(guild_id, data, key, None)
+
+    def clear(self, guild_id):
+        data = self.guild(guild_id)
+        data.clear()
+        self._save(guild_id, data, None, None)
+
+    def save(self, guild_id):
+        """Persists a guild's data after it was edited in place"""
+        self._save(guild_id, self.guild(guild_id), None, None)
+
+    def _save(self, guild_id, data, key, value):
+        dataIO.mark_dirty(self._filename(guild_id), data)
+        for callback in self._subscribers:
+            try:
+                callback(guild_id, key, value)
+            except Exception:
+                log.exception("Config subscriber of '{}' failed"
+                              "".format(self.name))
+
+    def subscribe(self, callback):
+        """callback(guild_id, key, value) runs after every change. key is
+        None when the change isn't about a single key"""
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def view(self, key, default=dict):
+        """A GuildView over key of the guild files"""
+        return GuildView(self, key, default)
+
+    def _import_legacy(self, legacy):
+        marker = os.path.join(self.path, "imported.json")
+        if dataIO.is_valid_json(marker) or self._move_old_marker(marker):
+            return
+        if isinstance(legacy, dict):
+            sources = legacy.items()
+        else:
+            sources = [(None, legacy)]
+        imported = {}
+        found = False
+        for name, source in sources:
+            guilds = self._load_legacy(source)
+            if guilds is None:
+                continue
+            found = True
+            for guild_id, data in guilds.items():
+                # Skips what isn't a guild, like an older global format
+                if not guild_id.isdigit():
+                    continue
+                if name is None:
+                    imported[guild_id] = data
+                else:
+                    imported.setdefault(guild_id, {})[name] = data
+        if not found:
+            return
+        for guild_id, data in imported.items():
+            dataIO.save_json(self._filename(guild_id), data)
+        dataIO.save_json(marker, {"legacy": legacy})
+        log.info("Imported {} guilds from {} into config namespace '{}'"
+                 "".format(len(imported), legacy, self.name))
+
+    def _load_legacy(self, source):
+        key = None
+        if isinstance(source, tuple):
+            source, key = source
+        if not dataIO.is_valid_json(source):
+            return None
+        data = dataIO.load_json(source)
+        if key is not None:
+            data = data.get(key, {})
+        return data
+
+    def _move_old_marker(self, marker):
+        # The marker used to be kept in global.json
+        filename = self._filename(None)
+        if not dataIO.is_valid_json(filename):
+            return False
+        data = dataIO.load_json(filename)
+        if "_imported_from" not in data:
+            return False
+        dataIO.save_json(marker, {"legacy": data.pop("_imported_from")})
+        dataIO.save_json(filename, data)
+        return True
+
+
+class GuildView:
+    """{guild id: data} mapping over one key of a namespace's guild files
+
+    Lets code written against the old {server id: data} json files keep
+    indexing by server. Like a defaultdict, a guild without the key gets
+    default() on first access. Edits are saved with namespace.save()"""
+
+    def __init__(self, namespace, key, default=dict):
+        self.namespace = namespace
+        self.key = key
+        self.default = default
+
+    def __getitem__(self, guild_id):
+        data = self.namespace.guild(guild_id)
+        if self.key not in data:
+            data[self.key] = self.default()
+        return data[self.key]
+
+    def __setitem__(self, guild_id, value):
+        self.namespace.set(guild_id, self.key, value)
+
+    def __contains__(self, guild_id):
+        return self.key in self.namespace.guild(guild_id)
+
+    def get(self, guild_id, default=None):
+        return self.namespace.get(guild_id, self.key, default)
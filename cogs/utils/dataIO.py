@@ -1,49 +1,341 @@
+import asyncio
+import functools
 import json
 import os
 import logging
+import threading
+import time
+from contextlib import contextmanager
 from random import randint
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Seconds the data parsed by is_valid_json is kept for the load_json that
+#   usually follows it
+VALIDATED_TTL = 30
+
+
 class InvalidFileIO(Exception):
     pass
 
 class DataIO():
     def __init__(self):
         self.logger = logging.getLogger("Chronoxia")
+        self.flush_interval = 5
+        self._dirty = {}        # filename: data waiting to be written
+        self._inflight = {}     # filename: payload the flusher is writing
+        self._generation = {}   # filename: last snapshot taken
+        self._written = {}      # filename: last snapshot that hit the disk
+        self._write_lock = threading.Lock()
+        self._flusher = None
+        self.lazy = False       # LazyJSON attributes load on first access
+        self.load_seconds = 0.0  # time spent parsing json, for profiling
+        self._validated = {}    # filename: (stat, data, expiry)
+        self._shard_root = None
+        self._shared_lock = None  # lock file taken by every shard to write
+        self._held = threading.local()  # how deep this thread holds it
+        self._base = {}         # filename: (stat, payload) last read/written
+        self._watchers = {}     # filename: [(owner, callback)]
+
+    def use_shard(self, shard_id):
+        """Runs this process as one of several shards
+
+        The json files stay in the shared data/ tree: a guild's files
+        are only written by the shard it belongs to, and a write to a
+        file every shard uses is merged with what the other shards
+        wrote since this one read it, under locked() (see merge()).
+        Files that belong to this process alone, like its logs and
+        caches, go where path() says."""
+        self._shard_root = os.path.join("data", "shards", str(shard_id))
+        os.makedirs(self._shard_root, exist_ok=True)
+        self._shared_lock = os.path.join("data", "shards", "json.lock")
+
+    def path(self, filename):
+        """Where this process keeps its own filename under data/
+
+        That's data/shards/<shard_id>/ under sharding"""
+        if self._shard_root is None:
+            return filename
+        parts = os.path.normpath(filename).split(os.sep)
+        if len(parts) < 2 or parts[0] != "data" or parts[1] == "shards":
+            return filename
+        mapped = os.path.join(self._shard_root, *parts[1:])
+        os.makedirs(os.path.dirname(mapped), exist_ok=True)
+        return mapped
+
+    def watch(self, filename, callback, owner=None):
+        """Calls callback() when another shard changed filename
+
+        The flusher checks every flush_interval, only under sharding.
+        It keeps calling it until this process reads the file again"""
+        self._watchers.setdefault(filename, []).append((owner, callback))
+
+    def watch_lazy(self, obj):
+        """Makes obj's LazyJSON attributes load again on their next
+        access once another shard changed their file"""
+        for cls in type(obj).__mro__:
+            for name, attr in vars(cls).items():
+                if isinstance(attr, LazyJSON):
+                    self.watch(attr.filename,
+                               functools.partial(obj.__dict__.pop, name,
+                                                 None), owner=obj)
+
+    def unwatch(self, owner):
+        """Removes the callbacks watch() registered for owner"""
+        for filename, watchers in list(self._watchers.items()):
+            watchers[:] = [w for w in watchers if w[0] is not owner]
+            if not watchers:
+                del self._watchers[filename]
 
     def save_json(self, filename, data):
         """Atomically saves json file"""
+        self._dirty.pop(filename, None)
+        self._inflight.pop(filename, None)  # Superseded
+        payload = self._dumps(data)
+        return self._write_atomic(filename, payload,
+                                  self._next_generation(filename),
+                                  verify=True)
+
+    def mark_dirty(self, filename, data):
+        """Schedules data to be written to filename by the flusher
+
+        Any further change made before the next flush is coalesced
+        into a single write. Falls back to save_json if the flusher
+        isn't running"""
+        if self._flusher is None or self._flusher.done():
+            return self.save_json(filename, data)
+        self._dirty[filename] = data
+        return True
+
+    def start_flusher(self, loop, interval=None):
+        """Starts the background task writing dirty files"""
+        if interval is not None:
+            self.flush_interval = interval
+        if self._flusher is None or self._flusher.done():
+            self._flusher = loop.create_task(self._flush_loop(loop))
+
+    def flush(self, filename=None):
+        """Synchronously writes pending files. Used on shutdown"""
+        if filename is not None:
+            if filename not in self._dirty:
+                return
+            pending = {filename: self._dirty.pop(filename)}
+        else:
+            pending, self._dirty = self._dirty, {}
+        for filename, data in pending.items():
+            try:
+                payload = self._dumps(data)
+            except (TypeError, ValueError):
+                self.logger.exception("Could not serialize {}, the file on "
+                                      "disk is unaltered".format(filename))
+                continue
+            self._inflight.pop(filename, None)  # Superseded
+            self._write_atomic(filename, payload,
+                               self._next_generation(filename))
+
+    async def _flush_loop(self, loop):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            pending, self._dirty = self._dirty, {}
+            writes = []
+            for filename, data in pending.items():
+                # Serializing happens on the loop so that the snapshot
+                # is consistent, only the disk I/O goes to the executor
+                try:
+                    payload = self._dumps(data)
+                except (TypeError, ValueError):
+                    self.logger.exception("Could not serialize {}, the file "
+                                          "on disk is unaltered"
+                                          "".format(filename))
+                    continue
+                # Until it's on disk load_json reads it from here
+                self._inflight[filename] = payload
+                writes.append((filename, data, payload,
+                               self._next_generation(filename)))
+            for filename, data, payload, generation in writes:
+                try:
+                    await loop.run_in_executor(None, self._write_atomic,
+                                               filename, payload, generation)
+                except OSError:
+                    self.logger.exception("Write-behind flush of {} failed"
+                                          "".format(filename))
+                    self._dirty.setdefault(filename, data)
+                finally:
+                    if self._inflight.get(filename) is payload:
+                        del self._inflight[filename]
+            if self._shard_root is not None:
+                self._check_watched()
+
+    def _check_watched(self):
+        for filename, watchers in list(self._watchers.items()):
+            base = self._base.get(filename)
+            if base is None:
+                continue  # Not read yet
+            try:
+                if self._stat(filename) == base[0]:
+                    continue
+            except FileNotFoundError:
+                continue
+            for owner, callback in list(watchers):
+                try:
+                    callback()
+                except Exception:
+                    self.logger.exception("Reloading {} after another "
+                                          "shard changed it failed"
+                                          "".format(filename))
+
+    def _next_generation(self, filename):
+        generation = self._generation.get(filename, 0) + 1
+        self._generation[filename] = generation
+        return generation
+
+    def _write_atomic(self, filename, payload, generation, verify=False):
+        # The shared lock first, the thread holding it may be waiting for
+        #   the write lock
+        with self.locked(), self._write_lock:
+            if generation < self._written.get(filename, 0):
+                # A newer snapshot has already been written
+                return True
+            if self._shared_lock is None:
+                return self._replace(filename, payload, generation, verify)
+            written = self._merge_shared(filename, payload)
+            if not self._replace(filename, written, generation, verify):
+                return False
+            # After a merge the file has changes this process hasn't read
+            #   yet, a stat that can't match keeps it that way
+            stat = self._stat(filename) if written is payload else None
+            self._base[filename] = (stat, payload)
+            return True
+
+    def _replace(self, filename, payload, generation, verify):
         rnd = randint(1000, 9999)
         path, ext = os.path.splitext(filename)
         tmp_file = "{}-{}.tmp".format(path, rnd)
-        self._save_json(tmp_file, data)
-        try:
-            self._read_json(tmp_file)
-        except json.decoder.JSONDecodeError:
-            self.logger.exception("Attempted to write file {} but JSON "
-                                  "integrity check on tmp file has failed. "
-                                  "The original file is unaltered."
-                                  "".format(filename))
-            return False
+        with open(tmp_file, encoding='utf-8', mode="w") as f:
+            f.write(payload)
+        if verify:
+            try:
+                self._read_json(tmp_file, track=False)
+            except json.decoder.JSONDecodeError:
+                self.logger.exception("Attempted to write file {} but "
+                                      "JSON integrity check on tmp file "
+                                      "has failed. The original file is "
+                                      "unaltered.".format(filename))
+                return False
         os.replace(tmp_file, filename)
+        self._written[filename] = generation
         return True
 
+    @contextmanager
+    def locked(self):
+        """Holds the lock every shard takes to write json files
+
+        Lets a shard check a file and write it without another shard
+        writing in between. Does nothing without sharding"""
+        depth = getattr(self._held, "depth", 0)
+        self._held.depth = depth + 1
+        try:
+            if self._shared_lock is None or depth:
+                yield
+                return
+            with open(self._shared_lock, mode="a+") as f:
+                f.seek(0)
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                else:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                    else:
+                        f.seek(0)
+                        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._held.depth = depth
+
+    def _merge_shared(self, filename, payload):
+        """The payload to write to filename, with the changes another
+        shard made to it since this process read it. Called holding
+        the shared lock
+
+        Only what this process changed since it read the file is
+        applied to the file's current contents (see merge)"""
+        base = self._base.get(filename)
+        if base is None:
+            return payload
+        try:
+            if self._stat(filename) == base[0]:
+                return payload
+            theirs = self._read_json(filename, track=False)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return payload
+        merged = merge(theirs, json.loads(payload), json.loads(base[1]))
+        return self._dumps(merged)
+
     def load_json(self, filename):
         """Loads json file"""
+        self.flush(filename)
+        payload = self._inflight.get(filename)
+        if payload is not None:
+            # Newer than the file, the flusher is still writing it
+            self._validated.pop(filename, None)
+            return json.loads(payload)
+        validated = self._validated.pop(filename, None)
+        if validated is not None and validated[0] == self._stat(filename) \
+                and validated[2] > time.monotonic():
+            return validated[1]
         return self._read_json(filename)
 
     def is_valid_json(self, filename):
-        """Verifies if json file exists / is readable"""
+        """Verifies if json file exists / is readable
+
+        The parsed data is kept for VALIDATED_TTL seconds, for the
+        load_json that usually follows"""
+        now = time.monotonic()
+        for name in [n for n, v in self._validated.items() if v[2] <= now]:
+            del self._validated[name]
         try:
-            self._read_json(filename)
+            stat = self._stat(filename)
+            self._validated[filename] = (stat, self._read_json(filename),
+                                         now + VALIDATED_TTL)
             return True
         except FileNotFoundError:
             return False
         except json.decoder.JSONDecodeError:
             return False
 
-    def _read_json(self, filename):
-        with open(filename, encoding='utf-8', mode="r") as f:
-            data = json.load(f)
+    def preload(self, obj):
+        """Loads every LazyJSON attribute of obj now"""
+        for cls in type(obj).__mro__:
+            for name, attr in vars(cls).items():
+                if isinstance(attr, LazyJSON):
+                    getattr(obj, name)
+
+    def _stat(self, filename):
+        st = os.stat(filename)
+        return st.st_mtime_ns, st.st_size
+
+    def _read_json(self, filename, track=True):
+        start = time.perf_counter()
+        try:
+            with open(filename, encoding='utf-8', mode="r") as f:
+                if self._shard_root is None or not track:
+                    data = json.load(f)
+                else:
+                    # Kept to merge this process' next write with
+                    stat = os.fstat(f.fileno())
+                    payload = f.read()
+                    data = json.loads(payload)
+                    self._base[filename] = ((stat.st_mtime_ns, stat.st_size),
+                                            payload)
+        finally:
+            self.load_seconds += time.perf_counter() - start
         return data
 
     def _save_json(self, filename, data):
@@ -52,6 +344,10 @@ class DataIO():
                 separators=(',',' : '))
         return data
 
+    def _dumps(self, data):
+        return json.dumps(data, indent=4, sort_keys=True,
+                          separators=(',', ' : '))
+
     def _legacy_fileio(self, filename, IO, data=None):
         """Old fileIO provided for backwards compatibility"""
         if IO == "save" and data != None:
@@ -64,6 +360,39 @@ class DataIO():
             raise InvalidFileIO("FileIO was called with invalid"
                 " parameters")
 
+_MISSING = object()
+
+
+def merge(theirs, ours, base):
+    """Three-way merge of json data: ours' changes since base applied
+    to theirs
+
+    Dicts are merged key by key. Items ours added to or removed from a
+    list are added to or removed from theirs. For anything else, ours
+    wins over a conflicting change. _MISSING stands for a missing key"""
+    if ours == base:
+        return theirs
+    if theirs == base or theirs is _MISSING:
+        return ours
+    if isinstance(ours, dict) and isinstance(theirs, dict):
+        base = base if isinstance(base, dict) else {}
+        merged = dict(theirs)
+        for key in set(ours) | set(base):
+            value = merge(theirs.get(key, _MISSING), ours.get(key, _MISSING),
+                          base.get(key, _MISSING))
+            if value is _MISSING:
+                merged.pop(key, None)
+            else:
+                merged[key] = value
+        return merged
+    if isinstance(ours, list) and isinstance(theirs, list):
+        base = base if isinstance(base, list) else []
+        merged = [v for v in theirs if v in ours or v not in base]
+        merged += [v for v in ours if v not in base and v not in theirs]
+        return merged
+    return ours
+
+
 def get_value(filename, key):
     with open(filename, encoding='utf-8', mode="r") as f:
         data = json.load(f)
@@ -75,5 +404,36 @@ def set_value(filename, key, value):
     fileIO(filename, "save", data)
     return True
 
+class LazyJSON:
+    """Cog attribute that is loaded from a json file on first access
+
+        whitelist = LazyJSON("data/mod/whitelist.json", convert=set)
+
+    convert is applied to the loaded data and after names a method
+    called once it's in place. Unless dataIO.lazy is set the bot
+    preloads these when the cog is added, so only startup order
+    changes"""
+
+    def __init__(self, filename, *, convert=None, after=None):
+        self.filename = filename
+        self.convert = convert
+        self.after = after
+        self.name = None
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if self.name is None:
+            self.name = next(k for c in owner.__mro__
+                             for k, v in vars(c).items() if v is self)
+        value = dataIO.load_json(self.filename)
+        if self.convert is not None:
+            value = self.convert(value)
+        instance.__dict__[self.name] = value
+        if self.after is not None:
+            getattr(instance, self.after)()
+        return value
+
+
 dataIO = DataIO()
 fileIO = dataIO._legacy_fileio # backwards compatibility
@@ -0,0 +1,147 @@
+from collections import namedtuple
+import re
+
+# A message that starts with one of the server's prefixes, parsed once.
+# `invoker` is the command word (whitespace delimited, like discord.py's
+# StringView) and `command` the built-in it names. `alias` and `custom` are
+# the matching alias expansion / custom command text. Misses are None.
+Route = namedtuple("Route", "content prefix invoker command alias custom")
+
+_WORD = re.compile(r"\S*")
+_END = object()
+_NOTHING = {}  # Never written to
+
+
+class PrefixTrie:
+    """Matches the first listed prefix a string starts with in one pass"""
+
+    def __init__(self, prefixes):
+        self.root = {}
+        for index, prefix in enumerate(prefixes):
+            node = self.root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node.setdefault(_END, (index, prefix))
+
+    def match(self, text):
+        node = self.root
+        best = node.get(_END)
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            found = node.get(_END)
+            if found is not None and (best is None or found[0] < best[0]):
+                best = found
+        return best[1] if best is not None else None
+
+
+class Dispatcher:
+    """Per-server prefix and invocation-name index for incoming messages
+
+    Cogs that react to prefixed messages register a source (server id ->
+    {name: value}) and a handler coroutine. The bot parses each message
+    once and routes it to the handlers whose name table matched.
+
+    Built-in commands are in one table shared by every server, a server
+    only has its own table for the names its sources add."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._tries = {}
+        self._commands = None  # {name: {"command": command}}
+        self._tables = {}  # server id: {name: {kind: value}}
+        self._sources = {}
+        self._handlers = {}
+
+    def register(self, kind, source, handler):
+        self._sources[kind] = source
+        self._handlers[kind] = handler
+        self.invalidate()
+
+    def unregister(self, kind):
+        self._sources.pop(kind, None)
+        self._handlers.pop(kind, None)
+        self.invalidate()
+
+    def invalidate(self, server_id=None):
+        if server_id is None:
+            self._commands = None
+            self._tables.clear()
+        else:
+            self._tables.pop(server_id, None)
+
+    def get_trie(self, prefixes):
+        key = tuple(prefixes)
+        trie = self._tries.get(key)
+        if trie is None:
+            if len(self._tries) > 1024:
+                self._tries.clear()
+            trie = self._tries[key] = PrefixTrie(key)
+        return trie
+
+    def get_commands(self):
+        if self._commands is None:
+            self._commands = {name: {"command": command}
+                              for name, command in self.bot.commands.items()}
+        return self._commands
+
+    def get_table(self, server_id):
+        """The server's own names, entries also hold the built-in command
+        of the same name"""
+        table = self._tables.get(server_id)
+        if table is None:
+            commands = self.get_commands()
+            table = {}
+            for kind, source in self._sources.items():
+                for name, value in source(server_id).items():
+                    if name not in table:
+                        table[name] = dict(commands.get(name, {}))
+                    table[name][kind] = value
+            self._tables[server_id] = table
+        return table
+
+    def lookup(self, server_id, name):
+        """Everything name stands for on the server"""
+        entry = self.get_table(server_id).get(name)
+        if entry is None:
+            entry = self.get_commands().get(name, _NOTHING)
+        return entry
+
+    def parse(self, message):
+        """Returns a Route for the message, or None if it isn't prefixed"""
+        server = message.server
+        content = message.content
+        prefix = self.get_trie(
+            self.bot.settings.get_prefixes(server)).match(content)
+        if prefix is None:
+            return None
+        rest = content[len(prefix):]
+        invoker = _WORD.match(rest).group()
+        if server is None:
+            return Route(content, prefix, invoker,
+                         self.bot.commands.get(invoker), None, None)
+        sid = server.id
+        command = self.lookup(sid, invoker).get("command")
+        alias = self.lookup(sid, rest.split(" ", 1)[0].lower()).get("alias")
+        custom = self.lookup(sid, rest).get("customcom")
+        if custom is None:
+            custom = self.lookup(sid, rest.lower()).get("customcom")
+        return Route(content, prefix, invoker, command, alias, custom)
+
+    def rewrite(self, route, content):
+        """Route for content that keeps the prefix of an existing route"""
+        invoker = _WORD.match(content, len(route.prefix)).group()
+        return Route(content, route.prefix, invoker,
+                     self.bot.commands.get(invoker), None, None)
+
+    async def dispatch(self, message, route):
+        metrics = self.bot.metrics
+        if route.alias is not None and "alias" in self._handlers:
+            with metrics.time("listener_seconds", ("listener", "alias")):
+                await self._handlers["alias"](message, route)
+        if route.custom is not None and "customcom" in self._handlers:
+            with metrics.time("listener_seconds", ("listener", "customcom")):
+                await self._handlers["customcom"](message, route)
+        await self.bot.process_commands(message, route)
+
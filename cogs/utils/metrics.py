@@ -0,0 +1,176 @@
+from bisect import bisect_left
+from collections import Counter
+import asyncio
+import logging
+import os
+import time
+
+log = logging.getLogger("chronoxia.metrics")
+
+# Upper bounds in seconds, Prometheus style. The last bucket is +Inf.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Fixed-bucket histogram, cheap enough to observe on every message"""
+
+    __slots__ = ("buckets", "counts", "sum", "count", "max")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metrics:
+    """Counters, gauges and latency histograms for the running bot
+
+    Histograms are keyed by name and an optional (key, value) label, e.g.
+    ("command_seconds", ("command", "ping")). Gauges are callables sampled
+    when the metrics are read."""
+
+    def __init__(self, prefix="chronoxia"):
+        self.prefix = prefix
+        self.counters = Counter()
+        self.gauges = {}
+        self.histograms = {}
+
+    def histogram(self, name, label=None):
+        key = (name, label)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return histogram
+
+    def observe(self, name, value, label=None):
+        self.histogram(name, label).observe(value)
+
+    def time(self, name, label=None):
+        """Context manager that observes the time spent in its block"""
+        return _Timer(self.histogram(name, label))
+
+    def add_gauge(self, name, func):
+        self.gauges[name] = func
+
+    def remove_gauge(self, name):
+        self.gauges.pop(name, None)
+
+    def sample_gauges(self):
+        values = {}
+        for name, func in self.gauges.items():
+            try:
+                values[name] = float(func())
+            except Exception:
+                log.exception("Gauge '{}' failed".format(name))
+        return values
+
+    def render(self):
+        """Prometheus text exposition format"""
+        p = self.prefix
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append("# TYPE {}_{} counter".format(p, name))
+            lines.append("{}_{} {}".format(p, name, value))
+        for name, value in sorted(self.sample_gauges().items()):
+            lines.append("# TYPE {}_{} gauge".format(p, name))
+            lines.append("{}_{} {}".format(p, name, value))
+        typed = set()
+        for (name, label), h in sorted(self.histograms.items(),
+                                       key=lambda i: (i[0][0],
+                                                      i[0][1] or ())):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {}_{} histogram".format(p, name))
+            label = _label(label)
+            seen = 0
+            for bound, n in zip(h.buckets + ("+Inf",), h.counts):
+                seen += n
+                lines.append('{}_{}_bucket{{{}le="{}"}} {}'.format(
+                    p, name, label + "," if label else "", bound, seen))
+            suffix = "{" + label + "}" if label else ""
+            lines.append("{}_{}_sum{} {}".format(p, name, suffix, h.sum))
+            lines.append("{}_{}_count{} {}".format(p, name, suffix, h.count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Short human readable table for chat"""
+        lines = ["{:<32} {}".format(k, v)
+                 for k, v in sorted(self.counters.items())]
+        lines += ["{:<32} {:g}".format(k, v)
+                  for k, v in sorted(self.sample_gauges().items())]
+        if self.histograms:
+            lines.append("")
+            lines.append("{:<40} {:>7} {:>8} {:>8} {:>8}".format(
+                "latency (ms)", "count", "avg", "p95", "max"))
+        for (name, label), h in sorted(self.histograms.items(),
+                                       key=lambda i: (i[0][0],
+                                                      i[0][1] or ())):
+            if not h.count:
+                continue
+            key = name if label is None else "{}[{}]".format(name, label[1])
+            lines.append("{:<40} {:>7} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+                key[:40], h.count, h.sum / h.count * 1000,
+                h.quantile(0.95) * 1000, h.max * 1000))
+        return "\n".join(lines)
+
+    def write(self, filename, text=None):
+        if text is None:
+            text = self.render()
+        tmp = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, filename)
+
+    async def write_loop(self, loop, filename, interval):
+        """Periodically writes render() to filename, off the event loop"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                text = self.render()
+                await loop.run_in_executor(None, self.write, filename, text)
+            except Exception:
+                log.exception("Failed to write metrics to " + filename)
+
+
+def _label(label):
+    if label is None:
+        return ""
+    key, value = label
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return '{}="{}"'.format(key, value)
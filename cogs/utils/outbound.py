@@ -0,0 +1,105 @@
+from collections import deque
+import asyncio
+import logging
+import time
+
+log = logging.getLogger("chronoxia.outbound")
+
+MESSAGE_LIMIT = 2000
+# Discord lets a bot post 5 messages per 5 seconds in the same channel
+CHANNEL_BUCKET = (5, 5.0)
+
+
+class _Channel:
+    __slots__ = ("destination", "pending", "sent", "worker")
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.pending = deque()      # (content, future)
+        self.sent = deque()         # send times inside the bucket window
+        self.worker = None
+
+
+class OutboundQueue:
+    """Per-channel queue for plain-text messages
+
+    Messages queued for the same channel while an earlier one waits for
+    the rate limit are joined with newlines, up to 2000 characters, and
+    posted as one message through bot.send_message, so modifiers run
+    once per merged payload. Every caller gets the Message its content
+    ended up in."""
+
+    def __init__(self, bot, bucket=CHANNEL_BUCKET):
+        self.bot = bot
+        self.bucket = bucket
+        self._channels = {}
+
+    def send(self, destination, content):
+        """Queues content, returns a future for the resulting Message"""
+        key = getattr(destination, "id", destination)
+        channel = self._channels.get(key)
+        if channel is None:
+            channel = self._channels[key] = _Channel(destination)
+        future = self.bot.loop.create_future()
+        channel.pending.append((str(content), future))
+        if channel.worker is None or channel.worker.done():
+            channel.worker = self.bot.loop.create_task(self._drain(key))
+        return future
+
+    def _take_batch(self, channel):
+        content, future = channel.pending.popleft()
+        batch = [future]
+        while channel.pending:
+            following = channel.pending[0][0]
+            if len(content) + 1 + len(following) > MESSAGE_LIMIT:
+                break
+            content += "\n" + following
+            batch.append(channel.pending.popleft()[1])
+        return content, batch
+
+    async def _wait_for_bucket(self, channel):
+        limit, per = self.bucket
+        while True:
+            now = time.monotonic()
+            while channel.sent and now - channel.sent[0] >= per:
+                channel.sent.popleft()
+            if len(channel.sent) < limit:
+                channel.sent.append(now)
+                return
+            await asyncio.sleep(per - (now - channel.sent[0]))
+
+    def _prune(self, key):
+        """Forgets a channel that's been idle for a whole bucket window"""
+        channel = self._channels.get(key)
+        if channel is not None and not channel.pending and \
+                (channel.worker is None or channel.worker.done()):
+            del self._channels[key]
+
+    async def _drain(self, key):
+        channel = self._channels[key]
+        try:
+            await self._drain_channel(channel)
+        finally:
+            # Once its sends are outside the window nothing is left to
+            #   remember about the channel
+            self.bot.loop.call_later(self.bucket[1], self._prune, key)
+
+    async def _drain_channel(self, channel):
+        while channel.pending:
+            await self._wait_for_bucket(channel)
+            content, batch = self._take_batch(channel)
+            counters = self.bot.counter
+            counters["outbound_messages_queued"] += len(batch)
+            counters["outbound_messages_sent"] += 1
+            try:
+                message = await self.bot.send_message(channel.destination,
+                                                      content)
+            except Exception as e:
+                for future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future in batch:
+                    if not future.done():
+                        future.set_result(message)
+
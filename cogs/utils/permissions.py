@@ -0,0 +1,104 @@
+USER = 0
+MOD = 1
+ADMIN = 2
+OWNER = 3
+
+
+class PermissionResolver:
+    """Caches each member's tier and checks the bot-wide ignore lists
+
+    Tiers are cached per (server, member) together with the admin/mod role
+    names they were resolved against, so changing those names in settings
+    invalidates them on the next lookup. Role and member events drop the
+    affected entries. The blacklist, whitelist and ignore sets are read
+    from the Mod cog; while Mod isn't loaded everyone is allowed."""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self._tiers = {}
+        self._lists = None
+
+    def attach_lists(self, cog):
+        self._lists = cog
+
+    def detach_lists(self):
+        self._lists = None
+
+    def invalidate(self, server_id=None, member_id=None):
+        if server_id is None:
+            self._tiers.clear()
+        elif member_id is None:
+            self._tiers.pop(server_id, None)
+        elif server_id in self._tiers:
+            self._tiers[server_id].pop(member_id, None)
+
+    def _resolve(self, member, server):
+        """Returns (tier, case insensitive tier) of a member, cached"""
+        admin = self.settings.get_server_admin(server)
+        mod = self.settings.get_server_mod(server)
+        members = self._tiers.setdefault(server.id, {})
+        cached = members.get(member.id)
+        if cached is not None and cached[0] == admin and cached[1] == mod:
+            return cached[2]
+        admin_ci, mod_ci = admin.lower(), mod.lower()
+        tier = tier_ci = USER
+        for role in getattr(member, "roles", ()):
+            name = role.name
+            if name == admin:
+                tier = ADMIN
+            elif name == mod and tier < MOD:
+                tier = MOD
+            name = name.lower()
+            if name == admin_ci:
+                tier_ci = ADMIN
+            elif name == mod_ci and tier_ci < MOD:
+                tier_ci = MOD
+        members[member.id] = (admin, mod, (tier, tier_ci))
+        return tier, tier_ci
+
+    def tier(self, member, server, *, ignore_case=False):
+        if member.id == self.settings.owner:
+            return OWNER
+        if server is None:
+            return USER
+        return self._resolve(member, server)[ignore_case]
+
+    def user_allowed(self, message):
+        """The list part of Bot.user_allowed"""
+        lists = self._lists
+        if lists is None:
+            return True
+        author = message.author
+        private = message.channel.is_private
+        if author.id == self.settings.owner:
+            return True
+        if not private and self.tier(author, message.server) >= MOD:
+            return True
+        if author.id in lists.blacklist_list:
+            return False
+        if lists.whitelist_list and author.id not in lists.whitelist_list:
+            return False
+        if not private:
+            ignore_list = lists.ignore_list
+            if message.server.id in ignore_list["SERVERS"]:
+                return False
+            if message.channel.id in ignore_list["CHANNELS"]:
+                return False
+        return True
+
+    async def on_member_update(self, before, after):
+        if before.roles != after.roles:
+            self.invalidate(after.server.id, after.id)
+
+    async def on_member_remove(self, member):
+        self.invalidate(member.server.id, member.id)
+
+    async def on_server_role_update(self, before, after):
+        if before.name != after.name:
+            self.invalidate(after.server.id)
+
+    async def on_server_role_delete(self, role):
+        self.invalidate(role.server.id)
+
+    async def on_server_remove(self, server):
+        self.invalidate(server.id)
@@ -12,6 +12,17 @@ class Settings:
 
     def __init__(self, path=default_path, parse_args=True):
         self.path = path
+        self.shard_id = None
+        self.shard_count = 1
+        args = self.get_parser().parse_args() if parse_args else None
+        if args is not None and args.shard_count > 1:
+            if not 0 <= args.shard_id < args.shard_count:
+                self.get_parser().error("--shard-id must be between 0 and "
+                                        "--shard-count - 1")
+            # Must happen before any data file is read
+            self.shard_id = args.shard_id
+            self.shard_count = args.shard_count
+            dataIO.use_shard(self.shard_id)
         self.check_folders()
         self.default_settings = {
             "TOKEN": None,
@@ -45,9 +56,11 @@ class Settings:
         if "LOGIN_TYPE" in self.bot_settings:
             self.update_old_settings_v2()
         if parse_args:
-            self.parse_cmd_arguments()
+            self.parse_cmd_arguments(args)
+        if self.shard_id is not None and not self._memory_only:
+            dataIO.watch(self.path, self._settings_changed, owner=self)
 
-    def parse_cmd_arguments(self):
+    def get_parser(self):
         parser = argparse.ArgumentParser(description="Chronoxia - Discord Bot")
         parser.add_argument("--owner", help="ID of the owner. Only who hosts "
                                             "Chronoxia should be owner, this has "
@@ -80,8 +93,32 @@ class Settings:
         parser.add_argument("--debug",
                             action="store_true",
                             help="Enables debug mode")
-
-        args = parser.parse_args()
+        parser.add_argument("--log-json",
+                            action="store_true",
+                            help="Also writes the log as JSON lines to "
+                                 "data/chronoxia/chronoxia.jsonl")
+        parser.add_argument("--lazy-cogs",
+                            action="store_true",
+                            help="Defers loading the cogs' data files until "
+                                 "they are first used")
+        parser.add_argument("--profile-startup",
+                            action="store_true",
+                            help="Prints how long each cog took to import, "
+                                 "load its json files and set up. Can be "
+                                 "combined with --dry-run")
+        parser.add_argument("--shard-id", type=int, default=0,
+                            help="Shard run by this process, from 0 to "
+                                 "shard count - 1")
+        parser.add_argument("--shard-count", type=int, default=1,
+                            help="Total number of shards. With more than "
+                                 "one, the shards share the data folder and "
+                                 "each keeps its logs and caches in "
+                                 "data/shards/<shard id>")
+        return parser
+
+    def parse_cmd_arguments(self, args=None):
+        if args is None:
+            args = self.get_parser().parse_args()
 
         if args.owner:
             self.owner = args.owner
@@ -97,7 +134,10 @@ class Settings:
         self._memory_only = args.memory_only
         self._no_cogs = args.no_cogs
         self.debug = args.debug
+        self.log_json = args.log_json
         self._dry_run = args.dry_run
+        self._lazy_cogs = args.lazy_cogs
+        self._profile_startup = args.profile_startup
 
         self.save_settings()
 
@@ -112,6 +152,11 @@ class Settings:
         if not self._memory_only:
             dataIO.save_json(self.path, self.bot_settings)
 
+    def _settings_changed(self):
+        # Another shard saved them, e.g. after [p]set prefix
+        self.bot_settings.clear()
+        self.bot_settings.update(dataIO.load_json(self.path))
+
     def update_old_settings_v1(self):
         # This converts the old settings format
         mod = self.bot_settings["MOD_ROLE"]
@@ -14,6 +14,8 @@ import argparse
 import shutil
 import stat
 import time
+import json
+import collections
 try:
     import pip
 except ImportError:
@@ -35,6 +37,12 @@ IS_64BIT = platform.machine().endswith("64")
 INTERACTIVE_MODE = not len(sys.argv) > 1  # CLI flags = non-interactive
 PYTHON_OK = sys.version_info >= (3, 5)
 
+SHARD_BACKOFF_MAX = 300       # Seconds between restarts of a crashing shard
+SHARD_STABLE_AFTER = 600      # Uptime after which a shard's backoff resets
+SHARD_STALE_AFTER = 180       # Metrics older than this flag a shard
+SHARD_HEALTH_FILE = os.path.join("data", "shards", "health.json")
+METRICS_FILE = os.path.join("data", "chronoxia", "metrics.prom")
+
 FFMPEG_FILES = {
     "ffmpeg.exe"  : "e0d60f7c0d27ad9d7472ddf13e78dc89",
     "ffplay.exe"  : "d100abe8281cbcc3e6aebe550c675e09",
@@ -62,6 +70,10 @@ def parse_cli_arguments():
     parser.add_argument("--repair",
                         help="Issues a git reset --hard",
                         action="store_true")
+    parser.add_argument("--shards",
+                        help="Starts this many Chronoxia processes, one "
+                             "per shard, and supervises them",
+                        type=int, default=1)
     return parser.parse_args()
 
 
@@ -356,7 +368,7 @@ def maintenance_menu():
         clear_screen()
 
 
-def run_Chronoxia(autorestart):
+def run_Chronoxia(autorestart, shards=1):
     interpreter = sys.executable
 
     if interpreter is None: # This should never happen
@@ -368,6 +380,13 @@ def run_Chronoxia(autorestart):
         if not INTERACTIVE_MODE:
             exit(1)
 
+    if shards > 1:
+        code = supervise_shards(interpreter, shards, autorestart)
+        print("Chronoxia's shards have been terminated. Exit code: %d" % code)
+        if INTERACTIVE_MODE:
+            wait()
+        return
+
     cmd = (interpreter, "chronoxia.py")
 
     while True:
@@ -392,6 +411,189 @@ def run_Chronoxia(autorestart):
         wait()
 
 
+class Shard:
+    """One chronoxia.py process and its restart bookkeeping"""
+
+    def __init__(self, shard_id, shard_count, interpreter):
+        self.id = shard_id
+        self.cmd = (interpreter, "chronoxia.py", "--no-prompt",
+                    "--shard-id", str(shard_id),
+                    "--shard-count", str(shard_count))
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.failures = 0
+        self.last_exit = None
+        self.restart_at = None   # When a crashed shard is due to restart
+        self.metrics = os.path.join("data", "shards", str(shard_id),
+                                    "chronoxia", "metrics.prom")
+
+    def start(self):
+        self.process = subprocess.Popen(self.cmd)
+        self.started = time.time()
+        self.restart_at = None
+
+    def status(self):
+        if self.process is not None and self.process.poll() is None:
+            return "running"
+        if self.restart_at is not None:
+            return "backoff"
+        return "stopped"
+
+    def health(self):
+        try:
+            metrics_age = time.time() - os.path.getmtime(self.metrics)
+        except OSError:
+            metrics_age = None
+        status = self.status()
+        if status == "running" and metrics_age is not None and \
+                metrics_age > SHARD_STALE_AFTER and \
+                time.time() - self.started > SHARD_STALE_AFTER:
+            status = "stale"
+        return {
+            "status": status,
+            "pid": self.process.pid if self.process else None,
+            "uptime": round(time.time() - self.started)
+            if status in ("running", "stale") else 0,
+            "restarts": self.restarts,
+            "last_exit": self.last_exit,
+            "metrics_age": round(metrics_age)
+            if metrics_age is not None else None
+        }
+
+
+def supervise_shards(interpreter, shard_count, autorestart):
+    """
+    Runs one process per shard. A shard that exits with 26 is restarted
+    right away, one that crashes is restarted with an exponential backoff
+    if autorestart is set, and exit code 0 (shutdown) stops all of them.
+    Health is written to data/shards/health.json and the shards' metrics
+    are merged into data/chronoxia/metrics.prom with a shard label.
+    """
+    shards = [Shard(i, shard_count, interpreter) for i in range(shard_count)]
+    for shard in shards:
+        print("Starting shard {}/{}...".format(shard.id, shard_count))
+        shard.start()
+
+    code = 0
+    next_report = 0
+    try:
+        while True:
+            now = time.time()
+            for shard in shards:
+                if shard.status() == "backoff" and now >= shard.restart_at:
+                    print("Restarting shard {}...".format(shard.id))
+                    shard.restarts += 1
+                    shard.start()
+                    continue
+                if shard.process is None or shard.restart_at is not None:
+                    continue
+                exit_code = shard.process.poll()
+                if exit_code is None:
+                    continue
+                shard.process = None
+                shard.last_exit = exit_code
+                if exit_code == 0:
+                    print("Shard {} was shut down, stopping all shards"
+                          "".format(shard.id))
+                    return stop_shards(shards)
+                elif exit_code == 26:
+                    shard.restart_at = now
+                elif autorestart:
+                    if now - shard.started > SHARD_STABLE_AFTER:
+                        shard.failures = 0
+                    delay = min(SHARD_BACKOFF_MAX, 2 ** shard.failures)
+                    shard.failures += 1
+                    shard.restart_at = now + delay
+                    print("Shard {} exited with code {}, restarting in {}s"
+                          "".format(shard.id, exit_code, delay))
+                else:
+                    print("Shard {} exited with code {}".format(shard.id,
+                                                                exit_code))
+                    code = exit_code
+            if all(s.status() == "stopped" for s in shards):
+                return code
+            if now >= next_report:
+                write_shard_health(shards)
+                next_report = now + 5
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        return stop_shards(shards)
+
+
+def stop_shards(shards, timeout=30):
+    for shard in shards:
+        shard.restart_at = None
+        if shard.process is not None and shard.process.poll() is None:
+            shard.process.terminate()
+    deadline = time.time() + timeout
+    for shard in shards:
+        if shard.process is None:
+            continue
+        try:
+            shard.process.wait(max(0, deadline - time.time()))
+        except subprocess.TimeoutExpired:
+            shard.process.kill()
+            shard.process.wait()
+        shard.last_exit = shard.process.returncode
+    write_shard_health(shards)
+    return 0
+
+
+def write_shard_health(shards):
+    health = {str(s.id): s.health() for s in shards}
+    # Prometheus wants all samples of a metric family together, under a
+    #   single # HELP / # TYPE header
+    headers = collections.OrderedDict()  # family: header lines
+    samples = collections.defaultdict(list)  # family: sample lines
+    for shard in shards:
+        try:
+            with open(shard.metrics, encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        family = None
+        for line in lines:
+            if line.startswith("#"):
+                parts = line.split(" ", 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = parts[2]
+                    header = headers.setdefault(family, [])
+                    if not any(h.split(" ", 2)[1] == parts[1]
+                               for h in header):
+                        header.append(line)
+                continue
+            if not line:
+                continue
+            label = 'shard="{}"'.format(shard.id)
+            name, value = line.rsplit(" ", 1)
+            base = name.split("{", 1)[0]
+            if family is None or (base != family and
+                                  not base.startswith(family + "_")):
+                family = base  # A sample without a header
+                headers.setdefault(family, [])
+            if name.endswith("}"):
+                name = name.replace("{", "{" + label + ",", 1)
+            else:
+                name = name + "{" + label + "}"
+            samples[family].append(name + " " + value)
+    merged = []
+    for family, header in headers.items():
+        merged.extend(sorted(header))  # HELP before TYPE
+        merged.extend(samples[family])
+    for filename, text in ((SHARD_HEALTH_FILE,
+                            json.dumps(health, indent=4, sort_keys=True)),
+                           (METRICS_FILE, "\n".join(merged) + "\n")):
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            tmp = filename + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp, filename)
+        except OSError as e:
+            print("Couldn't write {}: {}".format(filename, e))
+
+
 def clear_screen():
     if IS_WINDOWS:
         os.system("cls")
@@ -570,4 +772,4 @@ if __name__ == '__main__':
         main()
     elif args.start:
         print("Starting Chronoxia...")
-        run_Chronoxia(autorestart=args.auto_restart)
+        run_Chronoxia(autorestart=args.auto_restart, shards=args.shards)
@@ -0,0 +1,117 @@
+"""Messages per second routed by the old per-listener prefix loops and by
+cogs.utils.dispatch.Dispatcher, on synthetic traffic.
+
+    python tools/bench_dispatch.py [messages]
+"""
+import copy
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cogs.utils.dispatch import Dispatcher, _WORD  # noqa: E402
+
+
+class _Fake:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+def benchmark(messages=20000, rounds=5):
+    """Messages per second routed by the three per-path prefix loops the
+    dispatcher replaced and by Dispatcher, best of rounds. The traffic is 70%
+    chatter, 20% built-ins, 5% aliases and 5% custom commands, with 3
+    prefixes and 200 built-ins. Blocking"""
+    rng = random.Random(1)
+    # deepcopying a discord.Message copies its server and members too
+    server = _Fake(id="1", members=[_Fake(id=str(i), name="u{}".format(i))
+                                    for i in range(50)])
+    channel = _Fake(id="2", is_private=False, server=server)
+    author = _Fake(id="3", bot=False)
+    prefixes = ["!", "chrono ", "c!"]
+    commands = {"cmd{}".format(i): object() for i in range(200)}
+    aliases = {"al{}".format(i): "cmd{} foo".format(i) for i in range(50)}
+    customs = {"cc{}".format(i): "text {}".format(i) for i in range(100)}
+
+    contents = []
+    for i in range(messages):
+        r = rng.random()
+        if r < .70:
+            contents.append("just chatting about stuff number {}".format(i))
+        elif r < .90:
+            contents.append(rng.choice(prefixes) +
+                            "cmd{} arg".format(rng.randrange(200)))
+        elif r < .95:
+            contents.append("!al{} x".format(rng.randrange(50)))
+        else:
+            contents.append("!cc{}".format(rng.randrange(100)))
+    batch = [_Fake(content=c, server=server, channel=channel, author=author,
+                   mentions=[author], embeds=[{"type": "rich"}],
+                   attachments=[]) for c in contents]
+
+    def get_prefix(content):
+        for p in prefixes:
+            if content.startswith(p):
+                return p
+
+    def process_commands(message):
+        prefix = get_prefix(message.content)
+        if prefix is not None:
+            return commands.get(_WORD.match(message.content,
+                                            len(prefix)).group())
+
+    def old(message):
+        # The core on_message, Alias.on_message and checkCC each matched
+        # the prefixes on their own, and Alias deepcopied the message
+        process_commands(message)
+        prefix = get_prefix(message.content)
+        if prefix is not None:
+            alias = message.content[len(prefix):].split(" ")[0].lower()
+            if alias in aliases:
+                rewritten = copy.deepcopy(message)
+                rewritten.content = (prefix + aliases[alias] +
+                                     message.content[len(prefix + alias):])
+                process_commands(rewritten)
+        prefix = get_prefix(message.content)
+        if prefix is not None:
+            name = message.content[len(prefix):]
+            if name not in customs:
+                customs.get(name.lower())
+
+    bot = _Fake(settings=_Fake(get_prefixes=lambda server: prefixes),
+                commands=commands)
+    dispatcher = Dispatcher(bot)
+    dispatcher.register("alias", lambda sid: aliases, None)
+    dispatcher.register("customcom", lambda sid: customs, None)
+
+    def new(message):
+        route = dispatcher.parse(message)
+        if route is not None and route.alias is not None:
+            rest = route.content[len(route.prefix):]
+            content = (route.prefix + route.alias +
+                       rest[len(rest.split(" ", 1)[0]):])
+            dispatcher.rewrite(route, content)
+
+    result = {}
+    for name, route in (("old", old), ("new", new)):
+        best = 0
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for message in batch:
+                route(message)
+            best = max(best, messages / (time.perf_counter() - start))
+        result[name] = best
+    return result
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    result = benchmark(messages)
+    print("Routed {old:,.0f} msg/s with a prefix loop per listener, "
+          "{new:,.0f} msg/s with the dispatcher.".format(**result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""CPU per stream playing a file through ffmpeg and the Opus encoder, the
+way the stock player does, and from the pre-encoded frames of the Opus
+cache. Run it on an otherwise idle machine.
+
+    python tools/bench_opus.py <audio file> [--avconv]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The cogs import these from the bot's main module, this script is it here
+send_cmd_help = settings = permissions = None
+
+import discord  # noqa: E402
+from cogs.audio import OPUS_MAGIC, encode_opus_frames  # noqa: E402
+
+
+def benchmark_stream_cpu(source, use_avconv=False):
+    """CPU seconds spent per second of audio playing source through
+    ffmpeg and the Opus encoder, and from pre-encoded frames. The
+    script runs nothing else, so the process's CPU time is the work's"""
+    def cpu():
+        t = os.times()
+        return t.user + t.system + t.children_user + t.children_system
+
+    encoder = discord.opus.Encoder(48000, 2)
+    args = ["avconv" if use_avconv else "ffmpeg", "-loglevel", "error",
+            "-i", source, "-f", "s16le", "-ar", "48000", "-ac", "2",
+            "pipe:1"]
+    start = cpu()
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    frames = 0
+    while True:
+        pcm = process.stdout.read(encoder.frame_size)
+        if len(pcm) != encoder.frame_size:
+            break
+        encoder.encode(pcm, encoder.samples_per_frame)
+        frames += 1
+    process.stdout.close()
+    process.wait()
+    live = cpu() - start
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_file = os.path.join(tmp_dir, "benchmark")
+        if not encode_opus_frames(source, tmp_file, use_avconv):
+            raise ValueError("{} couldn't be encoded".format(source))
+        start = cpu()
+        with open(tmp_file, "rb") as f:
+            f.read(len(OPUS_MAGIC))
+            while True:
+                header = f.read(2)
+                if len(header) != 2 or \
+                        not f.read(int.from_bytes(header, "big")):
+                    break
+        cached = cpu() - start
+
+    seconds = frames * encoder.frame_length / 1000
+    if not seconds:
+        raise ValueError("{} has no audio".format(source))
+    return {"seconds": seconds, "ffmpeg": live / seconds,
+            "opus_cache": cached / seconds}
+
+
+def main():
+    args = [a for a in sys.argv[1:] if a != "--avconv"]
+    if len(args) != 1:
+        sys.exit(__doc__.strip())
+    result = benchmark_stream_cpu(args[0], "--avconv" in sys.argv[1:])
+    print("{seconds:.0f}s of audio. CPU per stream: {ffmpeg:.2%} through "
+          "ffmpeg, {opus_cache:.2%} from the Opus cache.".format(**result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Requests and 429s for a burst of short messages to one channel, sent
+directly and through cogs.utils.outbound.OutboundQueue. Uses a fake HTTP
+client, nothing is sent to Discord.
+
+    python tools/bench_outbound.py [messages]
+"""
+from collections import Counter, deque
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cogs.utils.outbound import CHANNEL_BUCKET, OutboundQueue  # noqa: E402
+
+
+class _FakeHTTP:
+    """Counts requests, answering 429 past 5 per window in a channel the
+    way Discord does, after which the sender retries"""
+
+    def __init__(self, window):
+        self.window = window
+        self.requests = 0
+        self.rate_limited = 0
+        self._sent = {}
+
+    async def post(self, destination, content):
+        await asyncio.sleep(0.005)
+        sent = self._sent.setdefault(destination, deque())
+        while True:
+            now = time.monotonic()
+            while sent and now - sent[0] >= self.window:
+                sent.popleft()
+            self.requests += 1
+            if len(sent) < CHANNEL_BUCKET[0]:
+                sent.append(now)
+                return content
+            self.rate_limited += 1
+            await asyncio.sleep(self.window - (now - sent[0]))
+
+
+class _FakeBot:
+    def __init__(self, loop, window):
+        self.loop = loop
+        self.counter = Counter()
+        self.http = _FakeHTTP(window)
+        self.outbound = OutboundQueue(self, bucket=(CHANNEL_BUCKET[0],
+                                                    window))
+
+    async def send_message(self, destination, content, coalesce=False):
+        if coalesce:
+            return await self.outbound.send(destination, content)
+        return await self.http.post(destination, content)
+
+
+async def benchmark_burst(loop, messages=60, window=0.5):
+    """Sends a burst of short messages to one channel through a fake
+    HTTP client, with and without coalescing. window shrinks Discord's
+    5 seconds so it runs quickly"""
+    lines = ["line {} ".format(i) + "x" * (i % 90) for i in range(messages)]
+    results = {}
+    for coalesce in (False, True):
+        bot = _FakeBot(loop, window)
+        start = time.monotonic()
+        await asyncio.gather(*[bot.send_message("channel", line, coalesce)
+                               for line in lines])
+        results["coalesced" if coalesce else "direct"] = {
+            "requests": bot.http.requests,
+            "rate_limited": bot.http.rate_limited,
+            "seconds": time.monotonic() - start}
+    return results
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(benchmark_burst(loop, messages))
+    for name in ("direct", "coalesced"):
+        print("{}: {requests} requests, {rate_limited} rate limited, "
+              "{seconds:.2f}s".format(name, **result[name]))
+
+
+if __name__ == "__main__":
+    main()
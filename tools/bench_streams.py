@@ -0,0 +1,105 @@
+"""Time for one sweep of the stream checker over fake Twitch, Hitbox and
+Beam streams, served by a local fake API that answers every request after
+a delay. Nothing is sent to the real providers.
+
+    python tools/bench_streams.py [twitch] [hitbox] [beam]
+"""
+from collections import defaultdict
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The cogs import these from the bot's main module, this script is it here
+send_cmd_help = settings = permissions = None
+
+from cogs.streams import Streams  # noqa: E402
+
+
+class _FakeStreamAPI(asyncio.Protocol):
+    """Local stand-in for the three providers' APIs, answering that
+    every stream is offline after latency seconds. Mount at /twitch,
+    /hitbox and /beam"""
+
+    answers = (("/twitch/", {"streams": []}),
+               ("/hitbox/", {"livestream": [{"media_is_live": "0"}]}),
+               ("/beam/", {"online": False}))
+
+    def __init__(self, loop, latency, requests):
+        self.loop = loop
+        self.latency = latency
+        self.requests = requests  # path prefix: count
+        self.transport = None
+        self.buffer = b""
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        while b"\r\n\r\n" in self.buffer:
+            head, self.buffer = self.buffer.split(b"\r\n\r\n", 1)
+            path = head.split(b" ", 2)[1].decode()
+            answer = {}
+            for prefix, body in self.answers:
+                if path.startswith(prefix):
+                    self.requests[prefix] += 1
+                    answer = body
+            self.loop.call_later(self.latency, self.respond, answer)
+
+    def respond(self, answer):
+        if self.transport.is_closing():
+            return
+        body = json.dumps(answer).encode()
+        self.transport.write(b"HTTP/1.1 200 OK\r\n"
+                             b"Content-Type: application/json\r\n"
+                             b"Content-Length: " + str(len(body)).encode() +
+                             b"\r\n\r\n" + body)
+
+
+async def benchmark_sweep(loop, counts=(500, 200, 100), latency=0.05):
+    """Sweeps counts (Twitch, Hitbox, Beam) streams served by
+    _FakeStreamAPI and returns what it took"""
+    requests = defaultdict(int)
+    server = await loop.create_server(
+        lambda: _FakeStreamAPI(loop, latency, requests), "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    base = "http://127.0.0.1:{}".format(port)
+    checker = Streams(type("FakeBot", (), {"loop": loop}))
+    checker.twitch_api = base + "/twitch"
+    checker.hitbox_api = base + "/hitbox"
+    checker.beam_api = base + "/beam"
+    checker.settings = {}
+    for attr, count in zip(("twitch_streams", "hitbox_streams",
+                            "beam_streams"), counts):
+        setattr(checker, attr, [{"NAME": "stream{}".format(i),
+                                 "CHANNELS": [], "ALREADY_ONLINE": False}
+                                for i in range(count)])
+    try:
+        await checker.check_all_streams()
+    finally:
+        checker.session.close()
+        server.close()
+    seconds, streams = checker.last_sweep
+    # The old checker did one request per stream with a 0.5s sleep after
+    return {"seconds": seconds, "streams": streams,
+            "requests": sum(requests.values()),
+            "twitch_requests": requests["/twitch/"],
+            "old_seconds": streams * (latency + 0.5)}
+
+
+def main():
+    counts = [500, 200, 100]
+    for i, count in enumerate(sys.argv[1:4]):
+        counts[i] = int(count)
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(benchmark_sweep(loop, counts))
+    print("Swept {streams} fake streams in {seconds:.2f}s with {requests} "
+          "requests ({twitch_requests} to Twitch). Checking them one by one "
+          "would have taken {old_seconds:.0f}s.".format(**result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Microseconds per message for the old per-word filter loop and for
+cogs.mod.WordFilter, at several filter sizes.
+
+    python tools/bench_word_filter.py
+"""
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The cogs import these from the bot's main module, this script is it here
+send_cmd_help = settings = permissions = None
+
+from cogs.mod import WordFilter  # noqa: E402
+
+
+def benchmark_word_filter(sizes=(10, 100, 1000), words=40, rounds=2000):
+    """Microseconds per message for the old per-word loop and WordFilter,
+    for each filter size. The message has no filtered word in it, which
+    is the worst case for both. Blocking"""
+    rng = random.Random(0)
+
+    def word():
+        return "".join(rng.choice(string.ascii_lowercase)
+                       for _ in range(rng.randint(3, 9)))
+
+    message = " ".join(word() for _ in range(words)).upper()
+    results = []
+    for size in sizes:
+        terms = [word() + "q" for _ in range(size)]  # Never in the message
+        word_filter = WordFilter(terms)
+
+        def old():
+            for w in terms:
+                if w in message.lower():
+                    return w
+
+        def new():
+            return word_filter.search(message.lower())
+
+        timings = []
+        for func in (old, new):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                func()
+            timings.append((time.perf_counter() - start) / rounds * 1e6)
+        results.append((size, timings[0], timings[1]))
+    return results
+
+
+def main():
+    print("terms   old loop   WordFilter  (us per message)")
+    for size, old, new in benchmark_word_filter():
+        print("{:>5}  {:>9.1f}  {:>11.1f}".format(size, old, new))
+
+
+if __name__ == "__main__":
+    main()